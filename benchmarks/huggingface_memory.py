@@ -0,0 +1,63 @@
+"""Measure the per-kernel memory footprint of
+:class:`icortex.services.huggingface.HuggingFaceAutoService` when several
+processes load the same model, with and without memory-mapped weights::
+
+    python benchmarks/huggingface_memory.py --kernels 4
+
+RSS counts shared pages in every process that maps them, so PSS is the
+number to compare: it splits shared pages between the processes.
+"""
+
+import argparse
+import multiprocessing as mp
+
+from icortex.helper import get_pss, get_rss
+from icortex.services.huggingface import DEFAULT_MODEL, WEIGHT_LOADING_MODES
+
+
+def load_and_report(model, weight_loading, loaded, done):
+    from icortex.services.huggingface import HuggingFaceAutoService
+
+    service = HuggingFaceAutoService(model=model, weight_loading=weight_loading)
+    service._generate(prompt="# print hello world\n", max_length=32, temperature=0)
+    # Wait for every process to finish loading before measuring, so that
+    # PSS reflects the pages shared between all of them
+    loaded.wait()
+    done.put((get_rss(), get_pss()))
+
+
+def run(model, weight_loading, n_kernels):
+    ctx = mp.get_context("spawn")
+    loaded = ctx.Barrier(n_kernels)
+    done = ctx.Queue()
+    processes = [
+        ctx.Process(target=load_and_report, args=(model, weight_loading, loaded, done))
+        for _ in range(n_kernels)
+    ]
+    for p in processes:
+        p.start()
+    results = [done.get() for _ in processes]
+    for p in processes:
+        p.join()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    parser.add_argument("--kernels", type=int, default=4)
+    args = parser.parse_args()
+
+    print(f"{'weight_loading':<16}{'RSS/kernel (MB)':>17}{'PSS/kernel (MB)':>17}")
+    for mode in WEIGHT_LOADING_MODES:
+        results = run(args.model, mode, args.kernels)
+        rss = sum(r for r, _ in results) / len(results) / 2**20
+        pss_values = [p for _, p in results if p is not None]
+        pss = (
+            f"{sum(pss_values) / len(pss_values) / 2**20:.1f}" if pss_values else "n/a"
+        )
+        print(f"{mode:<16}{rss:>17.1f}{pss:>17}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""Compare generation speed and memory usage of the quantization modes of
+:class:`icortex.services.huggingface.HuggingFaceAutoService`.
+
+Each mode is run in a separate process so that the memory measurements
+do not affect each other::
+
+    python benchmarks/huggingface_quantization.py --model TextCortex/codegen-350M-optimized
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+from icortex.helper import get_rss
+from icortex.services.huggingface import QUANTIZATION_MODES, DEFAULT_MODEL
+
+PROMPTS = [
+    "print the first 10 prime numbers",
+    "read a csv file called data.csv and plot the first column",
+    "sort a list of dictionaries by the value of the key 'age'",
+]
+
+
+def run_mode(model: str, quantization: str, max_length: int, repeat: int):
+    from icortex.services.huggingface import HuggingFaceAutoService
+
+    start = time.perf_counter()
+    service = HuggingFaceAutoService(model=model, quantization=quantization)
+    load_time = time.perf_counter() - start
+    rss_after_load = get_rss()
+
+    # Warm up before measuring
+    service._generate(prompt=PROMPTS[0], max_length=max_length, temperature=0)
+
+    n_tokens = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for prompt in PROMPTS:
+            outputs = service._generate(
+                prompt=prompt, max_length=max_length, temperature=0
+            )
+            n_tokens += sum(len(service.tokenizer(o).input_ids) for o in outputs)
+    elapsed = time.perf_counter() - start
+
+    return {
+        "quantization": quantization,
+        "load_time_s": round(load_time, 2),
+        "tokens_per_s": round(n_tokens / elapsed, 2),
+        "rss_after_load_mb": round(rss_after_load / 2**20, 1),
+        "rss_mb": round(get_rss() / 2**20, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    parser.add_argument("--max-length", type=int, default=128)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--modes", nargs="+", choices=QUANTIZATION_MODES, default=QUANTIZATION_MODES
+    )
+    # Used internally to run a single mode in a subprocess
+    parser.add_argument("--single", choices=QUANTIZATION_MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single is not None:
+        result = run_mode(args.model, args.single, args.max_length, args.repeat)
+        print(json.dumps(result))
+        return
+
+    results = []
+    for mode in args.modes:
+        output = subprocess.check_output(
+            [
+                sys.executable,
+                __file__,
+                "--model",
+                args.model,
+                "--max-length",
+                str(args.max_length),
+                "--repeat",
+                str(args.repeat),
+                "--single",
+                mode,
+            ],
+            text=True,
+        )
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    baseline = next((r for r in results if r["quantization"] == "none"), None)
+    print(
+        f"{'quantization':<14}{'load (s)':>10}{'tokens/s':>10}{'speedup':>9}{'RSS (MB)':>10}{'RSS ratio':>11}"
+    )
+    for r in results:
+        speedup = r["tokens_per_s"] / baseline["tokens_per_s"] if baseline else 1.0
+        rss_ratio = r["rss_mb"] / baseline["rss_mb"] if baseline else 1.0
+        print(
+            f"{r['quantization']:<14}{r['load_time_s']:>10}{r['tokens_per_s']:>10}"
+            f"{speedup:>8.2f}x{r['rss_mb']:>10}{rss_ratio:>10.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""Sweep the thread settings of
+:class:`icortex.services.huggingface.HuggingFaceAutoService` and report
+generation speed for each, to pick the settings for a host::
+
+    python benchmarks/huggingface_threads.py --threads 1 2 4 8 --cpu-affinity 0-7
+
+Thread pools are configured once per process, so every setting is measured
+in its own process.
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+from icortex.services.huggingface import DEFAULT_MODEL
+
+PROMPTS = [
+    "print the first 10 prime numbers",
+    "read a csv file called data.csv and plot the first column",
+    "sort a list of dictionaries by the value of the key 'age'",
+]
+
+
+def run_setting(args):
+    from icortex.services.huggingface import HuggingFaceAutoService
+
+    service = HuggingFaceAutoService(
+        model=args.model,
+        backend=args.backend,
+        intra_op_threads=args.single,
+        inter_op_threads=args.inter_op_threads,
+        cpu_affinity=args.cpu_affinity,
+    )
+    # Warm up before measuring
+    service._generate(prompt=PROMPTS[0], max_length=args.max_length, temperature=0)
+
+    n_tokens = 0
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        for prompt in PROMPTS:
+            outputs = service._generate(
+                prompt=prompt, max_length=args.max_length, temperature=0
+            )
+            n_tokens += sum(len(service.tokenizer(o).input_ids) for o in outputs)
+    elapsed = time.perf_counter() - start
+
+    return {"threads": args.single, "tokens_per_s": round(n_tokens / elapsed, 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    parser.add_argument("--backend", default="auto", choices=["auto", "onnx"])
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--inter-op-threads", type=int, default=0)
+    parser.add_argument("--cpu-affinity", default="")
+    parser.add_argument("--max-length", type=int, default=128)
+    parser.add_argument("--repeat", type=int, default=3)
+    # Used internally to run a single setting in a subprocess
+    parser.add_argument("--single", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single is not None:
+        print(json.dumps(run_setting(args)))
+        return
+
+    print(f"{'intra-op threads':<18}{'tokens/s':>10}")
+    for threads in args.threads:
+        output = subprocess.check_output(
+            [sys.executable, __file__, *sys.argv[1:], "--single", str(threads)],
+            text=True,
+        )
+        result = json.loads(output.strip().splitlines()[-1])
+        print(f"{result['threads']:<18}{result['tokens_per_s']:>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,25 @@
-from icortex.kernel import ICortexKernel, print_service_help, get_icortex
+import typing as t
 
-import icortex.services
-import importlib_metadata
+# The kernel, the services and the package metadata are loaded on first
+# access, so that `import icortex` and the CLI start quickly
+_LAZY_ATTRIBUTES = {
+    "ICortexKernel": "icortex.kernel",
+    "print_service_help": "icortex.kernel",
+    "get_icortex": "icortex.kernel",
+}
 
-__version__ = importlib_metadata.version("icortex")
+
+def __getattr__(name: str) -> t.Any:
+    if name in _LAZY_ATTRIBUTES:
+        import importlib
+
+        return getattr(importlib.import_module(_LAZY_ATTRIBUTES[name]), name)
+    if name == "services":
+        import icortex.services
+
+        return icortex.services
+    if name == "__version__":
+        from icortex.helper import get_version
+
+        return get_version()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,135 @@
+import sys
+import typing as t
+
+from icortex.defaults import DEFAULT_OUTPUT_LIMIT
+
+TRUNCATION_MSG = "\n... [{} bytes truncated] ...\n"
+
+
+class StreamRecorder:
+    """Records text written to a stream, up to ``limit`` bytes. When the
+    limit is exceeded, the first and the last ``limit / 2`` bytes are kept
+    and the middle is dropped, so memory use stays bounded no matter how
+    much is written.
+
+    Args:
+        limit (int): Maximum number of bytes to keep. 0 or less means no limit.
+    """
+
+    def __init__(self, limit: int = DEFAULT_OUTPUT_LIMIT):
+        self.limit = limit
+        self.head_limit = limit - limit // 2
+        self.tail_limit = limit // 2
+        self._head = bytearray()
+        self._tail = bytearray()
+        self.size = 0
+
+    def write(self, text: str):
+        data = text.encode("utf-8", errors="replace")
+        self.size += len(data)
+        if self.limit <= 0:
+            self._head += data
+            return
+
+        room = self.head_limit - len(self._head)
+        if room > 0:
+            self._head += data[:room]
+            data = data[room:]
+        if data:
+            self._tail += data
+            # Trim lazily, so that many small writes stay cheap
+            if len(self._tail) > 2 * self.tail_limit:
+                del self._tail[: len(self._tail) - self.tail_limit]
+
+    @property
+    def truncated(self) -> int:
+        """Number of bytes that were dropped."""
+        if self.limit <= 0:
+            return 0
+        return max(self.size - self.head_limit - self.tail_limit, 0)
+
+    def getvalue(self) -> str:
+        head = self._head.decode("utf-8", errors="ignore")
+        if self.truncated == 0:
+            return head + self._tail.decode("utf-8", errors="ignore")
+        tail = self._tail[len(self._tail) - self.tail_limit :]
+        return (
+            head
+            + TRUNCATION_MSG.format(self.truncated)
+            + tail.decode("utf-8", errors="ignore")
+        )
+
+
+class TeeStream:
+    """Forwards everything written to it to ``stream`` right away, and
+    records a copy in ``recorder``. Other attributes are looked up on
+    ``stream``, so it can stand in for e.g. an ipykernel ``OutStream``.
+    """
+
+    def __init__(self, stream, recorder: StreamRecorder):
+        self.stream = stream
+        self.recorder = recorder
+
+    def write(self, text: str) -> int:
+        self.recorder.write(text)
+        return self.stream.write(text)
+
+    def writelines(self, lines: t.Iterable[str]):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class capture_streams:
+    """Context manager that tees :data:`sys.stdout` and :data:`sys.stderr`
+    while it is active. Unlike :class:`IPython.utils.capture.capture_output`,
+    output is still shown as it is written.
+
+    Args:
+        limit (int): Maximum number of bytes to record per stream.
+
+    Example:
+
+    .. code-block:: python
+
+        with capture_streams() as captured:
+            print("Hello")
+        captured.outputs  # [{"output_type": "stream", "name": "stdout", ...}]
+    """
+
+    def __init__(self, limit: int = DEFAULT_OUTPUT_LIMIT):
+        self.stdout = StreamRecorder(limit)
+        self.stderr = StreamRecorder(limit)
+
+    def __enter__(self):
+        self._stdout, self._stderr = sys.stdout, sys.stderr
+        sys.stdout = TeeStream(self._stdout, self.stdout)
+        sys.stderr = TeeStream(self._stderr, self.stderr)
+        return self
+
+    def __exit__(self, *exc_info):
+        sys.stdout, sys.stderr = self._stdout, self._stderr
+        return False
+
+    @property
+    def outputs(self) -> t.List[t.Dict[str, t.Any]]:
+        """The recorded streams as outputs in the Jupyter notebook format.
+        Empty streams are omitted.
+        """
+        ret = []
+        for name, recorder in [("stdout", self.stdout), ("stderr", self.stderr)]:
+            text = recorder.getvalue()
+            if text != "":
+                ret.append(
+                    {
+                        "output_type": "stream",
+                        "name": name,
+                        "text": text.splitlines(keepends=True),
+                    }
+                )
+        return ret
@@ -0,0 +1,334 @@
+import hashlib
+import importlib
+import os
+import pickle
+import sys
+import types
+import typing as t
+
+from icortex.defaults import DEFAULT_CELL_CACHE_MAX_SIZE, DEFAULT_CELL_CACHE_PATH
+from icortex.dependency import (
+    FILES,
+    CellDependencies,
+    apply_function_effects,
+    build_dependency_graph,
+    get_cell_dependencies,
+)
+
+# Types whose values cannot be mutated, so that passing them to a function
+# leaves them as they are. Functions are only called by the functions they
+# are passed to, and what they touch is tracked through function_effects
+IMMUTABLE_TYPES = (
+    int,
+    float,
+    complex,
+    bool,
+    str,
+    bytes,
+    range,
+    type(None),
+    types.FunctionType,
+    types.BuiltinFunctionType,
+)
+
+# Stands for any module, for cells whose dependencies are unclear
+_ANY_MODULE = "*"
+
+
+class _ModuleRef:
+    # Modules cannot be pickled, so they are imported again when loading
+    def __init__(self, name: str):
+        self.name = name
+
+
+def _is_immutable(value) -> bool:
+    if type(value) in (tuple, frozenset):
+        return all(_is_immutable(item) for item in value)
+    return type(value) in IMMUTABLE_TYPES
+
+
+def _get_used_modules(
+    cell_deps: t.List[t.Optional[CellDependencies]],
+) -> t.List[t.Set[str]]:
+    # Modules that each cell imports or refers to by a name bound upstream
+    used = []
+    modules: t.Dict[str, str] = {}
+    for deps in cell_deps:
+        if deps is None:
+            used.append({_ANY_MODULE})
+            modules = {}
+            continue
+        names = deps.reads | deps.writes | deps.method_targets
+        used.append(
+            set(deps.imports.values())
+            | {modules[name] for name in names - deps.binds if name in modules}
+        )
+        for name in deps.binds:
+            if name in deps.imports:
+                modules[name] = deps.imports[name]
+            else:
+                modules.pop(name, None)
+    return used
+
+
+class CellCache:
+    """Persistent cache of the results of notebook cells, for
+    ``icortex run --cache``. For every cell, the values of the global names
+    that it writes are pickled into ``path``. When the notebook is run
+    again, a cell whose key is found in the cache is not executed, and the
+    values are loaded into the scope instead.
+
+    The key of a cell is a hash of its code, of the working directory and
+    of the keys of the cells it depends on, see
+    :func:`icortex.dependency.build_dependency_graph`. The code of a
+    variable cell contains the value of the variable, so changing a
+    variable only re-executes the cells that depend on it. Files that cells
+    read are not part of the key.
+
+    Loading a cell can only restore the names it binds, so the following
+    cells are always executed:
+
+    - Cells whose dependencies are unclear.
+    - Cells that may mutate an object defined by an earlier cell, e.g. by
+      calling a method on it or passing it to a function, unless the object
+      is immutable, e.g. a number or a string. This includes mutating the
+      items of the object, e.g. through the target of ``for x in items``.
+    - Cells that call a function of a module, e.g. ``random.seed()``, if a
+      later cell uses the module as well, since the state of modules is not
+      stored.
+    - Cells that bind a name to an object defined by an earlier cell, or to
+      an item of one, e.g. ``b = a`` or ``b = a[0]``, since they would be
+      loaded as a copy of it.
+    - Cells that may write files, e.g. with ``open(path, "w")``.
+    - Cells whose values cannot be pickled.
+
+    The output of cells that are loaded from the cache is not shown again.
+
+    The entries are unpickled, which can run arbitrary code, so ``path``
+    has to be a directory that only trusted users can write to. It defaults
+    to a directory in the user cache. Once the entries exceed ``max_size``
+    bytes, the least recently used ones are deleted.
+
+    Args:
+        path (str, optional): Directory to store the results in.
+        max_size (int, optional): Maximum total size of the entries in
+            bytes.
+    """
+
+    def __init__(
+        self,
+        path: str = DEFAULT_CELL_CACHE_PATH,
+        max_size: int = DEFAULT_CELL_CACHE_MAX_SIZE,
+    ):
+        self.path = path
+        self.max_size = max_size
+
+    def get_keys(
+        self, codes: t.List[str], cell_deps: t.List[t.Optional[CellDependencies]]
+    ) -> t.Tuple[t.List[str], t.List[t.Set[int]]]:
+        """Compute the keys of cells.
+
+        Returns:
+            Tuple[List[str], List[Set[int]]]: The keys, and the dependency
+            graph of the cells.
+        """
+        graph = build_dependency_graph(cell_deps)
+        keys = []
+        for code, preds in zip(codes, graph):
+            digest = hashlib.sha256()
+            # Pickles are not guaranteed to load in other Python versions
+            digest.update(f"{sys.version_info[0]}.{sys.version_info[1]}\0".encode())
+            # Relative paths in the code refer to other files elsewhere
+            digest.update(os.getcwd().encode("utf-8") + b"\0")
+            digest.update(code.encode("utf-8"))
+            for pred in sorted(preds):
+                digest.update(b"\0" + keys[pred].encode())
+            keys.append(digest.hexdigest())
+        return keys, graph
+
+    def _get_path(self, key: str) -> str:
+        return os.path.join(self.path, key + ".pkl")
+
+    def load(self, key: str, scope: t.Dict[str, t.Any]) -> bool:
+        """Load the values that were stored for a key into ``scope``.
+
+        Returns:
+            bool: True if the key was found.
+        """
+        path = self._get_path(key)
+        try:
+            with open(path, "rb") as f:
+                entry = pickle.load(f)
+            values = {
+                name: (
+                    importlib.import_module(value.name)
+                    if isinstance(value, _ModuleRef)
+                    else value
+                )
+                for name, value in entry["values"].items()
+            }
+        except Exception:
+            # Missing, or stored by an incompatible version of a library
+            return False
+
+        try:
+            # Mark the entry as recently used
+            os.utime(path)
+        except OSError:
+            pass
+        scope.update(values)
+        for name in entry["deleted"]:
+            scope.pop(name, None)
+        return True
+
+    def store(self, key: str, scope: t.Dict[str, t.Any], names: t.Iterable[str]):
+        """Store the values of ``names`` in ``scope`` under a key. Nothing is
+        stored if a value cannot be pickled.
+        """
+        values, deleted = {}, []
+        for name in names:
+            if name not in scope:
+                deleted.append(name)
+            elif isinstance(scope[name], types.ModuleType):
+                values[name] = _ModuleRef(scope[name].__name__)
+            else:
+                values[name] = scope[name]
+
+        try:
+            data = pickle.dumps(
+                {"values": values, "deleted": deleted},
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+        except Exception:
+            return
+        if len(data) > self.max_size:
+            return
+
+        os.makedirs(self.path, exist_ok=True)
+        # Write atomically, since cells can run in parallel
+        tmp_path = f"{self._get_path(key)}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, self._get_path(key))
+        self.evict()
+
+    def evict(self):
+        """Delete the least recently used entries until the entries fit in
+        ``max_size`` bytes.
+        """
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith(".pkl"):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # Deleted by another process in the meantime
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def prepare(
+        self, codes: t.List[str], scope: t.Dict[str, t.Any]
+    ) -> t.Tuple[t.Callable[[int], bool], t.List[t.Set[int]]]:
+        """Prepare to run cells with the cache.
+
+        Returns:
+            Tuple[Callable[[int], bool], List[Set[int]]]: A function that
+            runs the cell with the given index, and returns True if it was
+            loaded from the cache, and the dependency graph of the cells.
+        """
+        cell_deps = [get_cell_dependencies(code) for code in codes]
+        keys, graph = self.get_keys(codes, cell_deps)
+        used_modules = _get_used_modules(cell_deps)
+
+        # Names whose values each cell stores, None if it is never cached,
+        # the names of objects from earlier cells that it may mutate, and
+        # the names that it binds to objects from earlier cells
+        cell_names: t.List[t.Optional[t.Set[str]]] = []
+        cell_mutated: t.List[t.Set[str]] = []
+        cell_aliases: t.List[t.Set[str]] = []
+        function_effects = {}
+        # Names bound by earlier cells to objects of other names
+        aliases: t.Dict[str, t.Set[str]] = {}
+        for idx, deps in enumerate(cell_deps):
+            if deps is None:
+                cell_names.append(None)
+                cell_mutated.append(set())
+                cell_aliases.append(set())
+                continue
+            function_effects.update(deps.function_effects)
+            _, writes, method_targets = apply_function_effects(deps, function_effects)
+            names = writes | method_targets
+            mutated = names - deps.binds
+            mutated = mutated.union(*(aliases.get(name, set()) for name in mutated))
+            for name in deps.binds:
+                if name in deps.aliases:
+                    aliases[name] = deps.aliases[name].union(
+                        *(aliases.get(source, set()) for source in deps.aliases[name])
+                    )
+                else:
+                    aliases.pop(name, None)
+
+            # Files that the cell writes are not restored when it is loaded
+            if FILES in names:
+                names = None
+
+            # The state of modules that the cell changes is lost when it is
+            # loaded, which later cells that use the modules would notice
+            called_modules = {
+                deps.imports[name] for name in method_targets if name in deps.imports
+            }
+            used_later = set().union(*used_modules[idx + 1 :])
+            if called_modules and (
+                called_modules & used_later or _ANY_MODULE in used_later
+            ):
+                names = None
+
+            cell_names.append(names)
+            cell_mutated.append(mutated)
+            cell_aliases.append(
+                {name for name, sources in deps.aliases.items() if sources - deps.binds}
+            )
+
+        def is_cacheable(idx: int) -> bool:
+            if cell_names[idx] is None:
+                return False
+            return all(
+                _is_immutable(scope[name])
+                for name in cell_mutated[idx]
+                if name in scope
+            )
+
+        def run_cell(idx: int) -> bool:
+            if not is_cacheable(idx):
+                exec(codes[idx], scope)
+                return False
+            if self.load(keys[idx], scope):
+                return True
+
+            # Objects from earlier cells, which would be loaded as copies
+            earlier = {id(value) for value in list(scope.values())}
+            exec(codes[idx], scope)
+            names = cell_names[idx]
+            if not any(
+                id(scope[name]) in earlier or name in cell_aliases[idx]
+                for name in names
+                if name in scope
+                and not _is_immutable(scope[name])
+                and not isinstance(scope[name], types.ModuleType)
+            ):
+                self.store(keys[idx], scope, names)
+            return False
+
+        return run_cell, graph
@@ -1,14 +1,24 @@
+import json
 import os
 import shlex
 import sys
 import argparse
-from icortex.context import ICortexContext
+from functools import lru_cache
 from icortex.services import get_available_services
-from icortex.defaults import DEFAULT_ICORTEX_CONFIG_PATH
-from icortex.kernel.install import is_kernel_installed, main as install_kernel
+from icortex.defaults import (
+    DEFAULT_CACHE_PATH,
+    DEFAULT_CELL_CACHE_PATH,
+    DEFAULT_ICORTEX_CONFIG_PATH,
+    DEFAULT_SERVER_HOST,
+    DEFAULT_SERVER_PORT,
+    DEFAULT_WHEELHOUSE_PATH,
+)
 from icortex.config import ICortexConfig
 
 
+# The parser only depends on prog, so it is built once and reused by every
+# %icortex magic
+@lru_cache(maxsize=None)
 def get_parser(prog=None):
     service_names = get_available_services()
     parser = argparse.ArgumentParser(add_help=False)
@@ -56,6 +66,24 @@ def get_parser(prog=None):
         type=str,
         help="Path to the ICortex notebook to be run",
     )
+    parser_run.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Maximum number of independent cells to run in parallel. Has to come before the notebook.",
+    )
+    parser_run.add_argument(
+        "--cache",
+        action="store_true",
+        help="Load cells whose code and upstream cells did not change since the last cached run from the cache, instead of executing them. Has to come before the notebook.",
+    )
+    parser_run.add_argument(
+        "--cache-dir",
+        type=str,
+        help="Directory of the cache of cell results. Cached results are unpickled, so only use a directory that untrusted users cannot write to.",
+        default=DEFAULT_CELL_CACHE_PATH,
+    )
     # A catch-all for the rest of the arguments
     parser_run.add_argument("notebook_args", nargs=argparse.REMAINDER)
 
@@ -82,6 +110,47 @@ def get_parser(prog=None):
         help="Path of the destination Python file",
     )
 
+    #####################################
+    # Serve code generation on the node #
+    #####################################
+
+    # icortex serve-generation
+    parser_serve = subparsers.add_parser(
+        "serve-generation",
+        help="Start a generation server that hosts services for all kernels on this node",
+        add_help=False,
+    )
+    parser_serve.add_argument(
+        "--config",
+        type=str,
+        help="Path to the configuration TOML file of the hosted services.",
+        default=DEFAULT_ICORTEX_CONFIG_PATH,
+    )
+    parser_serve.add_argument(
+        "--host",
+        type=str,
+        help="Host to listen on.",
+        default=DEFAULT_SERVER_HOST,
+    )
+    parser_serve.add_argument(
+        "--port",
+        type=int,
+        help="Port to listen on.",
+        default=DEFAULT_SERVER_PORT,
+    )
+    parser_serve.add_argument(
+        "--max-concurrency",
+        type=int,
+        help="Maximum number of concurrent generations per service.",
+        default=1,
+    )
+    parser_serve.add_argument(
+        "--rate-limit",
+        type=float,
+        help="Maximum number of generations per minute per service, shared by all clients. 0 means no limit.",
+        default=0,
+    )
+
     ##########################
     # Shell related commands #
     ##########################
@@ -92,6 +161,12 @@ def get_parser(prog=None):
         help="Start ICortex shell",
         add_help=False,
     )
+    parser_shell.add_argument(
+        "--existing",
+        type=str,
+        metavar="CONNECTION_FILE",
+        help="Connect to a running ICortex kernel through its connection file, instead of running the shell in this process.",
+    )
 
     ########
     # Help #
@@ -174,6 +249,72 @@ def get_parser(prog=None):
         choices=service_names,
         help="Name of the service to be used for code generation",
     )
+    ############################
+    # Package related commands #
+    ############################
+
+    # icortex packages
+    parser_packages = subparsers.add_parser(
+        "packages",
+        help="Manage the packages that are auto-installed for generated code",
+        add_help=False,
+    )
+    parser_packages_commands = parser_packages.add_subparsers(
+        dest="packages_command",
+        required=True,
+    )
+
+    # icortex packages refresh-index
+    parser_packages_commands.add_parser(
+        "refresh-index",
+        help="Rebuild the index that maps imported modules to PyPI packages from the installed distributions",
+        add_help=False,
+    )
+
+    ##########################
+    # Wheelhouse for offline #
+    ##########################
+
+    # icortex wheels
+    parser_wheels = subparsers.add_parser(
+        "wheels",
+        help="Manage the local wheelhouse that packages are installed from in offline mode",
+        add_help=False,
+    )
+    parser_wheels_commands = parser_wheels.add_subparsers(
+        dest="wheels_command",
+        required=True,
+    )
+
+    # icortex wheels sync [<notebook>] [--from-cache]
+    parser_wheels_commands_sync = parser_wheels_commands.add_parser(
+        "sync",
+        help="Download wheels for the packages imported by a notebook or by cached generations into the wheelhouse",
+        add_help=False,
+    )
+    parser_wheels_commands_sync.add_argument(
+        "notebook",
+        type=str,
+        nargs="?",
+        help="Path of the ICortex notebook whose imports are collected",
+    )
+    parser_wheels_commands_sync.add_argument(
+        "--from-cache",
+        action="store_true",
+        help="Collect the imports of the code in the generation cache",
+    )
+    parser_wheels_commands_sync.add_argument(
+        "--wheelhouse",
+        type=str,
+        help="Directory to download the wheels into. Defaults to the wheelhouse in the [packages] table of the configuration.",
+    )
+    parser_wheels_commands_sync.add_argument(
+        "--config",
+        type=str,
+        help="Path to the configuration TOML file.",
+        default=DEFAULT_ICORTEX_CONFIG_PATH,
+    )
+
     if prog is not None:
         parser_init.prog = prog
         for action in parser._actions:
@@ -197,9 +338,13 @@ def main(argv=None, prog=None, kernel=None):
     parser, parser_service = get_parser(prog=prog)
     args = parser.parse_args(argv)
 
-    # Install kernel if it's not already
-    if not is_kernel_installed():
-        install_kernel()
+    # Install kernel if it's not already. There is no need to check when
+    # running as a magic, inside the kernel itself
+    if prog != r"%icortex":
+        from icortex.kernel.install import is_kernel_installed, main as install_kernel
+
+        if not is_kernel_installed():
+            install_kernel([])
 
     if "config" in args:
         config_path = args.config
@@ -207,6 +352,11 @@ def main(argv=None, prog=None, kernel=None):
         config_path = DEFAULT_ICORTEX_CONFIG_PATH
 
     config = ICortexConfig(config_path)
+    if prog == r"%icortex":
+        # Running as a magic, so changes apply to the service of this kernel
+        from icortex.kernel import get_icortex
+
+        config.set_kernel(get_icortex())
 
     if args.command == "init":
         # If no config file exists, initialize it
@@ -220,26 +370,98 @@ def main(argv=None, prog=None, kernel=None):
         elif args.service_command == "set-var":
             config.set_service_var(args.variable_name, args.variable_value)
         elif args.service_command == "show":
+            from icortex.kernel import get_icortex
+
             print(config.format_current_service())
+            kernel = get_icortex()
+            if kernel is not None:
+                print(config.format_service_status(kernel))
         elif args.service_command == "init":
             config.set_service_config(args.service_name, hard_init=True)
         elif args.service_command == "help":
             parser_service.print_help()
     elif args.command == "help":
         parser.print_help()
+    elif args.command == "packages":
+        if args.packages_command == "refresh-index":
+            from icortex.pypi import refresh_module_index
+
+            index = refresh_module_index()
+            print(f"Indexed {len(index)} modules of installed distributions.")
+    elif args.command == "wheels":
+        if args.wheels_command == "sync":
+            from icortex.pypi import sync_wheelhouse
+
+            if args.notebook is None and not args.from_cache:
+                print("Pass a notebook, --from-cache, or both.")
+                return
+
+            codes = []
+            if args.notebook is not None:
+                from icortex.context import ICortexContext
+
+                context = ICortexContext.from_file(args.notebook)
+                codes += [cell.get_code() for cell in context.iter_cells()]
+            if args.from_cache and os.path.exists(DEFAULT_CACHE_PATH):
+                with open(DEFAULT_CACHE_PATH, "r") as f:
+                    for interaction in json.load(f):
+                        codes += interaction.get("outputs", [])
+
+            wheelhouse = args.wheelhouse
+            if wheelhouse is None:
+                wheelhouse = config.get_packages_option(
+                    "wheelhouse", DEFAULT_WHEELHOUSE_PATH
+                )
+            wheelhouse = os.path.expanduser(wheelhouse)
+
+            packages, unresolved_modules, success = sync_wheelhouse(codes, wheelhouse)
+            if len(unresolved_modules) > 0:
+                print(
+                    f"The following imported modules could not be resolved to PyPI packages: {', '.join(unresolved_modules)}"
+                )
+            if not success:
+                print(f"Could not download all of the wheels into {wheelhouse}.")
+            else:
+                print(f"Synced {len(packages)} packages into {wheelhouse}.")
     elif args.command == "run":
+        from icortex.context import ICortexContext
+
         context = ICortexContext.from_file(args.notebook)
-        context.run(args.notebook_args)
+        context.run(
+            args.notebook_args,
+            jobs=args.jobs,
+            cache_path=args.cache_dir if args.cache else None,
+        )
     elif args.command == "bake":
+        from icortex.context import ICortexContext
+
         context = ICortexContext.from_file(args.notebook)
         context.bake(args.destination)
+    elif args.command == "serve-generation":
+        from icortex.server import serve
+
+        serve(
+            config_path,
+            host=args.host,
+            port=args.port,
+            max_concurrency=args.max_concurrency,
+            rate_limit=args.rate_limit,
+        )
     elif args.command == "shell" or args.command is None:
         from icortex.kernel import get_icortex
-        from icortex.kernel.app import ZMQTerminalICortexApp
 
         kernel = get_icortex()
         if kernel is None:
-            ZMQTerminalICortexApp.launch_instance()
+            if getattr(args, "existing", None):
+                from icortex.kernel.app import ZMQTerminalICortexApp
+
+                ZMQTerminalICortexApp.launch_instance(
+                    argv=["--existing", args.existing]
+                )
+            else:
+                from icortex.kernel.terminal import launch_terminal_shell
+
+                launch_terminal_shell()
         else:
             # print("The ICortex shell is already running, skipping.")
             parser.print_help()
@@ -1,9 +1,11 @@
-import toml
+import typing as t
 from icortex.defaults import DEFAULT_SERVICE
 
 from icortex.services import get_available_services, get_service
 from icortex.helper import yes_no_input, prompt_input
-from icortex.services.service_base import ServiceVariable
+
+if t.TYPE_CHECKING:
+    from icortex.services.service_base import ServiceVariable
 
 
 class ICortexConfig:
@@ -36,7 +38,13 @@ class ICortexConfig:
             print(f"Service does not exist: {service_name}")
             return False
 
-        var: ServiceVariable = service.get_variable(service, var_name)
+        current = self.kernel.service if self.kernel is not None else None
+        if current is not None and current.name == service_name:
+            var: "ServiceVariable" = current.get_variable(var_name)
+        elif service.dynamic_variables:
+            var = service(**self.dict.get(service_name, {})).get_variable(var_name)
+        else:
+            var = service.get_variable(service, var_name)
 
         if var is None:
             print(f"Variable {var_name} does not exist for service {service_name}.")
@@ -52,7 +60,15 @@ class ICortexConfig:
             print(f"Set variable {var_name} to {cast_value}.")
             # kernel = get_icortex()
             if self.kernel is not None:
-                self.set_service()
+                # Apply the value to the running service if possible, instead
+                # of re-instantiating it
+                current = self.kernel.service
+                if (
+                    current is None
+                    or current.name != service_name
+                    or not current.set_variable(var_name, cast_value)
+                ):
+                    self.set_service()
             return True
         else:
             raise Exception("Could not write configuration file")
@@ -127,17 +143,23 @@ class ICortexConfig:
         return self.set_service_config(service_name)
 
     def read_config(self):
+        import toml
+
         try:
             self.dict = toml.load(open(self.path, "r"))
         except FileNotFoundError:
             self.dict = {}
 
     def write_config(self):
+        import toml
+
         with open(self.path, "w") as f:
             toml.dump(self.dict, f)
         return True
 
     def format_current_service(self):
+        import toml
+
         output_dict = {}
         if "service" in self.dict:
             service_name = self.dict["service"]
@@ -146,3 +168,21 @@ class ICortexConfig:
                 output_dict[service_name] = self.dict[service_name]
 
         return toml.dumps(output_dict)
+
+    def get_kernel_option(self, key: str, default=None):
+        """Get an option from the ``[kernel]`` table of the configuration"""
+        return self.dict.get("kernel", {}).get(key, default)
+
+    def get_packages_option(self, key: str, default=None):
+        """Get an option from the ``[packages]`` table of the configuration,
+        which configures how missing packages are installed
+        """
+        return self.dict.get("packages", {}).get(key, default)
+
+    def format_service_status(self, kernel) -> str:
+        import toml
+
+        status = {"state": kernel.service_state}
+        if kernel.service is not None:
+            status.update(kernel.service.get_status())
+        return toml.dumps({"status": status})
@@ -4,24 +4,25 @@ import os
 import typing as t
 import argparse
 from icortex.var import Var
-import importlib_metadata
 from abc import ABC, abstractclassmethod
 from copy import deepcopy
 import platform
-from icortex.defaults import DEFAULT_CONTEXT_VAR
+import tempfile
+import textwrap
+from icortex.defaults import DEFAULT_CONTEXT_VAR, DEFAULT_HISTORY_JOURNAL_PREFIX
 from icortex.services.service_interaction import ServiceInteraction
-from IPython.core.interactiveshell import ExecutionResult, ExecutionInfo
+
+if t.TYPE_CHECKING:
+    from IPython.core.interactiveshell import ExecutionResult
 
 from icortex.helper import (
     comment_out,
     unescape_quotes,
+    get_version,
     serialize_execution_result,
-    deserialize_execution_result,
     is_magic,
 )
 
-icortex_version = importlib_metadata.version("icortex")
-
 EMPTY_CONTEXT = {
     "metadata": {
         "kernelspec": {
@@ -37,7 +38,6 @@ EMPTY_CONTEXT = {
             "name": "icortex",
             "nbconvert_exporter": "python",
             "pygments_lexer": "ipython3",
-            "version": icortex_version,
             "python_version": platform.python_version(),
         },
     },
@@ -48,8 +48,22 @@ EMPTY_CONTEXT = {
 
 
 class Cell(ABC):
-    def __init__(self, execution_result: ExecutionResult = None):
-        self.execution_result = execution_result
+    """A cell in the notebook history.
+
+    The execution result is stored as a serialized snapshot, see
+    :func:`icortex.helper.serialize_execution_result`. Keeping the live
+    :class:`ExecutionResult` would keep the return value of the cell and
+    the frames of any exception alive for as long as the history exists.
+
+    Args:
+        execution_result (Union[ExecutionResult, Dict], optional): Result of
+            running the cell, or a snapshot of it.
+    """
+
+    def __init__(self, execution_result: t.Union["ExecutionResult", t.Dict] = None):
+        if execution_result is not None and not isinstance(execution_result, dict):
+            execution_result = serialize_execution_result(execution_result)
+        self.execution_result: t.Optional[t.Dict[str, t.Any]] = execution_result
 
     @abstractclassmethod
     def get_code(self) -> str:
@@ -63,7 +77,7 @@ class Cell(ABC):
     def success(self) -> bool:
         if self.execution_result is None:
             return False
-        return self.execution_result.success
+        return self.execution_result["success"]
 
 
 class CodeCell(Cell):
@@ -71,7 +85,7 @@ class CodeCell(Cell):
         self,
         code: str,
         outputs: t.List[t.Any],
-        execution_result: ExecutionResult = None,
+        execution_result: "ExecutionResult" = None,
     ):
         self.code = code
         self.outputs = outputs
@@ -88,9 +102,7 @@ class CodeCell(Cell):
             "outputs": self.outputs,
         }
         if self.execution_result:
-            ret["metadata"]["execution_result"] = serialize_execution_result(
-                self.execution_result
-            )
+            ret["metadata"]["execution_result"] = self.execution_result
 
         return ret
 
@@ -98,9 +110,7 @@ class CodeCell(Cell):
         return CodeCell(
             d["source"],
             d["outputs"],
-            execution_result=deserialize_execution_result(
-                d["metadata"]["execution_result"]
-            ),
+            execution_result=d["metadata"].get("execution_result"),
         )
 
     def get_code(self) -> str:
@@ -113,7 +123,7 @@ class PromptCell(Cell):
         prompt: str,
         outputs: t.List[t.Any],
         service_interaction: ServiceInteraction,
-        execution_result: ExecutionResult = None,
+        execution_result: "ExecutionResult" = None,
     ):
         self.prompt = prompt
         self.outputs = outputs
@@ -134,9 +144,7 @@ class PromptCell(Cell):
             "outputs": self.outputs,
         }
         if self.execution_result:
-            ret["metadata"]["execution_result"] = serialize_execution_result(
-                self.execution_result
-            )
+            ret["metadata"]["execution_result"] = self.execution_result
         return ret
 
     def from_dict(d: t.Dict[str, t.Any]):
@@ -144,7 +152,7 @@ class PromptCell(Cell):
             d["source"],
             d["outputs"],
             ServiceInteraction.from_dict(d["metadata"]["service"]),
-            deserialize_execution_result(d["metadata"]["execution_result"]),
+            d["metadata"].get("execution_result"),
         )
 
     def get_code(self) -> str:
@@ -165,7 +173,7 @@ class VarCell(Cell):
         var: Var,
         code: str,
         outputs: t.List[t.Any],
-        execution_result: ExecutionResult = None,
+        execution_result: "ExecutionResult" = None,
     ):
         self.var_line = var_line
         self.var = var
@@ -185,9 +193,7 @@ class VarCell(Cell):
             "outputs": self.outputs,
         }
         if self.execution_result:
-            ret["metadata"]["execution_result"] = serialize_execution_result(
-                self.execution_result
-            )
+            ret["metadata"]["execution_result"] = self.execution_result
 
         return ret
 
@@ -197,7 +203,7 @@ class VarCell(Cell):
             Var.from_dict(d["metadata"]["var"]),
             d["metadata"]["code"],
             d["outputs"],
-            deserialize_execution_result(d["metadata"]["execution_result"]),
+            d["metadata"].get("execution_result"),
         )
 
     def get_code(self):
@@ -210,10 +216,33 @@ class ICortexContext:
     The constructed dict maps to JSON, and the schema is compatible
     with the
     `Jupyter notebook format <https://nbformat.readthedocs.io/en/latest/format_description.html>`__:
+
+    Only the most recent ``window`` cells are kept in memory. Older cells
+    are appended to a journal file on disk, in the order they were run.
+    :func:`to_dict`, :func:`iter_cells` and :func:`save_to_file` cover
+    both the journal and the cells in memory.
+
+    Args:
+        scope (Dict[str, Any], optional): Namespace to register the context in.
+        window (int, optional): Number of cells to keep in memory. 0 keeps
+            every cell in memory. Defaults to 0.
+        journal_path (str, optional): Path of the journal that older cells
+            are written to. Defaults to a new file in the temporary directory
+            of the system, which is created when the first cell is spilled.
     """
 
-    def __init__(self, scope: t.Dict[str, t.Any] = None):
+    def __init__(
+        self,
+        scope: t.Dict[str, t.Any] = None,
+        window: int = 0,
+        journal_path: str = None,
+    ):
         self.scope = scope
+        self.window = window
+        self.journal_path = journal_path
+        # Whether the journal is a temporary file created by the context
+        self._temp_journal = False
+        self._spilled = 0
         self._cells = []
         self._vars = []
         self._check_init()
@@ -229,15 +258,69 @@ class ICortexContext:
 
         # self._dict = self.scope[DEFAULT_CONTEXT_VAR]
 
-    def to_dict(self, omit_last_cell=False):
+    def _append_cell(self, cell: Cell):
+        self._cells.append(cell)
+        if self.window <= 0 or len(self._cells) <= self.window:
+            return
+
+        # Move the oldest cells to the journal
+        spill = self._cells[: -self.window]
+        del self._cells[: -self.window]
+        if self.journal_path is None:
+            # A unique name, so that sessions never share a journal
+            fd, self.journal_path = tempfile.mkstemp(
+                prefix=DEFAULT_HISTORY_JOURNAL_PREFIX, suffix=".jsonl"
+            )
+            os.close(fd)
+            self._temp_journal = True
+        # Start a new journal on the first spill, in case a stale one exists
+        with open(self.journal_path, "a" if self._spilled > 0 else "w") as f:
+            for old_cell in spill:
+                f.write(json.dumps(old_cell.to_dict()) + "\n")
+        self._spilled += len(spill)
+
+    def _iter_cell_dicts(self, recent_only=False) -> t.Iterator[t.Dict[str, t.Any]]:
+        if self._spilled > 0 and not recent_only:
+            with open(self.journal_path, "r") as f:
+                for line in f:
+                    yield json.loads(line)
+        for cell in self._cells:
+            yield cell.to_dict()
+
+    def __len__(self):
+        return self._spilled + len(self._cells)
+
+    def close(self):
+        """Delete the journal. Cells that were spilled to it are lost."""
+        if self._spilled > 0 and os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+        self._spilled = 0
+        if self._temp_journal:
+            self.journal_path = None
+            self._temp_journal = False
+
+    def _get_metadata(self) -> t.Dict[str, t.Any]:
         ret = deepcopy(EMPTY_CONTEXT)
-        # ret = deepcopy(self._dict)
-        # Serialize cells and add to the return value
-        cells = [cell.to_dict() for cell in self._cells]
-        ret.update({"cells": cells})
+        del ret["cells"]
+        ret["metadata"]["language_info"]["version"] = get_version()
         # Serialize vars and add to the return value
         vars = [var.to_dict() for var in self._vars]
         ret["metadata"].update({"variables": vars})
+        return ret
+
+    def to_dict(self, omit_last_cell=False, recent_only=False):
+        """Serialize the context in the Jupyter notebook format.
+
+        Args:
+            omit_last_cell (bool, optional): Leave out the last cell.
+            recent_only (bool, optional): Only include the cells that are
+                kept in memory, without reading the journal. Use this to
+                build the context of a prompt cheaply.
+        """
+        ret = self._get_metadata()
+        # Serialize cells and add to the return value
+        cells = list(self._iter_cell_dicts(recent_only=recent_only))
+        ret.update({"cells": cells})
 
         if omit_last_cell:
             if len(ret["cells"]) > 0:
@@ -256,25 +339,35 @@ class ICortexContext:
     def add_code_cell(self, *args, **kwargs):
         self._check_init()
         cell = CodeCell(*args, **kwargs)
-        self._cells.append(cell)
+        self._append_cell(cell)
         return cell
 
     def add_var_cell(self, *args, **kwargs):
         self._check_init()
         cell = VarCell(*args, **kwargs)
-        self._cells.append(cell)
+        self._append_cell(cell)
         return cell
 
     def add_prompt_cell(self, *args, **kwargs):
         self._check_init()
         cell = PromptCell(*args, **kwargs)
-        self._cells.append(cell)
+        self._append_cell(cell)
         return cell
 
     def save_to_file(self, path: str):
         self._check_init()
+        # Write cells one by one, including the ones in the journal, so that
+        # the whole notebook never has to be held in memory at once
         with open(path, "w") as f:
-            json.dump(self.to_dict(), f, indent=2)
+            f.write("{")
+            for key, value in self._get_metadata().items():
+                value_json = textwrap.indent(json.dumps(value, indent=2), "  ")
+                f.write(f"\n  {json.dumps(key)}: {value_json.lstrip()},")
+            f.write('\n  "cells": [')
+            for i, cell_dict in enumerate(self._iter_cell_dicts()):
+                f.write("," if i > 0 else "")
+                f.write("\n" + textwrap.indent(json.dumps(cell_dict, indent=2), "    "))
+            f.write("\n  ]\n}\n")
 
         print("Exported to", path)
 
@@ -292,17 +385,7 @@ class ICortexContext:
         ret = ICortexContext(scope=scope)
 
         for cell_dict in context_dict["cells"]:
-            if cell_dict["metadata"]["source_type"] == "code":
-                cell = CodeCell.from_dict(cell_dict)
-            elif cell_dict["metadata"]["source_type"] == "var":
-                cell = VarCell.from_dict(cell_dict)
-            elif cell_dict["metadata"]["source_type"] == "prompt":
-                cell = PromptCell.from_dict(cell_dict)
-            else:
-                raise ValueError(
-                    f"Unknown cell type {cell_dict['metadata']['source_type']}"
-                )
-            ret._cells.append(cell)
+            ret._cells.append(cell_from_dict(cell_dict))
 
         ret._vars = [Var.from_dict(v) for v in context_dict["metadata"]["variables"]]
 
@@ -314,16 +397,35 @@ class ICortexContext:
         return self._vars
 
     def iter_cells(self) -> t.Iterator[Cell]:
+        # Cells in the journal are deserialized one at a time
+        if self._spilled > 0:
+            with open(self.journal_path, "r") as f:
+                for line in f:
+                    yield cell_from_dict(json.loads(line))
         for cell in self._cells:
             yield cell
 
-    def run(self, notebook_args: t.List[str]):
-        """Run the notebook with the given arguments"""
+    def run(self, notebook_args: t.List[str], jobs: int = 1, cache_path: str = None):
+        """Run the notebook with the given arguments
+
+        Args:
+            notebook_args (List[str]): Values of the notebook variables.
+            jobs (int, optional): Maximum number of cells to run at the same
+                time. With more than 1, cells that do not depend on each
+                other run in parallel threads, see
+                :func:`icortex.dependency.run_in_parallel`. Defaults to 1.
+            cache_path (str, optional): Directory of a
+                :class:`icortex.cell_cache.CellCache`. If given, cells whose
+                code and upstream cells did not change since the last run
+                are loaded from the cache instead of being executed.
+                Defaults to None.
+        """
 
         vars = self.vars
         parsed_args = get_notebook_arg_parser(vars).parse_args(notebook_args)
         scope = locals()
 
+        codes = []
         for cell in self.iter_cells():
             if cell.success:
                 if isinstance(cell, VarCell):
@@ -333,8 +435,29 @@ class ICortexContext:
                     code = var.get_code()
                 else:
                     code = cell.get_code()
-                # Execute the returned code
-                exec(code, scope)
+                codes.append(code)
+
+        if cache_path is not None:
+            from icortex.cell_cache import CellCache
+            from icortex.dependency import run_graph
+
+            run_cell, graph = CellCache(cache_path).prepare(codes, scope)
+            if jobs > 1:
+                run_graph(graph, run_cell, jobs)
+            else:
+                for idx in range(len(codes)):
+                    run_cell(idx)
+            return
+
+        if jobs > 1:
+            from icortex.dependency import run_in_parallel
+
+            run_in_parallel(codes, scope, jobs)
+            return
+
+        for code in codes:
+            # Execute the returned code
+            exec(code, scope)
 
     def get_code(self, argparsify=False):
         """Aggregates the code for the notebook"""
@@ -403,6 +526,17 @@ class ICortexContext:
         print("Baked to", dest_path)
 
 
+def cell_from_dict(cell_dict: t.Dict[str, t.Any]) -> Cell:
+    if cell_dict["metadata"]["source_type"] == "code":
+        return CodeCell.from_dict(cell_dict)
+    elif cell_dict["metadata"]["source_type"] == "var":
+        return VarCell.from_dict(cell_dict)
+    elif cell_dict["metadata"]["source_type"] == "prompt":
+        return PromptCell.from_dict(cell_dict)
+    else:
+        raise ValueError(f"Unknown cell type {cell_dict['metadata']['source_type']}")
+
+
 def get_notebook_arg_parser(vars: t.List[Var]):
     parser = argparse.ArgumentParser(add_help=False)
     for var in vars:
@@ -1,4 +1,6 @@
 # Default parameters
+import os
+
 DEFAULT_ICORTEX_CONFIG_PATH = "icortex.toml"
 DEFAULT_CACHE_PATH = "cache.json"
 DEFAULT_REGENERATE = False
@@ -7,3 +9,15 @@ DEFAULT_AUTO_EXECUTE = False
 DEFAULT_QUIET = False
 DEFAULT_SERVICE = "textcortex"
 DEFAULT_CONTEXT_VAR = "_icortex_context"
+DEFAULT_OUTPUT_LIMIT = 1024 * 1024
+DEFAULT_HISTORY_WINDOW = 1000
+DEFAULT_HISTORY_JOURNAL_PREFIX = "icortex_history_"
+DEFAULT_SERVER_HOST = "127.0.0.1"
+DEFAULT_SERVER_PORT = 8765
+DEFAULT_USER_CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "icortex"
+)
+DEFAULT_MODULE_INDEX_PATH = os.path.join(DEFAULT_USER_CACHE_DIR, "module_index.json")
+DEFAULT_WHEELHOUSE_PATH = os.path.join(DEFAULT_USER_CACHE_DIR, "wheels")
+DEFAULT_CELL_CACHE_PATH = os.path.join(DEFAULT_USER_CACHE_DIR, "cells")
+DEFAULT_CELL_CACHE_MAX_SIZE = 2**30
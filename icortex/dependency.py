@@ -0,0 +1,680 @@
+import ast
+import builtins
+import typing as t
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# Calls that can read or write any name, so that the names a cell depends
+# on cannot be read from its code
+OPAQUE_CALLS = {
+    "exec",
+    "eval",
+    "globals",
+    "locals",
+    "vars",
+    "__import__",
+    "setattr",
+    "delattr",
+}
+
+# Builtins that do not mutate the objects passed to them. Arguments of any
+# other call are assumed to be mutated
+PURE_BUILTINS = set(dir(builtins)) - OPAQUE_CALLS - {"next", "anext"}
+
+# Methods that return parts of the object they are called on, e.g.
+# d.items(), rather than new objects
+VIEW_METHODS = {"items", "values", "keys", "get", "setdefault"}
+
+# Pseudo-name that cells read or write when they call a function that may
+# read or write files, e.g. open() or df.to_csv(), so that cells that read
+# a file wait for the cells that may have written it
+FILES = "<files>"
+
+# Prefixes of the names of functions and methods that read or write files,
+# and names with those prefixes that work on strings instead
+FILE_READ_PREFIXES = ("read", "load")
+FILE_WRITE_PREFIXES = (
+    "write",
+    "save",
+    "dump",
+    "to_csv",
+    "to_excel",
+    "to_feather",
+    "to_hdf",
+    "to_json",
+    "to_parquet",
+    "to_pickle",
+)
+STRING_FUNCTIONS = {"loads", "dumps"}
+
+
+class CellDependencies:
+    """Names that the code of a cell reads and writes in the global scope.
+
+    A cell that mutates an object, e.g. through ``x["key"] = 1``, writes
+    the name ``x`` as well. So does a cell that passes ``x`` to a function
+    other than a builtin, e.g. ``random.shuffle(x)``, since the function
+    may mutate it. Objects that methods are called on, e.g. ``x`` in
+    ``x.append(1)`` or ``plt`` in ``plt.plot()``, are kept in
+    :attr:`method_targets`, and the names of the methods in
+    :attr:`called_methods`. Names that the cell binds itself, e.g. by
+    assignments, imports and definitions, are kept in :attr:`binds`, and
+    names that are bound by imports are mapped to the imported modules in
+    :attr:`imports`.
+
+    Names that the cell binds to objects that may be part of other objects,
+    e.g. ``b`` in ``b = a``, ``b = a[0]`` or ``for b in a``, are mapped to
+    the names of those objects in :attr:`aliases`. Mutating ``b`` counts as
+    writing ``a`` as well.
+
+    For each function, lambda and class that the cell defines, what its body
+    reads and writes is kept in :attr:`function_effects`, so that it can be
+    attributed to the cells that call it. The effects of the methods of
+    classes are kept under ``"." + method_name`` as well, and are attributed
+    to the cells that call a method of that name on any object.
+    """
+
+    def __init__(
+        self,
+        reads: t.Set[str],
+        writes: t.Set[str],
+        method_targets: t.Set[str] = None,
+        imports: t.Dict[str, str] = None,
+        function_effects: t.Dict[str, "CellDependencies"] = None,
+        called_methods: t.Set[str] = None,
+        binds: t.Set[str] = None,
+        aliases: t.Dict[str, t.Set[str]] = None,
+    ):
+        self.reads = reads
+        self.writes = writes
+        self.method_targets = method_targets if method_targets is not None else set()
+        self.imports = imports if imports is not None else {}
+        self.function_effects = function_effects if function_effects is not None else {}
+        self.called_methods = called_methods if called_methods is not None else set()
+        self.binds = binds if binds is not None else set()
+        self.aliases = aliases if aliases is not None else {}
+
+    def merge(self, other: "CellDependencies") -> "CellDependencies":
+        """Combine what two pieces of code read and write."""
+        return CellDependencies(
+            self.reads | other.reads,
+            self.writes | other.writes,
+            method_targets=self.method_targets | other.method_targets,
+            called_methods=self.called_methods | other.called_methods,
+        )
+
+
+class _Unclear(Exception):
+    pass
+
+
+def _root_name(node: ast.AST) -> t.Optional[str]:
+    # x.a.b[0] -> x
+    while isinstance(node, (ast.Attribute, ast.Subscript, ast.Starred)):
+        node = node.value
+    if isinstance(node, ast.Name):
+        return node.id
+    return None
+
+
+def _target_names(node: ast.AST) -> t.Set[str]:
+    # a, (b.c, *d) = ... -> {a, b, d}
+    if isinstance(node, (ast.Tuple, ast.List)):
+        return set().union(*(_target_names(elt) for elt in node.elts))
+    name = _root_name(node)
+    return {name} if name is not None else set()
+
+
+def _source_names(node: ast.AST) -> t.Set[str]:
+    # Names of the objects that the value of an expression may be part of,
+    # e.g. a in a, a[0], (a, b), enumerate(a) or a.values()
+    if isinstance(node, (ast.Tuple, ast.List, ast.Set)):
+        return set().union(*(_source_names(elt) for elt in node.elts))
+    if isinstance(node, ast.Call):
+        if isinstance(node.func, ast.Name) and node.func.id in PURE_BUILTINS:
+            args = node.args + [keyword.value for keyword in node.keywords]
+            return set().union(*(_source_names(arg) for arg in args))
+        if isinstance(node.func, ast.Attribute) and node.func.attr in VIEW_METHODS:
+            return _source_names(node.func.value)
+        return set()
+    name = _root_name(node)
+    return {name} if name is not None else set()
+
+
+def _file_access(node: ast.Call) -> t.Optional[str]:
+    # "read" or "write" if a call may access files
+    if isinstance(node.func, ast.Name):
+        name = node.func.id
+    elif isinstance(node.func, ast.Attribute):
+        name = node.func.attr
+    else:
+        return None
+
+    if name == "open":
+        mode = node.args[1] if len(node.args) > 1 else None
+        for keyword in node.keywords:
+            if keyword.arg == "mode":
+                mode = keyword.value
+        if mode is None or (
+            isinstance(mode, ast.Constant)
+            and isinstance(mode.value, str)
+            and not set(mode.value) & set("wax+")
+        ):
+            return "read"
+        return "write"
+    if name in STRING_FUNCTIONS:
+        return None
+    if name.startswith(FILE_READ_PREFIXES):
+        return "read"
+    if name.startswith(FILE_WRITE_PREFIXES):
+        return "write"
+    return None
+
+
+def _is_special_method(key: str) -> bool:
+    # Special methods such as .__getitem__ are called implicitly
+    return key.startswith(".__") and key.endswith("__")
+
+
+class _DependencyVisitor(ast.NodeVisitor):
+    def __init__(self):
+        self.reads = set()
+        self.writes = set()
+        self.method_targets = set()
+        self.called_methods = set()
+        self.binds = set()
+        self.imports = {}
+        self.function_effects = {}
+        # Names that may refer to parts of other objects, in any scope
+        self.aliases: t.Dict[str, t.Set[str]] = {}
+        # Names bound at the top level of the cell. Inside function bodies,
+        # bound names are local
+        self._depth = 0
+        # Effects of the lambdas in the value of a top-level assignment, and
+        # the lambda that is assigned directly, e.g. g = lambda: x
+        self._lambdas: t.Optional[t.List[CellDependencies]] = None
+        self._assigned_lambda = None
+
+    def _add_function_effects(self, name: str, effects: CellDependencies):
+        if name in self.function_effects:
+            effects = self.function_effects[name].merge(effects)
+        self.function_effects[name] = effects
+
+    def _collect_effects(self, node: ast.AST, body: t.List[ast.AST]):
+        # Visit code that only runs when it is called, separately from the
+        # code that runs now
+        saved = self.reads, self.writes, self.method_targets, self.called_methods
+        self.reads, self.writes = set(), set()
+        self.method_targets, self.called_methods = set(), set()
+        self._visit_scope(node, body)
+        effects = CellDependencies(
+            self.reads,
+            self.writes,
+            method_targets=self.method_targets,
+            called_methods=self.called_methods,
+        )
+        self.reads, self.writes, self.method_targets, self.called_methods = saved
+        return effects
+
+    def _bind(self, name: str):
+        if self._depth == 0:
+            self.writes.add(name)
+            self.binds.add(name)
+
+    def _with_aliases(self, name: str) -> t.Set[str]:
+        return {name} | self.aliases.get(name, set())
+
+    def _add_aliases(self, targets: t.List[ast.AST], value: ast.AST):
+        sources = set()
+        for name in _source_names(value):
+            sources |= self._with_aliases(name)
+        for target in targets:
+            for name in _target_names(target):
+                aliases = self.aliases.get(name, set()) | sources
+                aliases.discard(name)
+                if aliases:
+                    self.aliases[name] = aliases
+
+    def visit_Name(self, node: ast.Name):
+        if isinstance(node.ctx, ast.Load):
+            self.reads.add(node.id)
+        else:
+            self._bind(node.id)
+
+    def _visit_mutation(self, target: ast.AST):
+        name = _root_name(target)
+        if name is not None:
+            self.reads.add(name)
+            self.writes |= self._with_aliases(name)
+
+    def visit_Attribute(self, node: ast.Attribute):
+        if not isinstance(node.ctx, ast.Load):
+            self._visit_mutation(node)
+        self.generic_visit(node)
+
+    def visit_Subscript(self, node: ast.Subscript):
+        if not isinstance(node.ctx, ast.Load):
+            self._visit_mutation(node)
+        self.generic_visit(node)
+
+    def visit_Call(self, node: ast.Call):
+        if isinstance(node.func, ast.Name) and node.func.id in OPAQUE_CALLS:
+            raise _Unclear()
+        # Methods may mutate the object they are called on
+        if isinstance(node.func, ast.Attribute):
+            name = _root_name(node.func.value)
+            if name is not None:
+                self.method_targets |= self._with_aliases(name)
+            self.called_methods.add(node.func.attr)
+        # Functions may mutate the objects that are passed to them
+        if not (isinstance(node.func, ast.Name) and node.func.id in PURE_BUILTINS):
+            for arg in node.args + [keyword.value for keyword in node.keywords]:
+                name = _root_name(arg)
+                if name is not None:
+                    self.writes |= self._with_aliases(name)
+        access = _file_access(node)
+        if access == "read":
+            self.reads.add(FILES)
+        elif access == "write":
+            self.writes.add(FILES)
+        self.generic_visit(node)
+
+    def _visit_assignment(self, targets: t.List[ast.AST], value: ast.AST):
+        if value is not None:
+            self._add_aliases(targets, value)
+        if self._depth > 0 or value is None:
+            if value is not None:
+                self.visit(value)
+            for target in targets:
+                self.visit(target)
+            return
+
+        # Lambdas that are stored in a name, e.g. in handlers = {"a": lambda:
+        # x}, can be called by the cells that read the name
+        self._lambdas = []
+        self._assigned_lambda = value
+        self.visit(value)
+        lambdas, self._lambdas, self._assigned_lambda = self._lambdas, None, None
+        for target in targets:
+            self.visit(target)
+            for name in _target_names(target):
+                for effects in lambdas:
+                    self._add_function_effects(name, effects)
+
+    def visit_Assign(self, node: ast.Assign):
+        self._visit_assignment(node.targets, node.value)
+
+    def visit_AnnAssign(self, node: ast.AnnAssign):
+        self.visit(node.annotation)
+        self._visit_assignment([node.target], node.value)
+
+    def visit_AugAssign(self, node: ast.AugAssign):
+        # x += 1 reads x as well
+        name = _root_name(node.target)
+        if name is not None:
+            self.reads.add(name)
+        self.generic_visit(node)
+
+    def _visit_loop(self, node):
+        # The target of a loop refers to the items of what it iterates over
+        self.visit(node.iter)
+        self._add_aliases([node.target], node.iter)
+        self.visit(node.target)
+        for child in getattr(node, "ifs", []) + getattr(node, "body", []):
+            self.visit(child)
+        for child in getattr(node, "orelse", []):
+            self.visit(child)
+
+    visit_For = _visit_loop
+    visit_AsyncFor = _visit_loop
+    visit_comprehension = _visit_loop
+
+    def visit_ExceptHandler(self, node: ast.ExceptHandler):
+        if node.name is not None:
+            self._bind(node.name)
+        self.generic_visit(node)
+
+    def _visit_capture_pattern(self, node):
+        # Names that are captured by patterns of match statements
+        for attr in ("name", "rest"):
+            name = getattr(node, attr, None)
+            if name is not None:
+                self._bind(name)
+        self.generic_visit(node)
+
+    visit_MatchAs = _visit_capture_pattern
+    visit_MatchStar = _visit_capture_pattern
+    visit_MatchMapping = _visit_capture_pattern
+
+    def visit_NamedExpr(self, node):
+        # Assignment expressions bind in the enclosing scope
+        self.writes.add(node.target.id)
+        self.visit(node.value)
+
+    def visit_Global(self, node: ast.Global):
+        raise _Unclear()
+
+    def visit_Nonlocal(self, node: ast.Nonlocal):
+        raise _Unclear()
+
+    def visit_Import(self, node: ast.Import):
+        for alias in node.names:
+            if alias.asname is not None:
+                name, module = alias.asname, alias.name
+            else:
+                name = module = alias.name.split(".")[0]
+            self._bind(name)
+            if self._depth == 0:
+                self.imports[name] = module
+
+    def visit_ImportFrom(self, node: ast.ImportFrom):
+        for alias in node.names:
+            if alias.name == "*":
+                raise _Unclear()
+            name = alias.asname or alias.name
+            self._bind(name)
+            if self._depth == 0:
+                self.imports[name] = (
+                    "." * node.level + f"{node.module or ''}.{alias.name}"
+                )
+
+    def _visit_scope(self, node: ast.AST, body: t.List[ast.AST]):
+        self._depth += 1
+        for child in body:
+            self.visit(child)
+        self._depth -= 1
+
+    def _visit_function(self, node):
+        for child in node.decorator_list + [node.args]:
+            self.visit(child)
+        if node.returns is not None:
+            self.visit(node.returns)
+        self._bind(node.name)
+
+        if self._depth > 0:
+            # Nested functions are part of what the outer function touches
+            self._visit_scope(node, node.body)
+            return
+
+        # The body only touches anything when the function is called, so it
+        # is kept track of separately from the cell
+        self.function_effects[node.name] = self._collect_effects(node, node.body)
+
+    visit_FunctionDef = _visit_function
+    visit_AsyncFunctionDef = _visit_function
+
+    def visit_Lambda(self, node: ast.Lambda):
+        self.visit(node.args)
+        if self._depth > 0 or self._lambdas is None:
+            # Lambdas that are not stored, e.g. sort keys, run right away
+            self._visit_scope(node, [node.body])
+            return
+
+        effects = self._collect_effects(node, [node.body])
+        self._lambdas.append(effects)
+        if node is not self._assigned_lambda:
+            # A lambda inside an expression may be called right away too
+            self.reads |= effects.reads
+            self.writes |= effects.writes
+            self.method_targets |= effects.method_targets
+            self.called_methods |= effects.called_methods
+
+    def visit_ClassDef(self, node: ast.ClassDef):
+        for child in node.decorator_list + node.bases + node.keywords:
+            self.visit(child)
+        self._bind(node.name)
+        if self._depth > 0:
+            self._visit_scope(node, node.body)
+            return
+
+        # The class body runs now, but its methods only run when they are
+        # called, either on an instance or, e.g. __init__, through the class
+        self._depth += 1
+        methods = CellDependencies(set(), set())
+        for child in node.body:
+            if not isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                self.visit(child)
+                continue
+            # Decorators and default values are evaluated now
+            for part in child.decorator_list + [child.args]:
+                self.visit(part)
+            effects = self._collect_effects(child, child.body)
+            self._add_function_effects("." + child.name, effects)
+            methods = methods.merge(effects)
+        self._depth -= 1
+        self.function_effects[node.name] = methods
+
+    def _visit_comprehension(self, node):
+        self._visit_scope(node, node.generators)
+        for child in ("elt", "key", "value"):
+            if hasattr(node, child):
+                self._visit_scope(node, [getattr(node, child)])
+
+    visit_ListComp = _visit_comprehension
+    visit_SetComp = _visit_comprehension
+    visit_GeneratorExp = _visit_comprehension
+    visit_DictComp = _visit_comprehension
+
+
+def get_cell_dependencies(code: str) -> t.Optional[CellDependencies]:
+    """Find the global names that code reads and writes.
+
+    Returns:
+        Optional[CellDependencies]: None if the dependencies of the code are
+        unclear, e.g. because it does not parse, uses a star import or
+        ``global``, or calls :func:`exec` or :func:`globals`.
+    """
+    try:
+        tree = ast.parse(code)
+    except (SyntaxError, ValueError):
+        return None
+
+    visitor = _DependencyVisitor()
+    try:
+        visitor.visit(tree)
+    except _Unclear:
+        return None
+    return CellDependencies(
+        visitor.reads,
+        visitor.writes,
+        method_targets=visitor.method_targets,
+        imports=visitor.imports,
+        function_effects=visitor.function_effects,
+        called_methods=visitor.called_methods,
+        binds=visitor.binds,
+        aliases={
+            name: sources
+            for name, sources in visitor.aliases.items()
+            if name in visitor.binds
+        },
+    )
+
+
+def apply_function_effects(
+    deps: CellDependencies,
+    function_effects: t.Dict[str, CellDependencies],
+) -> t.Tuple[t.Set[str], t.Set[str], t.Set[str]]:
+    """Add what the functions that a cell calls touch to what the cell
+    touches itself, including the functions that they call in turn. A cell
+    is assumed to call every function, lambda and class that it reads, and
+    the methods of the names it calls on objects. Special methods of
+    classes, e.g. ``__getitem__``, are assumed to be called by every cell.
+
+    Args:
+        deps (CellDependencies): Dependencies of the cell.
+        function_effects (Dict[str, CellDependencies]): Dependencies of the
+            bodies of the functions that are defined so far, by name.
+
+    Returns:
+        Tuple[Set[str], Set[str], Set[str]]: The reads, writes and method
+        targets.
+    """
+
+    def get_callees(effects: CellDependencies) -> t.List[str]:
+        return [name for name in effects.reads if name in function_effects] + [
+            "." + name
+            for name in effects.called_methods
+            if "." + name in function_effects
+        ]
+
+    reads, writes = set(deps.reads), set(deps.writes)
+    method_targets = set(deps.method_targets)
+    visited = set()
+    pending = get_callees(deps) + [
+        key for key in function_effects if _is_special_method(key)
+    ]
+    while pending:
+        name = pending.pop()
+        if name in visited:
+            continue
+        visited.add(name)
+        effects = function_effects[name]
+        reads |= effects.reads
+        writes |= effects.writes
+        method_targets |= effects.method_targets
+        pending += get_callees(effects)
+    return reads, writes, method_targets
+
+
+def build_dependency_graph(
+    cell_deps: t.List[t.Optional[CellDependencies]],
+) -> t.List[t.Set[int]]:
+    """Build a DAG of cells, in which a cell depends on the earlier cells
+    that write a name it reads, and on the earlier cells that read or write
+    a name it writes. Calling a method of an object, modules included,
+    counts as writing it. Mutating a name that an earlier cell bound to a
+    part of another object counts as writing that object as well, and
+    reading the name as reading it, see :attr:`CellDependencies.aliases`.
+    Calls that may read or write files count as reading or writing
+    :data:`FILES`. Cells whose dependencies are unclear (None) are
+    barriers: they depend on every earlier cell, and every later cell
+    depends on them.
+
+    Returns:
+        List[Set[int]]: Indices of the cells that each cell depends on.
+    """
+    graph = []
+    function_effects = {}
+    # Names that are currently bound to modules, and the modules
+    modules: t.Dict[str, str] = {}
+    # Names that may refer to parts of other objects. Kept across barriers,
+    # which do not change what the objects are
+    aliases: t.Dict[str, t.Set[str]] = {}
+
+    def with_aliases(names: t.Set[str]) -> t.Set[str]:
+        return names.union(*(aliases.get(name, set()) for name in names))
+
+    last_writer: t.Dict[str, int] = {}
+    # Cells that read a name since it was last written
+    readers: t.Dict[str, t.Set[int]] = {}
+    barrier = None
+    since_barrier = []
+
+    for idx, deps in enumerate(cell_deps):
+        if deps is None:
+            graph.append(set(since_barrier) | ({barrier} - {None}))
+            barrier = idx
+            since_barrier = []
+            last_writer, readers, modules = {}, {}, {}
+            continue
+
+        function_effects.update(deps.function_effects)
+        reads, writes, method_targets = apply_function_effects(deps, function_effects)
+        # Modules that the cell imports itself are not read from other cells
+        reads -= deps.imports.keys()
+
+        # Importing a module again does not change anything
+        writes -= {
+            name for name, module in deps.imports.items() if modules.get(name) == module
+        }
+        for name in deps.writes:
+            if name in deps.imports:
+                modules[name] = deps.imports[name]
+            else:
+                modules.pop(name, None)
+        # Methods may mutate the object, and functions of modules the state
+        # of the module, e.g. plt.plot() and plt.savefig()
+        writes |= method_targets
+
+        reads = with_aliases(reads)
+        writes = with_aliases(writes - deps.binds) | writes
+        for name in deps.binds:
+            if name in deps.aliases:
+                aliases[name] = with_aliases(deps.aliases[name]) - {name}
+            else:
+                aliases.pop(name, None)
+
+        preds = set() if barrier is None else {barrier}
+        for name in reads:
+            if name in last_writer:
+                preds.add(last_writer[name])
+        for name in writes:
+            if name in last_writer:
+                preds.add(last_writer[name])
+            preds |= readers.get(name, set())
+
+        for name in reads:
+            readers.setdefault(name, set()).add(idx)
+        for name in writes:
+            last_writer[name] = idx
+            readers[name] = set()
+
+        preds.discard(idx)
+        graph.append(preds)
+        since_barrier.append(idx)
+
+    return graph
+
+
+def run_graph(
+    graph: t.List[t.Set[int]], run_cell: t.Callable[[int], t.Any], jobs: int
+) -> None:
+    """Call ``run_cell`` with the index of every cell in a graph from
+    :func:`build_dependency_graph`, once the cells it depends on are done.
+    Cells that do not depend on each other run at the same time in up to
+    ``jobs`` threads.
+
+    If a cell raises an exception, no further cells are started, and the
+    exception of the earliest failing cell is raised once the running cells
+    have finished.
+    """
+    remaining = [set(preds) for preds in graph]
+    dependents: t.List[t.List[int]] = [[] for _ in graph]
+    for idx, preds in enumerate(graph):
+        for pred in preds:
+            dependents[pred].append(idx)
+
+    errors: t.Dict[int, BaseException] = {}
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        running = {
+            executor.submit(run_cell, idx): idx
+            for idx, preds in enumerate(remaining)
+            if len(preds) == 0
+        }
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                idx = running.pop(future)
+                if future.exception() is not None:
+                    errors[idx] = future.exception()
+                    continue
+                if errors:
+                    continue
+                for dependent in dependents[idx]:
+                    remaining[dependent].discard(idx)
+                    if len(remaining[dependent]) == 0:
+                        running[executor.submit(run_cell, dependent)] = dependent
+
+    if errors:
+        raise errors[min(errors)]
+
+
+def run_in_parallel(codes: t.List[str], scope: t.Dict[str, t.Any], jobs: int) -> None:
+    """Execute code cells in ``scope``, running cells that do not depend on
+    each other at the same time in up to ``jobs`` threads, see
+    :func:`run_graph`. All cells share the scope, so the names they define
+    are visible to the cells that run after them. Side effects that are not
+    visible in the code are not taken into account, apart from calls that
+    look like they read or write files, see :data:`FILES`.
+    """
+    graph = build_dependency_graph([get_cell_dependencies(code) for code in codes])
+    run_graph(graph, lambda idx: exec(codes[idx], scope), jobs)
@@ -1,9 +1,11 @@
+import reprlib
+import sys
 import traceback
-from pygments import highlight
-from pygments.formatters import Terminal256Formatter
-from pygments.lexers import PythonLexer
+import typing as t
+from functools import lru_cache
 
-from IPython.core.interactiveshell import ExecutionResult, ExecutionInfo
+if t.TYPE_CHECKING:
+    from IPython.core.interactiveshell import ExecutionResult
 
 
 def unescape(s) -> str:
@@ -69,7 +71,19 @@ def prompt_input(message: str, type=str, default=None, press_enter=False):
         return type(user_input)
 
 
+@lru_cache(maxsize=None)
+def get_version() -> str:
+    """Version of the installed icortex package."""
+    import importlib_metadata
+
+    return importlib_metadata.version("icortex")
+
+
 def highlight_python(code: str):
+    from pygments import highlight
+    from pygments.formatters import Terminal256Formatter
+    from pygments.lexers import PythonLexer
+
     return highlight(code, PythonLexer(), Terminal256Formatter())
 
 
@@ -82,14 +96,36 @@ def serialize_exception(exception):
         # This raises errors for certain exceptions.
         # Can't consider every edge case now, let's hope
         # "message" will contain enough information
-        ret["traceback"] = traceback.format_exc(exception)
+        ret["traceback"] = "".join(
+            traceback.format_exception(
+                type(exception), exception, exception.__traceback__
+            )
+        )
     except:
         pass
 
     return ret
 
 
-def serialize_execution_result(execution_result: ExecutionResult):
+def truncated_repr(obj, limit: int = 1000) -> str:
+    """Return the repr of an object, shortened to at most ``limit``
+    characters. Containers are abbreviated before their repr is built, so
+    this stays cheap for large lists and dicts.
+    """
+    r = reprlib.Repr()
+    r.maxstring = r.maxother = r.maxlong = limit
+    ret = r.repr(obj)
+    if len(ret) > limit:
+        ret = ret[: limit - 3] + "..."
+    return ret
+
+
+def serialize_execution_result(execution_result: "ExecutionResult", repr_limit=1000):
+    """Serialize an execution result into a JSON compatible snapshot that
+    holds no references to the result or to the frames of an exception.
+    The result itself is stored as a repr of at most ``repr_limit``
+    characters.
+    """
     ret = {}
     if execution_result.error_before_exec is not None:
         ret["error_before_exec"] = serialize_exception(
@@ -99,12 +135,14 @@ def serialize_execution_result(execution_result: ExecutionResult):
         ret["error_in_exec"] = serialize_exception(execution_result.error_in_exec)
     if execution_result.result is not None:
         # TODO: Are we ever going to need deeper serialization?
-        ret["result"] = str(execution_result.result)
+        ret["result"] = truncated_repr(execution_result.result, limit=repr_limit)
     ret["success"] = execution_result.success
     return ret
 
 
 def deserialize_execution_result(execution_result: dict):
+    from IPython.core.interactiveshell import ExecutionResult, ExecutionInfo
+
     # TODO: Deserialize the execution result and info better
     ret = ExecutionResult(ExecutionInfo("", False, None, None, None))
 
@@ -147,3 +185,41 @@ def comment_out(input: str) -> str:
     ret = "# " + input
     ret = ret.replace("\n", "\n# ")
     return ret
+
+
+def get_rss() -> int:
+    """Get the resident set size of the current process in bytes.
+
+    Falls back to the peak resident set size on platforms without procfs.
+    """
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    import resource
+
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def get_pss() -> t.Optional[int]:
+    """Get the proportional set size of the current process in bytes, where
+    memory shared with other processes, such as memory-mapped model weights,
+    is divided evenly between them. Summing it over processes gives their
+    actual memory footprint.
+
+    Returns None on platforms without ``/proc/self/smaps_rollup``.
+    """
+    try:
+        with open("/proc/self/smaps_rollup", "r") as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
@@ -2,13 +2,15 @@
 # https://jupyter-client.readthedocs.io/en/latest/wrapperkernels.html
 # https://github.com/jupyter/jupyter/wiki/Jupyter-kernels
 
+import atexit
 import sys
+import threading
 import types
 import typing as t
 from enum import Enum
 from logging import warning
 from icortex.config import ICortexConfig
-from icortex.cli import eval_cli
+from icortex.capture import capture_streams
 from icortex.context import ICortexContext
 
 from ipykernel.ipkernel import IPythonKernel
@@ -17,15 +19,13 @@ from IPython.core.interactiveshell import ExecutionResult, ExecutionInfo
 
 from icortex.helper import (
     escape_quotes,
+    get_version,
     is_icortex_magic,
 )
 from icortex.services import get_available_services
-from icortex.services.service_base import ServiceBase
+from icortex.services.service_base import GenerationCancelled, ServiceBase
 from icortex.defaults import *
 from icortex.var import Var
-import importlib_metadata
-
-__version__ = importlib_metadata.version("icortex")
 
 INIT_SERVICE_MSG = (
     r"No service selected. Run `%icortex service init <service_name>` to initialize a service. Candidates: "
@@ -41,22 +41,22 @@ class InputType(Enum):
     VAR = 2
 
 
-def stream_to_list(stream_str: str) -> t.List[str]:
-    ret = []
-    for line in stream_str.splitlines():
-        # The extra newline is to adhere to nbformat
-        ret.append(line + "\n")
-    return ret
-
-
 class ICortexShell(InteractiveShell):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
     def _init_icortex_shell(self):
         self.service = None
+        self.service_state = "not loaded"
+        self._warmup_thread = None
+        conf = ICortexConfig(DEFAULT_ICORTEX_CONFIG_PATH)
+        self.output_limit = conf.get_kernel_option("output_limit", DEFAULT_OUTPUT_LIMIT)
         scope = self.user_ns
-        self.history = ICortexContext(scope)
+        self.history = ICortexContext(
+            scope,
+            window=conf.get_kernel_option("history_window", DEFAULT_HISTORY_WINDOW),
+        )
+        atexit.register(self.history.close)
         from icortex.magics import load_ipython_extension
 
         load_ipython_extension(self)
@@ -69,6 +69,7 @@ class ICortexShell(InteractiveShell):
         self.set_service = types.MethodType(ICortexShell.set_service, self)
         # self._run_dialog = types.MethodType(ICortexShell._run_dialog, self)
         self._check_service = types.MethodType(ICortexShell._check_service, self)
+        self.warmup_service = types.MethodType(ICortexShell.warmup_service, self)
         self.print_service_help = types.MethodType(
             ICortexShell.print_service_help, self
         )
@@ -81,10 +82,17 @@ class ICortexShell(InteractiveShell):
         self.bake = types.MethodType(ICortexShell.bake, self)
 
     def set_service(self, service: t.Type[ServiceBase]):
+        if self.service is not None and self.service is not service:
+            self.service.close()
         self.service = service
+        self.service_state = "loaded"
         return True
 
     def _check_service(self):
+        if self._warmup_thread is not None and self._warmup_thread.is_alive():
+            print("Waiting for the service to finish warming up...")
+            self._warmup_thread.join()
+
         if self.service is None:
             conf = ICortexConfig(DEFAULT_ICORTEX_CONFIG_PATH)
             conf.set_kernel(self)
@@ -93,6 +101,37 @@ class ICortexShell(InteractiveShell):
         else:
             return True
 
+    def warmup_service(self) -> bool:
+        """Load the configured service and run a dummy generation in a
+        background thread, if ``warmup = true`` is set in the ``[kernel]``
+        table of the configuration. The first prompt waits for the
+        warm-up to finish instead of loading the service itself.
+
+        Returns:
+            bool: True if the warm-up was started.
+        """
+        conf = ICortexConfig(DEFAULT_ICORTEX_CONFIG_PATH)
+        # Never warm up an unconfigured kernel, that would require a dialog
+        if not conf.get_kernel_option("warmup", False) or "service" not in conf.dict:
+            return False
+        conf.set_kernel(self)
+
+        def warmup():
+            try:
+                self.service_state = "loading"
+                conf.set_service()
+                self.service_state = "warming up"
+                self.service.warmup()
+                self.service_state = "ready"
+            except Exception as e:
+                self.service_state = f"warm-up failed: {e}"
+
+        self._warmup_thread = threading.Thread(
+            target=warmup, name="icortex-warmup", daemon=True
+        )
+        self._warmup_thread.start()
+        return True
+
     def print_service_help(self):
         if self._check_service():
             self.service.prompt_parser.print_help()
@@ -110,58 +149,54 @@ class ICortexShell(InteractiveShell):
         input_type=InputType.CODE,
     ):
 
-        # Execute generated code
-        stdout = ""
-        stderr = ""
-        # with capture_output() as io:
-        #     self.run_cell(
-        #         code,
-        #         store_history=False,
-        #         silent=False,
-        #         cell_id=self.execution_count,
-        #     )
-        #     stdout = io.stdout
-        #     stderr = io.stderr
-        #     # TODO: Make capture_output() forward streams and display outputs
-        #     # This doesn't cause a problem with ipython for some reason but only icortex
+        # Streams are shown as usual, and a copy of them is recorded for
+        # the history
+        captured = capture_streams(self.output_limit)
 
         is_icortex_magic_ = is_icortex_magic(raw_cell)
         result = ExecutionResult(ExecutionInfo("", None, None, None, None))
 
         # print("Called run_cell ", input_type)
         if input_type == InputType.CODE:
-
-            result = InteractiveShell.run_cell(
-                self,
-                raw_cell,
-                store_history=store_history,
-                silent=silent,
-                shell_futures=shell_futures,
-                cell_id=cell_id,
-            )
+            with captured:
+                result = InteractiveShell.run_cell(
+                    self,
+                    raw_cell,
+                    store_history=store_history,
+                    silent=silent,
+                    shell_futures=shell_futures,
+                    cell_id=cell_id,
+                )
         elif input_type == InputType.PROMPT:
-            service_interaction = self.service.eval_prompt(raw_cell, self.history)
+            try:
+                service_interaction = self.service.eval_prompt(raw_cell, self.history)
+            except GenerationCancelled:
+                # Leave no trace of the prompt in the history
+                print("Generation cancelled.")
+                return result
             code = service_interaction.get_code()
 
-            result = InteractiveShell.run_cell(
-                self,
-                code,
-                store_history=False,
-                silent=False,
-                cell_id=self.execution_count,
-            )
+            with captured:
+                result = InteractiveShell.run_cell(
+                    self,
+                    code,
+                    store_history=False,
+                    silent=False,
+                    cell_id=self.execution_count,
+                )
         elif input_type == InputType.VAR:
             # args = self.var_parser.parse_args(raw_cell.split())
             # code, arg_name, var_name, value = line_to_code(raw_cell)
             var = Var.from_var_magic(raw_cell)
             code = var.get_code()
-            result = InteractiveShell.run_cell(
-                self,
-                code,
-                store_history=False,
-                silent=False,
-                cell_id=self.execution_count,
-            )
+            with captured:
+                result = InteractiveShell.run_cell(
+                    self,
+                    code,
+                    store_history=False,
+                    silent=False,
+                    cell_id=self.execution_count,
+                )
             self.history.define_var(var)
 
         # Get the output from InteractiveShell.history_manager.
@@ -184,29 +219,9 @@ class ICortexShell(InteractiveShell):
         except:
             warning("There was an issue with saving execution output to history")
 
-        # If cell has an output stream, add it to the outputs
+        # If cell has output streams, add them to the outputs
         # TODO: Decide whether to include fields `execution_count`, `metadata`, etc.
-        if stdout != "":
-            outputs.append(
-                {
-                    "name": "stdout",
-                    "output_type": "stream",
-                    "data": {
-                        "text/plain": stream_to_list(stdout),
-                    },
-                }
-            )
-        # Same for stderr
-        if stderr != "":
-            outputs.append(
-                {
-                    "name": "stderr",
-                    "output_type": "stream",
-                    "data": {
-                        "text/plain": stream_to_list(stderr),
-                    },
-                }
-            )
+        outputs.extend(captured.outputs)
 
         if input_type == InputType.CODE and not is_icortex_magic_:
             self.history.add_code_cell(
@@ -241,6 +256,8 @@ class ICortexShell(InteractiveShell):
             print(INIT_SERVICE_MSG)
 
     def cli(self, input_: str):
+        from icortex.cli import eval_cli
+
         prompt = escape_quotes(input_)
         eval_cli(prompt)
 
@@ -273,7 +290,6 @@ class ICortexKernel(IPythonKernel):
     """
 
     implementation = "icortex"
-    implementation_version = __version__
     language_info = {
         "name": "python",
         "version": sys.version.split()[0],
@@ -286,10 +302,15 @@ class ICortexKernel(IPythonKernel):
     banner = "ICortex: Generate Python code from natural language prompts using large language models"
     shell: InteractiveShell
 
+    @property
+    def implementation_version(self) -> str:
+        return get_version()
+
     def __init__(self, **kwargs):
 
         super().__init__(**kwargs)
         ICortexShell._init_icortex_shell(self.shell)
+        self.shell.warmup_service()
 
 
 def get_icortex():
@@ -5,6 +5,8 @@ from jupyter_console.app import ZMQTerminalIPythonApp
 # TODO: Make less hacky
 class ZMQTerminalICortexApp(ZMQTerminalIPythonApp):
     def parse_command_line(self, argv=None):
-        argv = ["--kernel", "icortex"]
+        # Only arguments that are passed explicitly are meant for the app,
+        # sys.argv holds the arguments of the icortex CLI
+        argv = ["--kernel", "icortex"] + list(argv or [])
         super(ZMQTerminalIPythonApp, self).parse_command_line(argv)
         self.build_kernel_argv(self.extra_args)
@@ -3,16 +3,11 @@ import sys
 import json
 import shutil
 import argparse
-import pkg_resources
+import importlib.util
+from functools import lru_cache
 
-from IPython.utils.tempdir import TemporaryDirectory
-
-try:
-    from jupyter_client.kernelspec import KernelSpecManager
-
-    HAVE_JUPYTER = True
-except ImportError:
-    HAVE_JUPYTER = False
+# jupyter_client is slow to import, so only check that it is available
+HAVE_JUPYTER = importlib.util.find_spec("jupyter_client") is not None
 
 kernel_json = {
     "argv": [sys.executable, "-m", "icortex.kernel", "-f", "{connection_file}"],
@@ -35,6 +30,10 @@ def install_my_kernel_spec(user=True, prefix=None, uninstall=False):
         print("Could not install Jupyter kernel spec, please install jupyter_client")
         return
 
+    import pkg_resources
+    from IPython.utils.tempdir import TemporaryDirectory
+    from jupyter_client.kernelspec import KernelSpecManager
+
     ksm = KernelSpecManager()
     if not uninstall:
         with TemporaryDirectory() as td:
@@ -57,6 +56,8 @@ def install_my_kernel_spec(user=True, prefix=None, uninstall=False):
         except KeyError:
             print("ICortex kernel not installed, skipping.")
 
+    is_kernel_installed.cache_clear()
+
 
 def _is_root():
     try:
@@ -65,15 +66,20 @@ def _is_root():
         return False  # assume not an admin on non-Unix platforms
 
 
+@lru_cache(maxsize=None)
 def is_kernel_installed():
     if not HAVE_JUPYTER:
         print("Could not install Jupyter kernel spec, please install jupyter_client")
         return False
 
-    ksm = KernelSpecManager()
+    # Look for the spec in the directories that KernelSpecManager searches,
+    # instead of listing and validating every installed kernelspec
+    from jupyter_core.paths import jupyter_path
 
-    paths = ksm.find_kernel_specs()
-    return "icortex" in paths
+    return any(
+        os.path.isfile(os.path.join(kernel_dir, "icortex", "kernel.json"))
+        for kernel_dir in jupyter_path("kernels")
+    )
 
 
 def main(argv=None):
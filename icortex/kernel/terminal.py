@@ -0,0 +1,17 @@
+from IPython.terminal.interactiveshell import TerminalInteractiveShell
+
+from icortex.kernel import ICortexKernel, ICortexShell
+
+
+def launch_terminal_shell():
+    """Start an ICortex shell in the current process.
+
+    Cells run directly in a :class:`TerminalInteractiveShell`, without a
+    separate kernel process and the ZMQ messaging in between. Use
+    :class:`icortex.kernel.app.ZMQTerminalICortexApp` to connect to a
+    kernel that is already running instead.
+    """
+    shell = TerminalInteractiveShell.instance(banner1=ICortexKernel.banner + "\n")
+    ICortexShell._init_icortex_shell(shell)
+    shell.warmup_service()
+    shell.mainloop()
@@ -1,36 +1,225 @@
+import ast
+import json
+import os
 import re
+import shutil
+import subprocess
+import sys
+import threading
 import importlib
-import pip
+import importlib.util
 import typing as t
 
-# A dictionary of popular module names mapped to their corresponding PyPI packages.
-# TODO: replace this with something more streamlined
+from icortex.defaults import DEFAULT_MODULE_INDEX_PATH
+
+# Module names mapped to their PyPI packages. These take precedence over
+# the shipped mapping and the index of installed distributions.
 MODULES_TO_PACKAGES = {
-    "numpy": "numpy",
-    "scipy": "scipy",
-    "sklearn": "sklearn",
-    "matplotlib": "matplotlib",
-    "pandas": "pandas",
+    "sklearn": "scikit-learn",
     "ethereumetl": "ethereum-etl",
 }
 
+#: Compact mapping of popular modules to PyPI packages that ships with ICortex
+SHIPPED_MODULE_INDEX_PATH = os.path.join(
+    os.path.dirname(__file__), "data", "module_packages.json"
+)
+
+# Merged module index, loaded on first use
+_module_index: t.Dict[str, str] = None
+
+
+def get_distribution_modules(dist) -> t.List[str]:
+    """Get the top-level modules that a distribution provides, from its
+    ``top_level.txt`` or, if it has none, from the files in its ``RECORD``.
+    """
+    text = dist.read_text("top_level.txt")
+    if text:
+        return [line.strip() for line in text.splitlines() if line.strip()]
+
+    modules = []
+    for file in dist.files or []:
+        parts = file.parts
+        if len(parts) == 0 or parts[0] in ("..", "__pycache__"):
+            continue
+        top = parts[0]
+        if top.endswith((".dist-info", ".egg-info", ".data")):
+            continue
+        if len(parts) > 1:
+            # A package directory
+            modules.append(top)
+        elif top.endswith(".py"):
+            modules.append(top[: -len(".py")])
+        elif top.endswith((".so", ".pyd")):
+            # Extension modules, e.g. _foo.cpython-310-x86_64-linux-gnu.so
+            modules.append(top.split(".")[0])
+    return [module for module in dict.fromkeys(modules) if module.isidentifier()]
+
+
+def build_module_index() -> t.Dict[str, str]:
+    """Map the top-level modules of every installed distribution to the
+    name of the distribution.
+    """
+    import importlib_metadata
+
+    index = {}
+    for dist in importlib_metadata.distributions():
+        name = dist.metadata["Name"]
+        if not name:
+            continue
+        for module in get_distribution_modules(dist):
+            index.setdefault(module, name)
+    return index
+
+
+def refresh_module_index(path: str = DEFAULT_MODULE_INDEX_PATH) -> t.Dict[str, str]:
+    """Rebuild the index of installed distributions and store it in the
+    user cache, so that it is not rebuilt at every kernel start.
+
+    Returns:
+        Dict[str, str]: The new index.
+    """
+    global _module_index
+    index = build_module_index()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(index, f, indent=0, sort_keys=True)
+    os.replace(tmp_path, path)
+    _module_index = None
+    return index
+
+
+def get_module_index(path: str = DEFAULT_MODULE_INDEX_PATH) -> t.Dict[str, str]:
+    """Get the index that maps module names to PyPI packages. It merges the
+    shipped mapping, the cached index of installed distributions and
+    :data:`MODULES_TO_PACKAGES`, in increasing order of precedence. The
+    index of installed distributions is built on first use.
+    """
+    global _module_index
+    if _module_index is None:
+        with open(SHIPPED_MODULE_INDEX_PATH) as f:
+            index = json.load(f)
+        try:
+            with open(path) as f:
+                installed = json.load(f)
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            installed = refresh_module_index(path)
+        index.update(installed)
+        index.update(MODULES_TO_PACKAGES)
+        _module_index = index
+    return _module_index
+
 
 def module_to_pypi_package(module_name):
-    if module_name in MODULES_TO_PACKAGES:
-        return MODULES_TO_PACKAGES[module_name]
-    else:
-        return None
+    return get_module_index().get(module_name)
+
+
+#: Supported values for the ``installer`` argument of :func:`install_packages`
+INSTALLERS = ["auto", "pip", "uv"]
+
+# Memo of module availability, valid as long as the search path fingerprint
+# stays the same, see _get_search_path_fingerprint
+_module_exists_cache: t.Dict[str, bool] = {}
+_module_exists_cache_key = None
+
+# Exceptions that mark an import as optional when they are caught around it
+IMPORT_ERRORS = {"ImportError", "ModuleNotFoundError"}
+
+
+def _get_search_path_fingerprint() -> t.Tuple:
+    # Installing or removing a distribution adds or removes entries in a
+    # directory on sys.path, which changes its modification time
+    ret = []
+    for path in sys.path:
+        try:
+            ret.append((path, os.stat(path or ".").st_mtime_ns))
+        except OSError:
+            ret.append((path, None))
+    return tuple(ret)
+
+
+def clear_module_cache():
+    """Forget which modules were found, e.g. after installing packages."""
+    global _module_exists_cache_key
+    _module_exists_cache.clear()
+    _module_exists_cache_key = None
+    importlib.invalidate_caches()
 
 
 def module_exists(name):
-    spec = importlib.util.find_spec(name)
-    return spec is not None
+    global _module_exists_cache_key
+    key = _get_search_path_fingerprint()
+    if key != _module_exists_cache_key:
+        _module_exists_cache.clear()
+        _module_exists_cache_key = key
+
+    if name not in _module_exists_cache:
+        if name in sys.modules:
+            exists = True
+        else:
+            try:
+                exists = importlib.util.find_spec(name) is not None
+            except (ImportError, ValueError):
+                exists = False
+        _module_exists_cache[name] = exists
+    return _module_exists_cache[name]
+
+
+def _catches_import_error(handler: ast.ExceptHandler) -> bool:
+    if handler.type is None:
+        return True
+    types = handler.type.elts if isinstance(handler.type, ast.Tuple) else [handler.type]
+    return any(isinstance(t_, ast.Name) and t_.id in IMPORT_ERRORS for t_ in types)
 
 
-def get_imported_modules(code):
-    regex = re.compile(r"^\s*(?:from|import)\s+(\w+(?:\s*,\s*\w+)*)", re.MULTILINE)
-    modules = re.findall(regex, code)
-    return modules
+class _ImportVisitor(ast.NodeVisitor):
+    def __init__(self):
+        self.modules = []
+
+    def visit_Import(self, node: ast.Import):
+        for alias in node.names:
+            self.modules.append(alias.name.split(".")[0])
+
+    def visit_ImportFrom(self, node: ast.ImportFrom):
+        # Relative imports refer to local packages, not to installed ones
+        if node.level == 0 and node.module is not None:
+            self.modules.append(node.module.split(".")[0])
+
+    def visit_Try(self, node: ast.Try):
+        # Imports that are guarded by an ImportError handler are optional
+        if not any(_catches_import_error(handler) for handler in node.handlers):
+            for child in node.body:
+                self.visit(child)
+        for child in node.handlers + node.orelse + node.finalbody:
+            self.visit(child)
+
+
+def get_imported_modules(code: str) -> t.List[str]:
+    """Get the top-level modules that are imported in the code, in order of
+    appearance. Relative imports, ``__future__`` imports and imports in a
+    ``try`` block that handles :class:`ImportError` are left out.
+    """
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        # Generated code might not be valid Python, fall back to a regex
+        regex = re.compile(
+            r"^\s*(?:from\s+(\w+)|import\s+(\w+(?:\.\w+)*(?:\s+as\s+\w+)?(?:\s*,\s*\w+(?:\.\w+)*(?:\s+as\s+\w+)?)*))",
+            re.MULTILINE,
+        )
+        modules = []
+        for from_module, import_list in regex.findall(code):
+            if from_module:
+                modules.append(from_module)
+            else:
+                for name in import_list.split(","):
+                    modules.append(name.split()[0].split(".")[0])
+    else:
+        visitor = _ImportVisitor()
+        visitor.visit(tree)
+        modules = visitor.modules
+
+    return [module for module in dict.fromkeys(modules) if module != "__future__"]
 
 
 def get_missing_modules(code: str) -> t.List[str]:
@@ -39,20 +228,248 @@ def get_missing_modules(code: str) -> t.List[str]:
     missing_modules = [
         module for module in imported_modules if not module_exists(module)
     ]
-    return list(set(missing_modules))
+    return missing_modules
 
 
-def install_missing_packages(code):
-    missing_modules = get_missing_modules(code)
+def resolve_packages(modules: t.List[str]) -> t.Tuple[t.List[str], t.List[str]]:
+    """Map modules to the PyPI packages that provide them.
 
+    Returns:
+        Tuple[List[str], List[str]]: The packages, without duplicates, and
+        the modules that could not be mapped to any package.
+    """
+    packages = []
     unresolved_modules = []
-    for module in missing_modules:
+    for module in modules:
         package = module_to_pypi_package(module)
         if package is not None:
-            result = pip.main(["install", package])
-            if result != 0:
-                unresolved_modules.append(module)
+            packages.append(package)
         else:
             unresolved_modules.append(module)
+    return list(dict.fromkeys(packages)), unresolved_modules
+
+
+def get_install_command(
+    packages: t.List[str],
+    installer: str = "auto",
+    find_links: str = None,
+    no_index: bool = False,
+) -> t.List[str]:
+    """Command that installs packages into the environment of the running
+    interpreter.
+
+    Args:
+        packages (List[str]): Requirement specifiers of the packages.
+        installer (str, optional): ``"pip"``, ``"uv"``, or ``"auto"`` to
+            use uv if it is on the PATH and pip otherwise. Defaults to "auto".
+        find_links (str, optional): Directory to look for wheels in.
+        no_index (bool, optional): Only install from ``find_links``,
+            without contacting the package index. Defaults to False.
+    """
+    if installer not in INSTALLERS:
+        raise ValueError(
+            f"Unknown installer {installer}, choose one of: {', '.join(INSTALLERS)}"
+        )
+    uv = shutil.which("uv") if installer in ("auto", "uv") else None
+    if uv is not None:
+        command = [uv, "pip", "install", "--python", sys.executable]
+    elif installer == "uv":
+        raise FileNotFoundError("uv was not found on the PATH")
+    else:
+        command = [sys.executable, "-m", "pip", "install"]
+
+    if find_links is not None:
+        command += ["--find-links", find_links]
+    if no_index:
+        command.append("--no-index")
+    return command + packages
+
+
+def get_download_command(packages: t.List[str], dest: str) -> t.List[str]:
+    """Command that downloads wheels for packages and their dependencies
+    into ``dest``, for the running interpreter and platform.
+    """
+    return [sys.executable, "-m", "pip", "download", "--dest", dest, *packages]
+
+
+def _run_streamed(command: t.List[str]) -> bool:
+    process = subprocess.Popen(
+        command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        bufsize=1,
+    )
+    for line in process.stdout:
+        print(line, end="", flush=True)
+    return process.wait() == 0
+
+
+def install_packages(
+    packages: t.List[str],
+    installer: str = "auto",
+    find_links: str = None,
+    no_index: bool = False,
+) -> bool:
+    """Install packages with a single call to the installer, in a
+    subprocess, and stream its output. Afterwards, newly installed modules
+    can be found right away. See :func:`get_install_command` for the
+    arguments.
+
+    Returns:
+        bool: True if the installation succeeded.
+    """
+    command = get_install_command(
+        packages, installer=installer, find_links=find_links, no_index=no_index
+    )
+    success = _run_streamed(command)
+
+    clear_module_cache()
+    return success
+
+
+class WheelPrefetch:
+    """Downloads wheels for packages into a wheelhouse in a background
+    thread, e.g. while the user decides whether to install them. Output of
+    the download is discarded, so that it does not interleave with the
+    questions that are shown in the meantime.
+
+    Args:
+        packages (List[str]): Packages to download.
+        wheelhouse (str): Directory to download the wheels into.
+    """
+
+    def __init__(self, packages: t.List[str], wheelhouse: str):
+        self.packages = packages
+        self.wheelhouse = wheelhouse
+        self.success = False
+        self._thread = threading.Thread(
+            target=self._run, name="icortex-prefetch", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self):
+        os.makedirs(self.wheelhouse, exist_ok=True)
+        command = get_download_command(self.packages, self.wheelhouse)
+        result = subprocess.run(
+            command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        self.success = result.returncode == 0
+
+    def wait(self) -> bool:
+        """Wait for the download to finish.
+
+        Returns:
+            bool: True if wheels for all packages were downloaded.
+        """
+        self._thread.join()
+        return self.success
+
+
+def prefetch_missing_packages(code: str, wheelhouse: str) -> t.Optional[WheelPrefetch]:
+    """Start downloading the packages that the code needs but that are
+    missing, if there are any.
+    """
+    packages, _ = resolve_packages(get_missing_modules(code))
+    if len(packages) == 0:
+        return None
+    return WheelPrefetch(packages, wheelhouse)
+
+
+def sync_wheelhouse(
+    codes: t.Iterable[str], wheelhouse: str
+) -> t.Tuple[t.List[str], t.List[str], bool]:
+    """Download wheels for every package that is imported by the given code
+    into a wheelhouse, so that they can be installed later in offline mode.
+    Modules that are part of the standard library or otherwise importable
+    without a package are skipped.
+
+    Args:
+        codes (Iterable[str]): Python code, e.g. the cells of a notebook.
+        wheelhouse (str): Directory to download the wheels into.
+
+    Returns:
+        Tuple[List[str], List[str], bool]: The packages, the modules that
+        could not be mapped to any package, and whether the download
+        succeeded.
+    """
+    modules = []
+    for code in codes:
+        modules += get_imported_modules(code)
+    packages, unresolved_modules = resolve_packages(list(dict.fromkeys(modules)))
+    unresolved_modules = [
+        module for module in unresolved_modules if not module_exists(module)
+    ]
+
+    success = True
+    if len(packages) > 0:
+        os.makedirs(wheelhouse, exist_ok=True)
+        success = _run_streamed(get_download_command(packages, wheelhouse))
+    return packages, unresolved_modules, success
+
+
+def install_missing_packages(
+    code,
+    installer: str = "auto",
+    prefetch: WheelPrefetch = None,
+    wheelhouse: str = None,
+    offline: bool = False,
+):
+    """Install the PyPI packages that provide the modules that the code
+    imports but that are missing.
+
+    Args:
+        code (str): Python code.
+        installer (str, optional): See :func:`get_install_command`.
+        prefetch (WheelPrefetch, optional): Wheels that are being downloaded
+            for the missing packages. They are tried before going online.
+        wheelhouse (str, optional): Directory of local wheels to install
+            from. Online, it is searched in addition to the package index.
+        offline (bool, optional): Install exclusively from ``wheelhouse``,
+            without contacting the package index. Defaults to False.
+
+    Returns:
+        List[str]: The modules that are still missing.
+    """
+    if offline and wheelhouse is None:
+        raise ValueError("A wheelhouse is required to install packages offline")
+
+    missing_modules = get_missing_modules(code)
+    packages, unresolved_modules = resolve_packages(missing_modules)
+
+    # All packages are resolved together, so that their requirements are
+    # consistent with each other
+    success = True
+    if len(packages) > 0:
+        success = False
+        if offline:
+            success = install_packages(
+                packages,
+                installer=installer,
+                find_links=wheelhouse,
+                no_index=True,
+            )
+        else:
+            if prefetch is not None and prefetch.wait():
+                # Install from the prefetched wheels without going online
+                success = install_packages(
+                    packages,
+                    installer=installer,
+                    find_links=prefetch.wheelhouse,
+                    no_index=True,
+                )
+            if not success:
+                if wheelhouse is not None and not os.path.isdir(wheelhouse):
+                    wheelhouse = None
+                success = install_packages(
+                    packages, installer=installer, find_links=wheelhouse
+                )
+
+    if not success:
+        unresolved_modules += [
+            module
+            for module in missing_modules
+            if module not in unresolved_modules and not module_exists(module)
+        ]
 
     return unresolved_modules
@@ -0,0 +1,313 @@
+"""A generation daemon that hosts code generation services once per node.
+
+Kernels connect to it through :class:`icortex.services.remote.RemoteService`,
+so that models, the generation cache and rate limits are shared by every
+kernel on the node instead of being duplicated in each of them.
+Start it with ``icortex serve-generation``.
+"""
+
+import json
+import logging
+import threading
+import time
+import typing as t
+from argparse import Namespace
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from icortex.config import ICortexConfig
+from icortex.context import ICortexContext
+from icortex.defaults import (
+    DEFAULT_CACHE_PATH,
+    DEFAULT_SERVER_HOST,
+    DEFAULT_SERVER_PORT,
+)
+from icortex.services import get_service
+from icortex.services.service_base import ServiceBase
+from icortex.services.service_interaction import ServiceInteraction
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimitExceeded(Exception):
+    pass
+
+
+class UnknownService(Exception):
+    pass
+
+
+class RateLimiter:
+    """Token bucket that allows ``rate`` requests per minute on average,
+    with bursts of up to ``rate`` requests. A rate of 0 disables limiting.
+    """
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = rate
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.rate, self.tokens + (now - self.last) * self.rate / 60
+            )
+            self.last = now
+            if self.tokens < 1:
+                raise RateLimitExceeded(
+                    f"Rate limit of {self.rate:g} requests per minute exceeded"
+                )
+            self.tokens -= 1
+
+
+class ServiceRegistry:
+    """Instantiates services from a configuration file on first use and
+    keeps them in memory, together with their concurrency and rate limits.
+
+    Args:
+        config_path (str): Path to the configuration TOML file.
+        max_concurrency (int): Maximum number of concurrent generations per service.
+        rate_limit (float): Maximum number of generations per minute per
+            service. 0 means no limit.
+    """
+
+    def __init__(self, config_path: str, max_concurrency: int = 1, rate_limit=0):
+        self.config = ICortexConfig(config_path)
+        self.max_concurrency = max_concurrency
+        self.rate_limit = rate_limit
+        self.services: t.Dict[str, ServiceBase] = {}
+        self.semaphores: t.Dict[str, threading.BoundedSemaphore] = {}
+        self.rate_limiters: t.Dict[str, RateLimiter] = {}
+        # Guards the dicts above. Each service is loaded under a lock of
+        # its own, so that loading a model does not block other services
+        self.lock = threading.Lock()
+        self.load_locks: t.Dict[str, threading.Lock] = {}
+        self.cache_lock = threading.Lock()
+
+    def resolve_name(self, name: str) -> str:
+        if not name:
+            name = self.config.get_service_name()
+            if name is None:
+                raise UnknownService("No service name given and no default service set")
+        return name
+
+    def get_service_class(self, name: str) -> t.Type[ServiceBase]:
+        try:
+            return get_service(name)
+        except KeyError:
+            raise UnknownService(name)
+
+    def get(self, name: str) -> ServiceBase:
+        name = self.resolve_name(name)
+        with self.lock:
+            if name in self.services:
+                return self.services[name]
+            load_lock = self.load_locks.setdefault(name, threading.Lock())
+
+        with load_lock:
+            # Another request may have loaded it in the meantime
+            with self.lock:
+                if name in self.services:
+                    return self.services[name]
+
+            service_class = self.get_service_class(name)
+            service_config = self.config.dict.get(name, {})
+            logger.info(f"Loading service {name}")
+            service = service_class(**service_config)
+
+            with self.lock:
+                self.semaphores[name] = threading.BoundedSemaphore(self.max_concurrency)
+                self.rate_limiters[name] = RateLimiter(self.rate_limit)
+                self.services[name] = service
+            return service
+
+    def describe(self, name: str) -> t.Dict[str, t.Any]:
+        """Describe the prompt variables of a service without loading it."""
+        name = self.resolve_name(name)
+        service_class = self.get_service_class(name)
+        variables = {}
+        for key, var in service_class.variables.items():
+            if var.secret:
+                continue
+            variables[key] = {
+                "type": var.type.__name__,
+                "default": var.default,
+                "help": var.help,
+                "argparse_args": var.argparse_args,
+            }
+        return {
+            "name": name,
+            "description": service_class.description,
+            "variables": variables,
+        }
+
+    def build_args(self, service: ServiceBase, prompt: str, args: t.Dict) -> Namespace:
+        # Start from the defaults of the service and apply the values that
+        # the client sent for arguments that the service knows about
+        namespace = service.prompt_parser.parse_args([])
+        for key, val in args.items():
+            if hasattr(namespace, key):
+                setattr(namespace, key, val)
+        namespace.prompt = prompt
+        return namespace
+
+    def generate(
+        self,
+        name: str,
+        prompt: str,
+        args: t.Dict,
+        context: t.Dict = None,
+    ) -> t.Dict[str, t.Any]:
+        name = self.resolve_name(name)
+        service = self.get(name)
+        self.rate_limiters[name].acquire()
+
+        namespace = self.build_args(service, prompt, args)
+        if context is not None:
+            try:
+                context = ICortexContext.from_dict(context)
+            except Exception:
+                logger.warning("Could not deserialize the prompt context")
+                context = None
+
+        with self.semaphores[name]:
+            generation_result = service.generate(prompt, namespace, context=context)
+        return {
+            "service": name,
+            "generation_result": generation_result.to_dict(),
+            "outputs": service.get_outputs_from_result(generation_result),
+        }
+
+    def cache_interaction(self, name: str, interaction_dict: t.Dict):
+        service = self.get(name)
+        interaction = ServiceInteraction.from_dict(interaction_dict)
+        interaction.name = service.name
+        with self.cache_lock:
+            service.cache_interaction(interaction, cache_path=DEFAULT_CACHE_PATH)
+
+    def get_status(self) -> t.Dict[str, t.Any]:
+        with self.lock:
+            services = dict(self.services)
+        return {
+            "default_service": self.config.get_service_name(),
+            "services": {
+                name: service.get_status() for name, service in services.items()
+            },
+        }
+
+
+class GenerationRequestHandler(BaseHTTPRequestHandler):
+    registry: ServiceRegistry = None
+
+    def _send_json(self, status: int, body: t.Dict):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_json(self) -> t.Dict:
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def _handle(self, func: t.Callable[[], t.Dict]):
+        try:
+            self._send_json(200, func())
+        except RateLimitExceeded as e:
+            self._send_json(429, {"error": str(e)})
+        except UnknownService as e:
+            self._send_json(404, {"error": f"Unknown service: {e}"})
+        except Exception as e:
+            logger.exception("Error while handling request")
+            self._send_json(500, {"error": f"{e.__class__.__name__}: {e}"})
+
+    def do_GET(self):
+        if self.path == "/status":
+            self._handle(self.registry.get_status)
+        elif self.path.startswith("/services/"):
+            name = self.path[len("/services/") :]
+            self._handle(lambda: self.registry.describe(name))
+        else:
+            self._send_json(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        try:
+            body = self._read_json()
+        except json.decoder.JSONDecodeError:
+            self._send_json(400, {"error": "Request body is not valid JSON"})
+            return
+
+        if self.path == "/generate":
+            self._handle(
+                lambda: self.registry.generate(
+                    body.get("service", ""),
+                    body.get("prompt", ""),
+                    body.get("args", {}),
+                    context=body.get("context"),
+                )
+            )
+        elif self.path == "/interactions":
+            self._handle(
+                lambda: self.registry.cache_interaction(
+                    body.get("service", ""), body.get("interaction", {})
+                )
+                or {}
+            )
+        else:
+            self._send_json(404, {"error": f"Unknown path {self.path}"})
+
+    def log_message(self, format, *args):
+        logger.info("%s - %s", self.address_string(), format % args)
+
+
+def make_server(
+    config_path: str,
+    host: str = DEFAULT_SERVER_HOST,
+    port: int = DEFAULT_SERVER_PORT,
+    max_concurrency: int = 1,
+    rate_limit: float = 0,
+) -> ThreadingHTTPServer:
+    """Create the generation daemon, without starting it. Port 0 picks a
+    free port, which can be read from ``server.server_address``.
+    """
+    registry = ServiceRegistry(
+        config_path, max_concurrency=max_concurrency, rate_limit=rate_limit
+    )
+    handler = type(
+        "BoundGenerationRequestHandler",
+        (GenerationRequestHandler,),
+        {"registry": registry},
+    )
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def serve(
+    config_path: str,
+    host: str = DEFAULT_SERVER_HOST,
+    port: int = DEFAULT_SERVER_PORT,
+    max_concurrency: int = 1,
+    rate_limit: float = 0,
+):
+    """Run the generation daemon until interrupted."""
+    logging.basicConfig(level=logging.INFO)
+    server = make_server(
+        config_path,
+        host=host,
+        port=port,
+        max_concurrency=max_concurrency,
+        rate_limit=rate_limit,
+    )
+
+    print(f"Serving code generation on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -2,10 +2,11 @@ import typing as t
 from copy import deepcopy
 import importlib
 
-from icortex.services.service_base import ServiceBase, ServiceVariable
-
 from icortex.defaults import DEFAULT_SERVICE
 
+if t.TYPE_CHECKING:
+    from icortex.services.service_base import ServiceBase, ServiceVariable
+
 #: A dictionary that maps unique service names to corresponding
 #: classes that derive from :class:`icortex.services.service_base.ServiceBase`.
 #: Extend this to add new code generation services to ICortex.
@@ -14,10 +15,11 @@ AVAILABLE_SERVICES: t.Dict[str, str] = {
     "textcortex": "icortex.services.textcortex.TextCortexService",
     "openai": "icortex.services.openai.OpenAIService",
     "huggingface": "icortex.services.huggingface.HuggingFaceAutoService",
+    "remote": "icortex.services.remote.RemoteService",
 }
 
 
-def get_service(name: str) -> t.Type[ServiceBase]:
+def get_service(name: str) -> t.Type["ServiceBase"]:
     """Get the class corresponding a service name
 
     Args:
@@ -42,3 +44,13 @@ def get_available_services() -> t.List[str]:
     sorted_services = [DEFAULT_SERVICE] + sorted_services
 
     return sorted_services
+
+
+def __getattr__(name: str) -> t.Any:
+    # The base classes are loaded on first access, so that listing the
+    # available services does not import every dependency of a service
+    if name in ("ServiceBase", "ServiceVariable"):
+        from icortex.services import service_base
+
+        return getattr(service_base, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,116 @@
+import queue
+import threading
+import time
+import typing as t
+from concurrent.futures import Future
+
+# Put on the queue by MicroBatcher.close to stop the worker thread
+_STOP = object()
+
+
+class MicroBatcher:
+    """Gathers requests that are submitted within a short time window and
+    processes them together, e.g. in a single forward pass of a model.
+
+    Requests are grouped by :attr:`key`, so that only compatible requests
+    end up in the same batch. Each caller gets a future that resolves to
+    the result of its own request.
+
+    Args:
+        process_batch (Callable[[List[Any]], List[Any]]): Function that
+            processes a list of requests and returns one result per request,
+            in the same order.
+        window (float): Time in seconds to wait for more requests after the
+            first request of a batch arrives.
+        max_batch_size (int): Maximum number of requests in a batch.
+        key (Callable[[Any], Hashable], optional): Function that maps a
+            request to a key. Requests with different keys are never
+            batched together. Defaults to None, which batches all requests.
+    """
+
+    def __init__(
+        self,
+        process_batch: t.Callable[[t.List[t.Any]], t.List[t.Any]],
+        window: float,
+        max_batch_size: int,
+        key: t.Callable[[t.Any], t.Hashable] = None,
+    ):
+        self.process_batch = process_batch
+        self.window = window
+        self.max_batch_size = max(max_batch_size, 1)
+        self.key = key if key is not None else (lambda request: None)
+        self._queue = queue.Queue()
+        self._closed = False
+        # Makes sure that no request is queued after the stop marker
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(
+            target=self._run, name="icortex-batcher", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, request) -> Future:
+        """Submit a request to be processed in the next batch.
+
+        Returns:
+            Future: Resolves to the result of the request.
+        """
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Cannot submit requests to a closed batcher")
+            self._queue.put((request, future))
+        return future
+
+    def close(self):
+        """Stop the worker thread once the requests that were submitted so
+        far are processed. The thread holds a reference to
+        ``process_batch``, so e.g. a model that it uses is only released
+        after the batcher is closed.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put((_STOP, None))
+        if threading.current_thread() is not self._thread:
+            self._thread.join()
+
+    def _collect(self) -> t.List[t.Tuple[t.Any, Future]]:
+        # Block until the first request arrives, then gather whatever else
+        # arrives within the window
+        items = [self._queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(items) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                items.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return items
+
+    def _run(self):
+        stopped = False
+        while not stopped:
+            items = self._collect()
+
+            groups: t.Dict[t.Hashable, t.List[t.Tuple[t.Any, Future]]] = {}
+            for request, future in items:
+                if request is _STOP:
+                    stopped = True
+                    continue
+                # Skip requests whose callers are no longer waiting
+                if future.set_running_or_notify_cancel():
+                    groups.setdefault(self.key(request), []).append((request, future))
+
+            for group in groups.values():
+                try:
+                    results = self.process_batch([request for request, _ in group])
+                except Exception as e:
+                    for _, future in group:
+                        future.set_exception(e)
+                    continue
+                for (_, future), result in zip(group, results):
+                    future.set_result(result)
+        self.process_batch = None
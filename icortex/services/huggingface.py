@@ -1,10 +1,17 @@
+import os
 import re
+import threading
+import time
 import typing as t
+from collections import OrderedDict
+from contextlib import contextmanager
+from logging import warning
 
 from icortex.defaults import *
 from icortex.helper import unescape
 from icortex.services import ServiceBase, ServiceVariable
 from icortex.context import ICortexContext
+from icortex.services.batching import MicroBatcher
 from icortex.services.generation_result import GenerationResult
 
 # TODO
@@ -13,6 +20,51 @@ from icortex.services.generation_result import GenerationResult
 
 DEFAULT_MODEL = "TextCortex/codegen-350M-optimized"
 
+#: Supported values for the ``quantization`` service variable
+QUANTIZATION_MODES = ["none", "dynamic-int8", "onnx-int8"]
+
+#: Supported values for the ``backend`` service variable
+BACKENDS = ["auto", "onnx"]
+
+# Fields of batched requests that are specific to each request, see
+# HuggingFaceAutoService._process_batch
+BATCH_REQUEST_FIELDS = {"prompt", "is_cancelled"}
+
+#: Supported values for the ``weight_loading`` service variable
+WEIGHT_LOADING_MODES = ["default", "mmap"]
+
+#: Number of assisted generations after which the draft model is evaluated
+#: and possibly disabled
+DRAFT_MIN_GENERATIONS = 3
+
+#: Every this many prompts that could use the draft model, one is decoded
+#: without it, to measure the plain decoding throughput that assisted
+#: generation is compared against
+DRAFT_BASELINE_INTERVAL = 4
+
+#: Earliest optimum version in which from_pretrained exports PyTorch
+#: checkpoints with ``export=True`` instead of ``from_transformers=True``
+ORT_EXPORT_MIN_VERSION = "1.7.0"
+
+#: Earliest transformers version that supports assisted generation, and the
+#: earliest one that supports it together with sampling (temperature > 0)
+ASSISTED_GENERATION_MIN_VERSION = "4.29.0"
+ASSISTED_SAMPLING_MIN_VERSION = "4.31.0"
+
+# Map from safetensors dtype names to torch dtype names
+SAFETENSORS_DTYPES = {
+    "F64": "float64",
+    "F32": "float32",
+    "F16": "float16",
+    "BF16": "bfloat16",
+    "I64": "int64",
+    "I32": "int32",
+    "I16": "int16",
+    "I8": "int8",
+    "U8": "uint8",
+    "BOOL": "bool",
+}
+
 
 def build_prompt(input: str, prefix: str, suffix: str):
     return prefix + input + suffix
@@ -22,6 +74,7 @@ def build_prompt(input: str, prefix: str, suffix: str):
 PRETRAINED_FILENAMES = {
     "AutoModelForCausalLM": [
         "pytorch_model.bin",
+        r"model.*\.safetensors",
         "tf_model.h5",
         "model.ckpt",
         "flax_model.msgpack",
@@ -33,10 +86,11 @@ PRETRAINED_FILENAMES = {
 }
 
 
-def get_model_initializer(model_id):
-    from huggingface_hub.hf_api import list_repo_files
+def get_model_initializer(model_id, files: t.List[str] = None):
+    if files is None:
+        from huggingface_hub.hf_api import list_repo_files
 
-    files = list_repo_files(model_id)
+        files = list_repo_files(model_id)
 
     for initializer, candidates in PRETRAINED_FILENAMES.items():
         for candidate in candidates:
@@ -46,6 +100,729 @@ def get_model_initializer(model_id):
     return None
 
 
+def has_onnx_weights(files: t.List[str]) -> bool:
+    """Whether a model repo ships ONNX weights that onnxruntime can load
+    without exporting the PyTorch checkpoint first.
+    """
+    return any(
+        re.match(candidate, file) is not None
+        for candidate in PRETRAINED_FILENAMES["ORTModelForCausalLM"]
+        for file in files
+    )
+
+
+def _get_repo_cache_dir(model_id: str) -> str:
+    from huggingface_hub.constants import HUGGINGFACE_HUB_CACHE
+
+    return os.path.join(HUGGINGFACE_HUB_CACHE, "models--" + model_id.replace("/", "--"))
+
+
+def get_model_artifact_dir(model_id: str, revision: str) -> str:
+    """Directory for artifacts that ICortex derives from a model snapshot,
+    such as quantized weights. It is placed next to the snapshots of the
+    model in the HuggingFace cache, and is specific to the revision.
+    """
+    return os.path.join(_get_repo_cache_dir(model_id), "icortex", revision)
+
+
+def get_package_version(name: str) -> str:
+    try:
+        from importlib.metadata import version
+    except ImportError:
+        # Python 3.7
+        from importlib_metadata import version
+    try:
+        return version(name)
+    except Exception:
+        return "unknown"
+
+
+def parse_version(version: str) -> t.Tuple[int, ...]:
+    """Parse the leading release numbers of a version, e.g. ``"4.29.0.dev0"``
+    into ``(4, 29, 0)``. Unknown versions parse into an empty tuple, which
+    compares lower than any release.
+    """
+    release = []
+    for part in version.split("."):
+        match = re.match(r"\d+", part)
+        if match is None:
+            break
+        release.append(int(match.group()))
+        if match.end() < len(part):
+            break
+    return tuple(release)
+
+
+def get_artifact_tag(*packages: str) -> str:
+    """Tag for artifacts that can only be read back by the versions of the
+    packages that wrote them, e.g. ``"torch-1.13.0_transformers-4.24.0"``.
+    """
+    return "_".join(f"{name}-{get_package_version(name)}" for name in packages)
+
+
+def get_model_revision(model_id: str) -> t.Tuple[str, t.List[str]]:
+    """Resolve the revision of a model and the files in it. A model that is
+    already in the local HuggingFace cache is resolved without going
+    online, so that warm loads need no network.
+
+    Returns:
+        Tuple[str, List[str]]: The commit hash and the file names.
+    """
+    repo_dir = _get_repo_cache_dir(model_id)
+    ref_path = os.path.join(repo_dir, "refs", "main")
+    if os.path.exists(ref_path):
+        with open(ref_path, "r") as f:
+            revision = f.read().strip()
+        snapshot_dir = os.path.join(repo_dir, "snapshots", revision)
+        files = [
+            os.path.relpath(os.path.join(root, file), snapshot_dir)
+            for root, _, names in os.walk(snapshot_dir)
+            for file in names
+        ]
+        # Only trust the snapshot if it contains weights
+        if get_model_initializer(model_id, files=files) is not None:
+            return revision, files
+
+    from huggingface_hub.hf_api import model_info
+
+    try:
+        info = model_info(model_id)
+    except Exception as e:
+        raise RuntimeError(
+            f"Model {model_id} is not in the local HuggingFace cache, and it could not be looked up on the Hub: {e}"
+        ) from e
+    return info.sha, [sibling.rfilename for sibling in info.siblings]
+
+
+def load_dynamic_int8_model(model_id: str, revision: str, artifact_dir: str):
+    """Load a PyTorch model with its linear layers dynamically quantized to
+    int8. The quantized model is saved on the first load and read back
+    directly afterwards, without materializing the fp32 weights.
+    """
+    import torch
+    from transformers import AutoModelForCausalLM
+
+    # The whole module is pickled, so it is tied to the library versions
+    path = os.path.join(
+        artifact_dir,
+        f"model-dynamic-int8_{get_artifact_tag('torch', 'transformers')}.pt",
+    )
+    if os.path.exists(path):
+        try:
+            return torch.load(path, weights_only=False)
+        except TypeError:
+            # Older versions of torch do not have the weights_only argument
+            return torch.load(path)
+
+    model = AutoModelForCausalLM.from_pretrained(model_id, revision=revision).eval()
+    model = torch.quantization.quantize_dynamic(
+        model, {torch.nn.Linear}, dtype=torch.qint8
+    )
+    os.makedirs(artifact_dir, exist_ok=True)
+    # Write to a temporary file first so that concurrent loads never see a
+    # partially written model
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    torch.save(model, tmp_path)
+    os.replace(tmp_path, path)
+    return model
+
+
+def parse_cpu_list(cpu_list: str) -> t.Set[int]:
+    """Parse a CPU list such as ``"0-3,8,10-11"`` into a set of CPU ids."""
+    cpus = set()
+    for part in cpu_list.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            start, end = part.split("-", 1)
+            cpus.update(range(int(start), int(end) + 1))
+        else:
+            cpus.add(int(part))
+    return cpus
+
+
+def set_process_affinity(cpus: t.Set[int]):
+    """Pin every thread of the process to the given CPUs.
+    ``os.sched_setaffinity(0, ...)`` only pins the calling thread on Linux,
+    so threads that were already started, e.g. by the kernel or by a thread
+    pool, are pinned one by one through ``/proc/self/task``. Threads that
+    are started afterwards inherit the affinity of the thread that starts
+    them. A thread that is being started while this runs may be missed.
+    """
+    try:
+        tids = [int(tid) for tid in os.listdir("/proc/self/task")]
+    except OSError:
+        # No procfs, only the calling thread can be pinned
+        tids = [0]
+    for tid in tids:
+        try:
+            os.sched_setaffinity(tid, cpus)
+        except ProcessLookupError:
+            # The thread exited in the meantime
+            pass
+
+
+def configure_cpu_threads(
+    intra_op_threads: int = 0, inter_op_threads: int = 0, cpu_affinity: str = ""
+):
+    """Pin the process to the given CPUs and set the thread pool sizes of
+    torch. When CPUs are given but the number of intra-op threads is not,
+    it is set to the number of CPUs instead of the number of cores on the
+    host.
+
+    Returns:
+        Tuple[int, int]: The intra-op and inter-op thread counts to use for
+        onnxruntime sessions, 0 meaning the library default.
+    """
+    import torch
+
+    if cpu_affinity:
+        cpus = parse_cpu_list(cpu_affinity)
+        if hasattr(os, "sched_setaffinity"):
+            set_process_affinity(cpus)
+        else:
+            warning("CPU affinity is not supported on this platform, ignoring it")
+        if intra_op_threads <= 0:
+            intra_op_threads = len(cpus)
+
+    if intra_op_threads > 0:
+        torch.set_num_threads(intra_op_threads)
+    if inter_op_threads > 0:
+        try:
+            torch.set_num_interop_threads(inter_op_threads)
+        except RuntimeError:
+            # Can only be set once, before any inter-op parallel work
+            warning(
+                "Could not set the number of inter-op threads, torch has already started its thread pool"
+            )
+
+    return intra_op_threads, inter_op_threads
+
+
+def load_ort_model(model_id: str, revision: str = None, export: bool = False, **kwargs):
+    """Load an ONNX model with ``ORTModelForCausalLM.from_pretrained``.
+    ``from_pretrained`` has no ``revision`` parameter in the optimum
+    version in the lock file, and reads the revision from
+    ``model_id@revision`` instead, which later versions accept as well.
+
+    Args:
+        model_id (str): Model id on the HuggingFace Hub, or a local directory.
+        revision (str, optional): Revision of the model on the Hub.
+        export (bool, optional): Export a PyTorch checkpoint to ONNX. The
+            keyword for this depends on the optimum version.
+        **kwargs: Passed on to ``from_pretrained``.
+    """
+    from optimum.onnxruntime import ORTModelForCausalLM
+
+    if revision is not None:
+        model_id = f"{model_id}@{revision}"
+    if export:
+        version = parse_version(get_package_version("optimum"))
+        if version >= parse_version(ORT_EXPORT_MIN_VERSION):
+            kwargs["export"] = True
+        else:
+            kwargs["from_transformers"] = True
+    return ORTModelForCausalLM.from_pretrained(model_id, **kwargs)
+
+
+def get_ort_session_options(intra_op_threads: int, inter_op_threads: int):
+    import onnxruntime
+
+    session_options = onnxruntime.SessionOptions()
+    if intra_op_threads > 0:
+        session_options.intra_op_num_threads = intra_op_threads
+    if inter_op_threads > 0:
+        session_options.inter_op_num_threads = inter_op_threads
+    return session_options
+
+
+def mmap_safetensors(path: str):
+    """Memory-map a safetensors file and return its tensors. The tensors
+    are read-only views of the mapped file, so their pages live in the page
+    cache and are shared by every process that maps the same file.
+
+    Returns:
+        Dict[str, torch.Tensor]: Map from tensor names to tensors.
+    """
+    import json
+    import mmap
+    import warnings
+    import torch
+
+    with open(path, "rb") as f:
+        header_size = int.from_bytes(f.read(8), "little")
+        header = json.loads(f.read(header_size))
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    data_start = 8 + header_size
+    tensors = {}
+    for name, info in header.items():
+        if name == "__metadata__":
+            continue
+        dtype = getattr(torch, SAFETENSORS_DTYPES[info["dtype"]])
+        start, end = info["data_offsets"]
+        if start == end:
+            tensors[name] = torch.empty(info["shape"], dtype=dtype)
+            continue
+        count = (end - start) // torch.tensor([], dtype=dtype).element_size()
+        with warnings.catch_warnings():
+            # The mapping is read-only on purpose, weights are never written to
+            warnings.simplefilter("ignore", UserWarning)
+            tensor = torch.frombuffer(
+                buffer, dtype=dtype, count=count, offset=data_start + start
+            )
+        tensors[name] = tensor.reshape(info["shape"])
+    return tensors
+
+
+def get_safetensors_files(model_id: str, revision: str, artifact_dir: str):
+    """Get local paths to the safetensors weights of a model. Repos without
+    safetensors weights are converted once and the result is cached in the
+    artifact directory.
+    """
+    import glob
+    from huggingface_hub import snapshot_download
+
+    snapshot_dir = snapshot_download(
+        model_id, revision=revision, allow_patterns=["*.safetensors"]
+    )
+    files = sorted(glob.glob(os.path.join(snapshot_dir, "*.safetensors")))
+    if files:
+        return files
+
+    path = os.path.join(artifact_dir, "model.safetensors")
+    if not os.path.exists(path):
+        from safetensors.torch import save_model
+        from transformers import AutoModelForCausalLM
+
+        model = AutoModelForCausalLM.from_pretrained(model_id, revision=revision)
+        os.makedirs(artifact_dir, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        save_model(model, tmp_path)
+        os.replace(tmp_path, path)
+        del model
+
+    return [path]
+
+
+def _assign_tensors(model, tensors) -> t.Dict[str, t.Any]:
+    """Point the parameters and buffers of a model at the given tensors,
+    without copying them. This does what ``load_state_dict(assign=True)``
+    does in torch 2.1 and later.
+
+    Returns:
+        Dict[str, torch.Tensor]: The tensors that were assigned, by name.
+    """
+    assigned = {}
+    for name, tensor in tensors.items():
+        module_name, _, attr = name.rpartition(".")
+        try:
+            module = model.get_submodule(module_name)
+        except AttributeError:
+            continue
+        if module._parameters.get(attr) is not None:
+            param = module._parameters[attr]
+            if param.shape != tensor.shape:
+                raise ValueError(
+                    f"Shape mismatch for {name}: {tuple(tensor.shape)} in the checkpoint, {tuple(param.shape)} in the model"
+                )
+            if tensor.dtype != param.dtype:
+                # Casting copies the tensor, so it is not shared anymore
+                tensor = tensor.to(param.dtype)
+            param.data = tensor
+        elif attr in module._buffers:
+            module._buffers[attr] = tensor
+        else:
+            continue
+        assigned[name] = tensor
+    return assigned
+
+
+def _get_uninitialized_keys(model, assigned: t.Dict[str, t.Any]) -> t.List[str]:
+    # Parameters that were neither loaded nor tied to a loaded parameter.
+    # Buffers are computed when the model is constructed, which
+    # no_init_weights does not skip
+    loaded_ptrs = {tensor.data_ptr() for tensor in assigned.values()}
+    buffers = {name for name, _ in model.named_buffers()}
+    ignored = getattr(model, "_keys_to_ignore_on_load_missing", None) or []
+    return [
+        name
+        for name, tensor in model.state_dict().items()
+        if name not in assigned
+        and name not in buffers
+        and tensor.data_ptr() not in loaded_ptrs
+        and not any(re.search(pattern, name) for pattern in ignored)
+    ]
+
+
+@contextmanager
+def _skip_torch_init():
+    """Turn the initializers in ``torch.nn.init`` into no-ops, so that the
+    ``reset_parameters`` of torch layers leave the parameters untouched.
+    ``no_init_weights`` of transformers 4.24 only skips ``_init_weights`` of
+    the model.
+    """
+    import torch
+
+    # In-place initializers such as kaiming_uniform_ and normal_
+    names = [
+        name
+        for name in dir(torch.nn.init)
+        if name.endswith("_") and not name.startswith("_")
+    ]
+    originals = {name: getattr(torch.nn.init, name) for name in names}
+
+    def skip(tensor, *args, **kwargs):
+        return tensor
+
+    try:
+        for name in names:
+            setattr(torch.nn.init, name, skip)
+        yield
+    finally:
+        for name, func in originals.items():
+            setattr(torch.nn.init, name, func)
+
+
+def load_mmap_model(model_id: str, revision: str, artifact_dir: str):
+    """Load a PyTorch model whose weights are memory-mapped from safetensors
+    files instead of being copied into process memory. Kernels that load the
+    same model share a single copy of the weights through the page cache.
+
+    The parameters are not initialized before the weights are assigned. If
+    the weights cannot be memory-mapped, e.g. because converting them needs
+    a newer version of safetensors, or the checkpoint does not match the
+    parameters of the model, the model is loaded the default way instead.
+    """
+    from transformers import AutoConfig, AutoModelForCausalLM
+    from transformers.modeling_utils import no_init_weights
+
+    def fall_back(reason: str):
+        warning(f"{reason}, loading {model_id} without memory-mapping")
+        return AutoModelForCausalLM.from_pretrained(model_id, revision=revision)
+
+    try:
+        paths = get_safetensors_files(model_id, revision, artifact_dir)
+    except ImportError as e:
+        # save_model was added in safetensors 0.3
+        return fall_back(
+            f"Converting the weights to safetensors requires safetensors>=0.3 ({e})"
+        )
+
+    config = AutoConfig.from_pretrained(model_id, revision=revision)
+    # Parameters are allocated but never written to, so their memory is not
+    # resident before they are replaced by the mapped tensors
+    with no_init_weights(), _skip_torch_init():
+        model = AutoModelForCausalLM.from_config(config)
+
+    assigned = {}
+    try:
+        for path in paths:
+            assigned.update(_assign_tensors(model, mmap_safetensors(path)))
+    except ValueError as e:
+        return fall_back(str(e))
+    model.tie_weights()
+
+    uninitialized = _get_uninitialized_keys(model, assigned)
+    if uninitialized:
+        return fall_back(
+            f"The safetensors weights do not cover {', '.join(uninitialized[:5])}"
+            f"{' and more' if len(uninitialized) > 5 else ''}"
+        )
+
+    return model
+
+
+def _publish_dir(tmp_dir: str, dest_dir: str):
+    """Move a fully written temporary directory to its final location.
+    If another process got there first, keep its copy.
+    """
+    import shutil
+
+    try:
+        os.rename(tmp_dir, dest_dir)
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def export_onnx_model(model_id: str, revision: str, artifact_dir: str) -> str:
+    """Export a PyTorch checkpoint to ONNX. The export is cached for the
+    given revision, so the conversion only happens once.
+
+    Returns:
+        str: Directory containing the exported ONNX model.
+    """
+    import tempfile
+
+    onnx_dir = os.path.join(artifact_dir, f"onnx_{get_artifact_tag('optimum')}")
+
+    if not os.path.isdir(onnx_dir):
+        model = load_ort_model(model_id, revision=revision, export=True)
+        os.makedirs(artifact_dir, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=artifact_dir)
+        model.save_pretrained(tmp_dir)
+        _publish_dir(tmp_dir, onnx_dir)
+
+    return onnx_dir
+
+
+def load_onnx_int8_model(
+    model_id: str,
+    revision: str,
+    artifact_dir: str,
+    export: bool = False,
+    session_options=None,
+):
+    """Load an ONNX model with its weights dynamically quantized to int8.
+    The quantized model is saved on the first load and reused afterwards.
+
+    Args:
+        model_id (str): Model id on the HuggingFace Hub.
+        revision (str): Revision of the model.
+        artifact_dir (str): Directory to save the quantized model to.
+        export (bool, optional): Set to True if the repo contains PyTorch
+            weights that need to be exported to ONNX first. Defaults to False.
+        session_options (onnxruntime.SessionOptions, optional): Options for
+            the inference session. Defaults to None.
+    """
+    import platform
+    import tempfile
+    from optimum.onnxruntime import ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+    from transformers import AutoConfig
+
+    quantized_dir = os.path.join(
+        artifact_dir, f"onnx-int8_{get_artifact_tag('optimum')}"
+    )
+
+    if not os.path.isdir(quantized_dir):
+        if platform.machine().lower() in ("arm64", "aarch64"):
+            qconfig = AutoQuantizationConfig.arm64(is_static=False)
+        else:
+            qconfig = AutoQuantizationConfig.avx2(is_static=False)
+
+        if export:
+            onnx_dir = export_onnx_model(model_id, revision, artifact_dir)
+        else:
+            from huggingface_hub import snapshot_download
+
+            onnx_dir = snapshot_download(model_id, revision=revision)
+
+        os.makedirs(artifact_dir, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=artifact_dir)
+        # Quantize every ONNX file of the model, e.g. decoders with and
+        # without past key values
+        for file_name in sorted(os.listdir(onnx_dir)):
+            if file_name.endswith(".onnx"):
+                quantizer = ORTQuantizer.from_pretrained(onnx_dir, file_name=file_name)
+                quantizer.quantize(save_dir=tmp_dir, quantization_config=qconfig)
+        AutoConfig.from_pretrained(onnx_dir).save_pretrained(tmp_dir)
+        _publish_dir(tmp_dir, quantized_dir)
+
+    quantized_files = sorted(
+        f for f in os.listdir(quantized_dir) if f.endswith("_quantized.onnx")
+    )
+    file_name = (
+        "model_quantized.onnx"
+        if "model_quantized.onnx" in quantized_files
+        else quantized_files[0]
+    )
+    return load_ort_model(
+        quantized_dir, file_name=file_name, session_options=session_options
+    )
+
+
+class StopSequenceCriteria:
+    """Stopping criteria that ends generation once every sequence in the
+    batch contains the stop string in its generated part.
+
+    Only the last few tokens of each sequence are decoded at each step, so
+    stop strings that the tokenizer splits into several tokens are matched
+    without re-decoding the whole sequence. Beam search reorders the rows
+    of the batch between steps, so matches are remembered by the token ids
+    of the sequence up to the match rather than by row: a row is done if it
+    continues any sequence that contained the stop string. Compatible with
+    :class:`transformers.StoppingCriteriaList`.
+
+    Args:
+        tokenizer: Tokenizer used to decode the generated tokens.
+        stop (str): The stop string.
+        prompt_length (int): Number of prompt tokens at the start of
+            each sequence, which are never matched against.
+    """
+
+    def __init__(self, tokenizer, stop: str, prompt_length: int):
+        self.tokenizer = tokenizer
+        self.stop = stop
+        self.prompt_length = prompt_length
+        # Every token decodes to at least one character, so the stop string
+        # spans at most len(stop) tokens
+        self.window = max(len(stop), 1)
+        # Token ids of the sequences in which the stop string was found
+        self.matches: t.List[t.List[int]] = []
+
+    def __call__(self, input_ids, scores, **kwargs) -> bool:
+        start = max(self.prompt_length, input_ids.shape[1] - self.window)
+        done = True
+        for row in range(input_ids.shape[0]):
+            ids = input_ids[row].tolist()
+            if any(ids[: len(match)] == match for match in self.matches):
+                continue
+            if self.stop in self.tokenizer.decode(ids[start:]):
+                self.matches.append(ids)
+            else:
+                done = False
+
+        return done
+
+
+class CancellationCriteria:
+    """Stopping criteria that ends generation as soon as ``is_cancelled``
+    returns True, so that an interrupted prompt stops decoding at the next
+    token. Compatible with :class:`transformers.StoppingCriteriaList`.
+    """
+
+    def __init__(self, is_cancelled: t.Callable[[], bool]):
+        self.is_cancelled = is_cancelled
+
+    def __call__(self, input_ids, scores, **kwargs) -> bool:
+        return self.is_cancelled()
+
+
+def truncate_at_stop(text: str, stop: str) -> str:
+    if stop:
+        text = text.split(stop, 1)[0]
+    return text
+
+
+class PrefixCache:
+    """Bounded LRU cache that maps token id sequences to the past key values
+    computed for them, so that prompts sharing a prefix with an earlier
+    prompt only need to prefill the part that differs.
+
+    Args:
+        capacity (int): Maximum number of entries to keep. 0 disables the cache.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._entries = OrderedDict()
+
+    def get(self, ids: t.List[int]) -> t.Tuple[t.Any, int]:
+        """Find the entry that shares the longest prefix with ``ids``. The
+        shared prefix is strictly shorter than ``ids``, so that at least one
+        token is left to be fed to the model. On ties, the shortest entry
+        wins.
+
+        Returns:
+            Tuple[Any, int]: The past key values of the entry and the length
+            of the shared prefix, or ``(None, 0)`` on a miss. The past key
+            values can cover more tokens than the shared prefix, see
+            :func:`slice_past_key_values`.
+        """
+        best_key, best_length = None, 0
+        limit = len(ids) - 1
+        for key in self._entries:
+            length = 0
+            for a, b in zip(key[:limit], ids):
+                if a != b:
+                    break
+                length += 1
+            if length > best_length or (
+                length == best_length and length > 0 and len(key) < len(best_key)
+            ):
+                best_key, best_length = key, length
+        if best_key is None:
+            return None, 0
+        self._entries.move_to_end(best_key)
+        return self._entries[best_key], best_length
+
+    def put(self, ids: t.List[int], past_key_values):
+        if self.capacity <= 0:
+            return
+        self._entries[tuple(ids)] = past_key_values
+        self._entries.move_to_end(tuple(ids))
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+
+def to_legacy_past_key_values(past_key_values):
+    """Convert past key values to the tuple format that every version of
+    transformers accepts: one ``(key, value)`` pair per layer.
+    """
+    if hasattr(past_key_values, "to_legacy_cache"):
+        past_key_values = past_key_values.to_legacy_cache()
+    return tuple(tuple(layer) for layer in past_key_values)
+
+
+def slice_past_key_values(past_key_values, length: int):
+    """Keep the first ``length`` positions of legacy past key values.
+
+    Returns None if the layout of the tensors is not the common
+    ``(batch, heads, sequence, head_dim)``, in which case the sequence
+    dimension is unknown.
+    """
+    for layer in past_key_values:
+        for tensor in layer:
+            if tensor.dim() != 4:
+                return None
+    if past_key_values[0][0].shape[-2] == length:
+        return past_key_values
+    return tuple(
+        tuple(tensor[:, :, :length] for tensor in layer) for layer in past_key_values
+    )
+
+
+class DecodingStats:
+    """Running totals of decoding throughput, and of the acceptance rate of
+    draft tokens for assisted generation.
+
+    The acceptance rate is estimated from the number of forward calls: in
+    every assisted step the draft model proposes one token per forward call,
+    and the target model verifies them in a single forward call that also
+    contributes one token of its own. The prefill call of the target model
+    is counted as a step as well, which makes the estimate slightly
+    conservative.
+    """
+
+    def __init__(self):
+        self.generations = 0
+        self.tokens = 0
+        self.seconds = 0.0
+        self.target_calls = 0
+        self.draft_calls = 0
+
+    def update(
+        self, tokens: int, seconds: float, target_calls: int = 0, draft_calls: int = 0
+    ):
+        self.generations += 1
+        self.tokens += tokens
+        self.seconds += seconds
+        self.target_calls += target_calls
+        self.draft_calls += draft_calls
+
+    @property
+    def tokens_per_second(self) -> t.Optional[float]:
+        if self.seconds <= 0:
+            return None
+        return self.tokens / self.seconds
+
+    @property
+    def acceptance_rate(self) -> t.Optional[float]:
+        if self.draft_calls <= 0:
+            return None
+        accepted = max(self.tokens - self.target_calls, 0)
+        return min(accepted / self.draft_calls, 1.0)
+
+
+def _round(value: t.Optional[float], ndigits: int = 2) -> t.Optional[float]:
+    return None if value is None else round(value, ndigits)
+
+
 class HuggingFaceAutoService(ServiceBase):
     name = "huggingface"
     description = "Service to generate code using HuggingFace models"
@@ -70,7 +847,7 @@ class HuggingFaceAutoService(ServiceBase):
         "max_length": ServiceVariable(
             int,
             default=256,
-            help=f"Maximum token count that the API should attempt to generate.",
+            help=f"Maximum number of tokens to generate, not counting the prompt.",
             argparse_args=["-c", "--max_length"],
         ),
         "prompt_prefix": ServiceVariable(
@@ -91,6 +868,67 @@ class HuggingFaceAutoService(ServiceBase):
             help=f"A sequence where the API will stop generating further tokens. The returned text will not contain the stop sequence.",
             argparse_args=["--stop"],
         ),
+        "max_time": ServiceVariable(
+            float,
+            default=0.0,
+            help=f"Maximum time in seconds that a generation is allowed to run. 0 means no limit.",
+            argparse_args=["--max-time"],
+        ),
+        "prefix_cache_size": ServiceVariable(
+            int,
+            default=4,
+            help=f"Number of recent prompts whose key/value cache is kept in memory, so that the prefix a new prompt shares with them, e.g. the prompt prefix and template, is not computed again. 0 disables prefix caching.",
+        ),
+        "quantization": ServiceVariable(
+            str,
+            default="none",
+            help=f"Quantize the model when it is loaded, for faster inference on CPU. One of: {', '.join(QUANTIZATION_MODES)}.",
+        ),
+        "backend": ServiceVariable(
+            str,
+            default="auto",
+            help=f"Inference backend. 'auto' picks PyTorch or onnxruntime depending on the files in the model repo. 'onnx' exports PyTorch checkpoints to ONNX once, caches the export and runs them with onnxruntime.",
+        ),
+        "batch_window_ms": ServiceVariable(
+            int,
+            default=0,
+            help=f"Time window in milliseconds in which concurrent prompts are gathered and generated in a single batch. Only prompts with the same options and prompt prefix are batched together. The prefix cache and assisted generation only apply to batches of a single prompt. 0 disables batching.",
+        ),
+        "max_batch_size": ServiceVariable(
+            int,
+            default=8,
+            help=f"Maximum number of prompts in a batch when batching is enabled.",
+        ),
+        "intra_op_threads": ServiceVariable(
+            int,
+            default=0,
+            help=f"Number of threads used within an operation, e.g. a matrix multiplication, by torch and onnxruntime. 0 uses the library default, or the number of CPUs in cpu_affinity if it is set.",
+        ),
+        "inter_op_threads": ServiceVariable(
+            int,
+            default=0,
+            help=f"Number of threads used to run independent operations in parallel. 0 uses the library default.",
+        ),
+        "cpu_affinity": ServiceVariable(
+            str,
+            default="",
+            help=f"CPUs to pin the kernel to, e.g. '0-7,16-23'. All threads of the kernel process are pinned when the model is loaded (Linux only). Leave empty to use all CPUs.",
+        ),
+        "weight_loading": ServiceVariable(
+            str,
+            default="default",
+            help=f"How PyTorch weights are loaded on CPU. 'mmap' memory-maps safetensors weights so that kernels running the same model share them. One of: {', '.join(WEIGHT_LOADING_MODES)}.",
+        ),
+        "draft_model": ServiceVariable(
+            str,
+            default="",
+            help=f"Id of a small model that shares the tokenizer of the main model, e.g. Salesforce/codegen-350M-mono. It proposes tokens that the main model verifies in a single forward pass (assisted generation). Requires transformers>=4.29, and >=4.31 for temperature > 0. Leave empty to disable.",
+        ),
+        "draft_min_acceptance": ServiceVariable(
+            float,
+            default=0.3,
+            help=f"Assisted generation is turned off if the rate at which draft tokens are accepted falls below this value, or if it turns out slower than plain decoding.",
+        ),
     }
 
     def __init__(self, **kwargs: t.Dict):
@@ -100,36 +938,239 @@ class HuggingFaceAutoService(ServiceBase):
         from transformers import AutoTokenizer
 
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
-        self.token_id_cache = {}
 
         if "model" in kwargs:
             model_id = kwargs["model"]
         else:
             model_id = DEFAULT_MODEL
 
-        initializer = get_model_initializer(model_id)
+        quantization = kwargs.get("quantization", "none")
+        if quantization not in QUANTIZATION_MODES:
+            raise ValueError(
+                f"Unknown quantization mode {quantization}, choose one of: {', '.join(QUANTIZATION_MODES)}"
+            )
+
+        backend = kwargs.get("backend", "auto")
+        if backend not in BACKENDS:
+            raise ValueError(
+                f"Unknown backend {backend}, choose one of: {', '.join(BACKENDS)}"
+            )
+
+        weight_loading = kwargs.get("weight_loading", "default")
+        if weight_loading not in WEIGHT_LOADING_MODES:
+            raise ValueError(
+                f"Unknown weight loading mode {weight_loading}, choose one of: {', '.join(WEIGHT_LOADING_MODES)}"
+            )
+        self.weight_loading = weight_loading
+
+        # Threading has to be configured before the model is loaded
+        threads = configure_cpu_threads(
+            intra_op_threads=kwargs.get("intra_op_threads", 0),
+            inter_op_threads=kwargs.get("inter_op_threads", 0),
+            cpu_affinity=kwargs.get("cpu_affinity", ""),
+        )
+
+        revision, files = get_model_revision(model_id)
+        artifact_dir = get_model_artifact_dir(model_id, revision)
+
+        initializer = get_model_initializer(model_id, files=files)
 
         # Tokenizer is always initialized with AutoTokenizer
-        self.tokenizer = AutoTokenizer.from_pretrained(model_id)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_id, revision=revision)
+        # Batched prompts are left-padded so that generation continues right
+        # after the end of each prompt
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
 
         # For the model itself, we need to use the respective auto initializers
         # print("Loading HuggingFace model ", model_id)
 
-        if initializer == "AutoModelForCausalLM":
+        if initializer is None:
+            raise Exception(
+                f"Could not find an appropriate initializer for model {model_id}"
+            )
+        elif quantization == "onnx-int8" or (
+            quantization == "dynamic-int8" and initializer == "ORTModelForCausalLM"
+        ):
+            # ONNX models are quantized with onnxruntime for both modes
+            self.model = load_onnx_int8_model(
+                model_id,
+                revision,
+                artifact_dir,
+                export=not has_onnx_weights(files),
+                session_options=get_ort_session_options(*threads),
+            )
+            initializer = "ORTModelForCausalLM"
+        elif initializer == "AutoModelForCausalLM" and backend == "onnx":
+            if has_onnx_weights(files):
+                # Use the ONNX weights that the repo ships along with the
+                # PyTorch checkpoint
+                self.model = load_ort_model(
+                    model_id,
+                    revision=revision,
+                    session_options=get_ort_session_options(*threads),
+                )
+            else:
+                onnx_dir = export_onnx_model(model_id, revision, artifact_dir)
+                self.model = load_ort_model(
+                    onnx_dir, session_options=get_ort_session_options(*threads)
+                )
+            initializer = "ORTModelForCausalLM"
+        elif initializer == "AutoModelForCausalLM":
             from transformers import AutoModelForCausalLM
 
-            self.model = AutoModelForCausalLM.from_pretrained(model_id)
+            if quantization == "dynamic-int8":
+                # Dynamic quantization is only supported on CPU
+                self.device = "cpu"
+                self.model = load_dynamic_int8_model(model_id, revision, artifact_dir)
+            elif weight_loading == "mmap" and self.device == "cpu":
+                self.model = load_mmap_model(model_id, revision, artifact_dir)
+            else:
+                self.model = AutoModelForCausalLM.from_pretrained(
+                    model_id, revision=revision
+                )
 
             if hasattr(self.model, "eval"):
                 self.model = self.model.eval().to(self.device)
         elif initializer == "ORTModelForCausalLM":
-            from optimum.onnxruntime import ORTModelForCausalLM
+            self.model = load_ort_model(
+                model_id,
+                revision=revision,
+                session_options=get_ort_session_options(*threads),
+            )
+
+        self.model_id = model_id
+        self.initializer = initializer
+
+        self.draft_model_id = kwargs.get("draft_model", "")
+        self.draft_min_acceptance = kwargs.get(
+            "draft_min_acceptance", self.variables["draft_min_acceptance"].default
+        )
+        self.draft_model = None
+        self.draft_enabled = False
+        self.draft_sampling = False
+        self.plain_stats = DecodingStats()
+        self.assisted_stats = DecodingStats()
+        self._forward_calls = {"target": 0, "draft": 0}
+        self._draft_turns = 0
+        if self.draft_model_id:
+            self._load_draft_model()
+
+        self.prefix_cache = PrefixCache(
+            kwargs.get("prefix_cache_size", self.variables["prefix_cache_size"].default)
+        )
 
-            self.model = ORTModelForCausalLM.from_pretrained(model_id)
+        batch_window_ms = kwargs.get(
+            "batch_window_ms", self.variables["batch_window_ms"].default
+        )
+        if batch_window_ms > 0:
+            self.batcher = MicroBatcher(
+                self._process_batch,
+                window=batch_window_ms / 1000,
+                max_batch_size=kwargs.get(
+                    "max_batch_size", self.variables["max_batch_size"].default
+                ),
+                key=self._get_batch_key,
+            )
         else:
-            raise Exception(
-                f"Could not find an appropriate initializer for model {model_id}"
+            self.batcher = None
+        # Without the batcher, concurrent requests would share the prefix
+        # cache, the forward call counters and the decoding statistics
+        self._generate_lock = threading.Lock()
+
+    def set_variable(self, var_name: str, value) -> bool:
+        # Settings that are not tied to the loaded model are applied in place
+        if var_name == "draft_min_acceptance":
+            self.variables[var_name].set_default(value)
+            self.draft_min_acceptance = value
+            return True
+        if var_name == "prefix_cache_size":
+            self.variables[var_name].set_default(value)
+            self.prefix_cache = PrefixCache(value)
+            return True
+        return super().set_variable(var_name, value)
+
+    def close(self):
+        if self.batcher is not None:
+            self.batcher.close()
+
+    def _load_draft_model(self):
+        if self.initializer != "AutoModelForCausalLM":
+            warning(
+                f"Assisted generation requires a PyTorch model, ignoring the draft model {self.draft_model_id}"
+            )
+            return
+
+        version = get_package_version("transformers")
+        if parse_version(version) < parse_version(ASSISTED_GENERATION_MIN_VERSION):
+            warning(
+                f"Assisted generation requires transformers>={ASSISTED_GENERATION_MIN_VERSION}, but {version} is installed, ignoring the draft model {self.draft_model_id}"
             )
+            return
+        # Older versions silently ignore the draft model when sampling
+        self.draft_sampling = parse_version(version) >= parse_version(
+            ASSISTED_SAMPLING_MIN_VERSION
+        )
+
+        from transformers import AutoModelForCausalLM
+
+        self.draft_model = (
+            AutoModelForCausalLM.from_pretrained(self.draft_model_id)
+            .eval()
+            .to(self.device)
+        )
+        self.draft_enabled = True
+
+        # Count forward calls of both models to estimate the acceptance rate
+        def count(name):
+            def hook(module, inputs, outputs):
+                self._forward_calls[name] += 1
+
+            return hook
+
+        self.model.register_forward_hook(count("target"))
+        self.draft_model.register_forward_hook(count("draft"))
+
+    def _update_decoding_stats(self, assisted: bool, tokens: int, seconds: float):
+        if not assisted:
+            self.plain_stats.update(tokens, seconds)
+            return
+
+        stats = self.assisted_stats
+        stats.update(
+            tokens,
+            seconds,
+            target_calls=self._forward_calls["target"],
+            draft_calls=self._forward_calls["draft"],
+        )
+        if stats.generations < DRAFT_MIN_GENERATIONS:
+            return
+
+        # Fall back to plain decoding if the draft model does not pay off
+        reason = None
+        if (
+            stats.acceptance_rate is not None
+            and stats.acceptance_rate < self.draft_min_acceptance
+        ):
+            reason = f"acceptance rate {stats.acceptance_rate:.2f} is below {self.draft_min_acceptance:.2f}"
+        elif (
+            self.plain_stats.generations >= DRAFT_MIN_GENERATIONS
+            and stats.tokens_per_second is not None
+            and self.plain_stats.tokens_per_second is not None
+            and stats.tokens_per_second < self.plain_stats.tokens_per_second
+        ):
+            reason = f"{stats.tokens_per_second:.1f} tokens/s is slower than {self.plain_stats.tokens_per_second:.1f} tokens/s with plain decoding"
+        if reason is not None:
+            warning(f"Disabling the draft model {self.draft_model_id}: {reason}")
+            self.draft_enabled = False
+
+    def _use_draft(self) -> bool:
+        # Called for every prompt that could use the draft model. Some are
+        # decoded without it, since plain decoding is never measured
+        # otherwise while the draft model is enabled
+        self._draft_turns += 1
+        return self._draft_turns % DRAFT_BASELINE_INTERVAL != 0
 
     def generate(
         self,
@@ -150,7 +1191,8 @@ class HuggingFaceAutoService(ServiceBase):
             "stop": args.stop,
             "temperature": args.temperature,
             "max_length": args.max_length,
-            # "n_gen": args.n_gen,
+            "num_return_sequences": args.n_gen,
+            "max_time": args.max_time,
         }
 
         # Create a dict of the request for cache storage
@@ -169,8 +1211,12 @@ class HuggingFaceAutoService(ServiceBase):
                     return cached_interaction.generation_result
 
         # Inference
-        code = self._generate(**payload)
-        response_dict = {"generated_text": [{"text": code}]}
+        outputs = self._generate(
+            **payload,
+            prefix=unescape(args.prompt_prefix),
+            is_cancelled=self.get_cancel_check(),
+        )
+        response_dict = {"generated_text": [{"text": code} for code in outputs]}
 
         return GenerationResult(cached_request_dict, response_dict)
 
@@ -181,40 +1227,246 @@ class HuggingFaceAutoService(ServiceBase):
         max_length=64,
         temperature=0.2,
         num_return_sequences=1,
-    ):
+        max_time=0.0,
+        prefix="",
+        is_cancelled: t.Callable[[], bool] = None,
+    ) -> t.List[str]:
+        options = {
+            "stop": stop,
+            "max_length": max_length,
+            "temperature": temperature,
+            "num_return_sequences": num_return_sequences,
+            "max_time": max_time,
+            "prefix": prefix,
+        }
+        if self.batcher is not None:
+            request = {"prompt": prompt, "is_cancelled": is_cancelled, **options}
+            return self.batcher.submit(request).result()
+        with self._generate_lock:
+            return self._generate_batch([prompt], is_cancelled=is_cancelled, **options)[
+                0
+            ]
+
+    def _process_batch(self, requests: t.List[t.Dict]) -> t.List[t.List[str]]:
+        # Requests are grouped by their options, including the prompt prefix
+        # whose key/value cache is reused, see _get_batch_key
+        options = {
+            key: val
+            for key, val in requests[0].items()
+            if key not in BATCH_REQUEST_FIELDS
+        }
+        prompts = [request["prompt"] for request in requests]
+        checks = [
+            request["is_cancelled"]
+            for request in requests
+            if request["is_cancelled"] is not None
+        ]
+
+        # Stop the batch once every prompt in it is cancelled
+        def is_cancelled():
+            return len(checks) == len(requests) and all(check() for check in checks)
+
+        return self._generate_batch(prompts, is_cancelled=is_cancelled, **options)
+
+    def _get_batch_key(self, request: t.Dict) -> t.Tuple:
+        return tuple(
+            sorted((k, v) for k, v in request.items() if k not in BATCH_REQUEST_FIELDS)
+        )
+
+    def _generate_batch(
+        self,
+        prompts: t.List[str],
+        stop="```",
+        max_length=64,
+        temperature=0.2,
+        num_return_sequences=1,
+        max_time=0.0,
+        prefix="",
+        is_cancelled: t.Callable[[], bool] = None,
+    ) -> t.List[t.List[str]]:
+        """Generate completions for several prompts in a single call to
+        ``model.generate``. Prompts are left-padded to the same length.
+        Decoding stops early once ``is_cancelled`` returns True.
+
+        Returns:
+            List[List[str]]: ``num_return_sequences`` outputs for each prompt.
+        """
+        from transformers import StoppingCriteriaList
+
+        if is_cancelled is None:
+            is_cancelled = lambda: False
+
         # Tokenize input
-        input_ids = self.tokenizer(prompt, return_tensors="pt").input_ids.to(
+        inputs = self.tokenizer(prompts, return_tensors="pt", padding=True).to(
             self.device
         )
+        input_ids = inputs.input_ids
+
+        # Sample all candidates in a single batched call. Greedy decoding
+        # cannot return more than one sequence, so fall back to beam search
+        # when multiple candidates are requested with zero temperature.
+        generation_kwargs = {"attention_mask": inputs.attention_mask}
+        if temperature > 0:
+            generation_kwargs["do_sample"] = True
+            generation_kwargs["temperature"] = temperature
+        elif num_return_sequences > 1:
+            generation_kwargs["num_beams"] = num_return_sequences
+            generation_kwargs["early_stopping"] = True
+        if max_time > 0:
+            generation_kwargs["max_time"] = max_time
+
+        # Reuse the key/value cache of a previously seen prompt prefix.
+        # Expanding a cache for multiple return sequences, beams or padded
+        # batches is not supported, so only single-sequence generation takes
+        # this path.
+        #
+        # Assisted generation only supports a single sequence as well, and
+        # takes precedence over the prefix cache. Sampling with a draft model
+        # needs a recent version of transformers, see _load_draft_model.
+        assisted = (
+            self.draft_enabled
+            and len(prompts) == 1
+            and num_return_sequences == 1
+            and (temperature <= 0 or self.draft_sampling)
+            and self._use_draft()
+        )
+        if assisted:
+            generation_kwargs["assistant_model"] = self.draft_model
+        elif len(prompts) == 1 and num_return_sequences == 1:
+            past_key_values = self._get_prefix_past_key_values(input_ids, prefix)
+            if past_key_values is not None:
+                generation_kwargs[self._past_key_values_kwarg] = past_key_values
+
+        stopping_criteria = StoppingCriteriaList([CancellationCriteria(is_cancelled)])
+        if stop:
+            stopping_criteria.append(
+                StopSequenceCriteria(self.tokenizer, stop, input_ids.shape[1])
+            )
+
         # Generate
+        self._forward_calls.update(target=0, draft=0)
+        start = time.perf_counter()
         generated_ids = self.model.generate(
             input_ids,
-            max_length=max_length,
-            temperature=temperature,
+            # max_length would count the left padding of shorter prompts
+            max_new_tokens=max_length,
             num_return_sequences=num_return_sequences,
-            early_stopping=True,
-            eos_token_id=self.get_token_id(stop),
+            stopping_criteria=stopping_criteria,
+            pad_token_id=self.tokenizer.pad_token_id,
+            **generation_kwargs,
+        )
+        if len(prompts) == 1 and num_return_sequences == 1 and not is_cancelled():
+            # Only single-sequence throughput is comparable between plain
+            # and assisted generation
+            self._update_decoding_stats(
+                assisted,
+                generated_ids.shape[1] - input_ids.shape[1],
+                time.perf_counter() - start,
+            )
+        # Only decode the newly generated tokens
+        texts = self.tokenizer.batch_decode(
+            generated_ids[:, input_ids.shape[1] :], skip_special_tokens=True
         )
-        output = self.tokenizer.decode(generated_ids[0], skip_special_tokens=True)
 
-        # Postprocess
-        output = output[: -len(stop)]
-        output = output[len(prompt) :]
-        output = output.rstrip()
+        # Postprocess. Sequences of the same prompt are adjacent in the output.
+        outputs = [truncate_at_stop(text, stop).rstrip() for text in texts]
+        return [
+            outputs[i : i + num_return_sequences]
+            for i in range(0, len(outputs), num_return_sequences)
+        ]
+
+    def _get_prefix_past_key_values(self, input_ids, prefix: str):
+        """Compute the past key values of all but the last token of
+        ``input_ids``, which ``generate()`` feeds itself. Only the tokens
+        after the longest prefix shared with an earlier prompt are prefilled,
+        and the result is cached for the next prompts. This covers whatever
+        successive prompts have in common, e.g. ``prompt_prefix`` and the
+        start of the prompt template. Returns None if the model does not
+        support prefix reuse.
+        """
+        if (
+            self.prefix_cache.capacity <= 0
+            or self.initializer != "AutoModelForCausalLM"
+        ):
+            return None
+
+        import torch
 
-        return output
+        ids = input_ids[0].tolist()
+        if len(ids) < 2:
+            return None
 
-    def get_token_id(self, seq):
-        if seq in self.token_id_cache:
-            return self.token_id_cache[seq]
+        with torch.no_grad():
+            past_key_values, length = self.prefix_cache.get(ids)
+            if past_key_values is not None:
+                past_key_values = slice_past_key_values(past_key_values, length)
+                if past_key_values is None:
+                    length = 0
 
-        result = self.tokenizer(seq)
-        ids = result["input_ids"][1:]
-        assert len(ids) == 1
-        token_id = ids[0]
-        self.token_id_cache[seq] = token_id
+            if past_key_values is None and prefix:
+                prefix_ids = self.tokenizer(prefix).input_ids
+                # Only cache the prefix if it tokenizes identically on its own
+                if (
+                    0 < len(prefix_ids) < len(ids)
+                    and ids[: len(prefix_ids)] == prefix_ids
+                ):
+                    out = self.model(input_ids[:, : len(prefix_ids)], use_cache=True)
+                    past_key_values = to_legacy_past_key_values(out.past_key_values)
+                    length = len(prefix_ids)
+                    self.prefix_cache.put(prefix_ids, past_key_values)
 
-        return token_id
+            if length < len(ids) - 1:
+                out = self.model(
+                    input_ids[:, length:-1],
+                    past_key_values=past_key_values,
+                    attention_mask=torch.ones_like(input_ids[:, :-1]),
+                    use_cache=True,
+                )
+                past_key_values = to_legacy_past_key_values(out.past_key_values)
+                self.prefix_cache.put(ids[:-1], past_key_values)
+
+        # The tuples are never modified in place, generate() concatenates
+        # new tensors, so they can be handed out without copying
+        return past_key_values
+
+    @property
+    def _past_key_values_kwarg(self) -> str:
+        # Before transformers 4.27, generate() expects the cache as "past"
+        import inspect
+
+        parameters = inspect.signature(
+            self.model.prepare_inputs_for_generation
+        ).parameters
+        return "past_key_values" if "past_key_values" in parameters else "past"
+
+    def warmup(self):
+        # Run a few decoding steps so that lazy initialization and graph
+        # optimizations happen before the first prompt
+        self._generate(prompt="# ", max_length=8, temperature=0)
+
+    def get_status(self) -> t.Dict[str, t.Any]:
+        status = {
+            "model": self.model_id,
+            "initializer": self.initializer,
+            "device": self.device,
+            "weight_loading": self.weight_loading,
+            "tokens_per_s": _round(self.plain_stats.tokens_per_second),
+        }
+        if self.draft_model is not None:
+            status.update(
+                {
+                    "draft_model": self.draft_model_id,
+                    "draft_enabled": self.draft_enabled,
+                    "draft_acceptance_rate": _round(
+                        self.assisted_stats.acceptance_rate
+                    ),
+                    "assisted_tokens_per_s": _round(
+                        self.assisted_stats.tokens_per_second
+                    ),
+                }
+            )
+        status.update(super().get_status())
+        return status
 
     def get_outputs_from_result(
         self, generation_result: GenerationResult
@@ -0,0 +1,156 @@
+import requests
+
+import typing as t
+
+from icortex.context import ICortexContext
+from icortex.defaults import *
+from icortex.services import ServiceBase, ServiceVariable
+from icortex.services.generation_result import GenerationResult
+from icortex.services.service_interaction import ServiceInteraction
+
+DEFAULT_SERVER_URL = "http://127.0.0.1:8765"
+
+SERVER_UNAVAILABLE_MSG = """Could not connect to the ICortex generation server at {url}.
+
+Start it on this node by running the following in the directory of the
+icortex.toml that configures the services to be hosted:
+
+icortex serve-generation
+"""
+
+TYPE_NAME_TO_TYPE = {
+    "str": str,
+    "int": int,
+    "float": float,
+    "bool": bool,
+}
+
+
+class RemoteService(ServiceBase):
+    """Thin client that forwards generation requests to a generation server
+    started with ``icortex serve-generation``. The prompt arguments of the
+    hosted service are fetched from the server, so prompts accept the same
+    flags as they would with the hosted service itself.
+    """
+
+    name = "remote"
+    description = "Forward prompts to a shared ICortex generation server"
+    # The variables of the hosted service are fetched in __init__
+    dynamic_variables = True
+    variables = {
+        "url": ServiceVariable(
+            str,
+            default=DEFAULT_SERVER_URL,
+            help="URL of the generation server.",
+        ),
+        "backend": ServiceVariable(
+            str,
+            default="",
+            help="Name of the service hosted by the server to use. Leave empty to use the default service of the server.",
+        ),
+        "timeout": ServiceVariable(
+            float,
+            default=600.0,
+            help="Timeout for generation requests in seconds.",
+        ),
+    }
+
+    def __init__(self, **kwargs: t.Dict):
+        self.url = kwargs.get("url", DEFAULT_SERVER_URL).rstrip("/")
+        self.backend = kwargs.get("backend", "")
+        self.timeout = kwargs.get("timeout", 600.0)
+
+        spec = self._request("GET", f"/services/{self.backend}")
+        self.backend = spec["name"]
+        self.description = spec["description"]
+
+        # Expose the arguments of the hosted service in the prompt parser
+        self.variables = dict(RemoteService.variables)
+        for key, var in spec["variables"].items():
+            if key in self.variables:
+                continue
+            self.variables[key] = ServiceVariable(
+                TYPE_NAME_TO_TYPE.get(var["type"], str),
+                default=var["default"],
+                help=var["help"],
+                argparse_args=var["argparse_args"],
+            )
+
+        super(RemoteService, self).__init__(**kwargs)
+
+    def _request(self, method: str, path: str, **kwargs) -> t.Dict:
+        try:
+            response = requests.request(
+                method, self.url + path, timeout=self.timeout, **kwargs
+            )
+        except requests.exceptions.ConnectionError:
+            print(SERVER_UNAVAILABLE_MSG.format(url=self.url))
+            raise Exception("Generation server is not available")
+
+        response_dict = response.json()
+        if response.status_code != 200:
+            raise Exception(
+                f"There was an issue with generation: {response_dict.get('error', 'No message provided')}"
+            )
+        return response_dict
+
+    def generate(
+        self,
+        prompt: str,
+        args,
+        context: ICortexContext = None,
+    ) -> GenerationResult:
+        # The server checks its cache, which is shared by all kernels
+        payload = {
+            "service": self.backend,
+            "prompt": prompt,
+            "args": args.__dict__,
+        }
+        cached_request_dict = {
+            "service": self.name,
+            "backend": self.backend,
+            "data": payload,
+        }
+        if context is not None:
+            payload = {**payload, "context": context.to_dict(recent_only=True)}
+
+        result = self._request("POST", "/generate", json=payload)
+
+        response_dict = {
+            "generated_text": [{"text": code} for code in result["outputs"]],
+            "backend": {
+                "service": result["service"],
+                "generation_result": result["generation_result"],
+            },
+        }
+        return GenerationResult(cached_request_dict, response_dict)
+
+    def cache_interaction(
+        self,
+        interaction: ServiceInteraction,
+        cache_path: str = DEFAULT_CACHE_PATH,
+    ):
+        ret = super(RemoteService, self).cache_interaction(
+            interaction, cache_path=cache_path
+        )
+
+        # Store the interaction on the server as well, under the request of
+        # the hosted service, so that other kernels can reuse the result
+        backend = interaction.generation_result.response_dict["backend"]
+        interaction_dict = interaction.to_dict()
+        interaction_dict["generation_result"] = backend["generation_result"]
+        try:
+            self._request(
+                "POST",
+                "/interactions",
+                json={"service": backend["service"], "interaction": interaction_dict},
+            )
+        except Exception as e:
+            print(f"Could not store the interaction on the generation server: {e}")
+        return ret
+
+    def get_outputs_from_result(
+        self, generation_result: GenerationResult
+    ) -> t.List[str]:
+        ret = [i["text"] for i in generation_result.response_dict["generated_text"]]
+        return ret
@@ -1,22 +1,48 @@
 import os
 import argparse
 import json
+import sys
+import threading
+import time
 import typing as t
+from concurrent.futures import Future, TimeoutError
 from abc import ABC, abstractclassmethod
 
 from icortex.defaults import (
     DEFAULT_AUTO_EXECUTE,
     DEFAULT_AUTO_INSTALL_PACKAGES,
     DEFAULT_CACHE_PATH,
+    DEFAULT_ICORTEX_CONFIG_PATH,
     DEFAULT_QUIET,
+    DEFAULT_WHEELHOUSE_PATH,
 )
 from icortex.context import ICortexContext
-from icortex.helper import escape_quotes, highlight_python, prompt_input, yes_no_input
-from icortex.pypi import get_missing_modules, install_missing_packages
+from icortex.helper import (
+    escape_quotes,
+    get_pss,
+    get_rss,
+    highlight_python,
+    prompt_input,
+    yes_no_input,
+)
+from icortex.pypi import (
+    get_missing_modules,
+    install_missing_packages,
+    prefetch_missing_packages,
+)
 from icortex.services.generation_result import GenerationResult
 from icortex.services.service_interaction import ServiceInteraction
 from icortex.parser import lex_prompt
 
+#: Interval in seconds at which the elapsed time of a generation is shown
+PROGRESS_INTERVAL = 1.0
+
+
+class GenerationCancelled(Exception):
+    """Raised when a generation is cancelled, e.g. by a kernel interrupt."""
+
+    pass
+
 
 def is_str_repr(s: str):
     quotes = ["'", '"']
@@ -123,12 +149,21 @@ class ServiceBase(ABC):
     variables: t.Dict[str, ServiceVariable] = {}
     # This has stopped working, fix
     hidden: bool = False
+    # Set if some variables are only known once the service is instantiated,
+    # e.g. because they are fetched from a server
+    dynamic_variables: bool = False
+    # Set while a prompt is being generated, see :func:`cancel`
+    _cancel_event: threading.Event = None
+    # Holds the event of the generation that runs on the current thread
+    _cancel_local: threading.local = None
 
     def __init__(self, **kwargs: t.Dict[str, t.Any]):
         """Classes that derive from ServiceBase are always initialized with
         keyword arguments that contain values for the service variables.
         The values can come
         """
+        self._cancel_local = threading.local()
+
         # Create the prompt parser and add default arguments
         self.prompt_parser = argparse.ArgumentParser(
             add_help=False,
@@ -165,6 +200,8 @@ class ServiceBase(ABC):
         self.prompt_parser.description = self.description
 
         # Add service-specific variables
+        # Keep the parser actions, so that defaults can be updated in place
+        self._variable_actions: t.Dict[str, argparse.Action] = {}
         for key, var in self.variables.items():
             # If user has specified a value for the variable, use that
             # Otherwise, the default value will be used
@@ -173,11 +210,39 @@ class ServiceBase(ABC):
 
             # Omit secret arguments from the parser, but still read them
             if var.secret == False and len(var.argparse_args) > 0:
-                self.prompt_parser.add_argument(
+                self._variable_actions[key] = self.prompt_parser.add_argument(
                     *var.argparse_args,
                     **var.argparse_kwargs,
                 )
 
+    def set_variable(self, var_name: str, value) -> bool:
+        """Change the value of a variable without re-instantiating the
+        service.
+
+        Variables that can be passed in prompts are read at generation
+        time, so their default value and the prompt parser are updated in
+        place. Other variables are usually read in the constructor, e.g. to
+        load a model or create a client. Services can override this to
+        apply such variables in place as well.
+
+        Args:
+            var_name (str): Name of the variable.
+            value (Any): New value, of the type of the variable.
+
+        Returns:
+            bool: True if the value was applied, False if the service has
+            to be re-instantiated for it to take effect.
+        """
+        action = self._variable_actions.get(var_name)
+        if action is None:
+            return False
+
+        var = self.variables[var_name]
+        var.set_default(value)
+        action.default = var.default
+        action.help = var.argparse_kwargs["help"]
+        return True
+
     def find_cached_interaction(
         self,
         request_dict: t.Dict,
@@ -260,6 +325,113 @@ class ServiceBase(ABC):
             return_dict[key] = user_val
         return return_dict
 
+    def warmup(self):
+        """Prepare the service for the first prompt, e.g. by running a
+        tiny generation that triggers lazy initialization. Called from a
+        background thread when the kernel starts with warm-up enabled.
+        Does nothing by default.
+        """
+        pass
+
+    def close(self):
+        """Release the resources of the service, e.g. background threads.
+        Called by the kernel when the service is replaced by another one.
+        Does nothing by default.
+        """
+        pass
+
+    def cancel(self):
+        """Cancel the generation that is currently running. Called from the
+        main thread when the user interrupts a prompt, while :func:`generate`
+        is still running on a worker thread.
+
+        Sets an event that long-running services can poll with
+        :func:`is_cancelled`, e.g. from a stopping criterion. Services can
+        override this to also abort their in-flight requests. The result of
+        a cancelled generation is discarded either way.
+        """
+        if self._cancel_event is not None:
+            self._cancel_event.set()
+
+    def is_cancelled(self) -> bool:
+        """Whether the generation that is currently running was cancelled.
+        On the worker thread of a generation, this refers to that generation
+        even after the next prompt has started.
+        """
+        return self.get_cancel_check()()
+
+    def get_cancel_check(self) -> t.Callable[[], bool]:
+        """Get a function that tells whether the generation that is running
+        on the current thread was cancelled. Call it from :func:`generate`
+        and hand the result to other threads that work on the generation,
+        e.g. a batching thread, since :func:`is_cancelled` cannot tell there
+        which generation they work on.
+        """
+        event = getattr(self._cancel_local, "event", None) or self._cancel_event
+        if event is None:
+            return lambda: False
+        return event.is_set
+
+    def _generate_in_background(
+        self, prompt: str, args, context: ICortexContext = None
+    ) -> GenerationResult:
+        """Run :func:`generate` on a worker thread and show the elapsed time
+        while waiting for it, so that a kernel interrupt reaches the main
+        thread and can be turned into a cancellation.
+
+        Raises:
+            GenerationCancelled: If the generation was interrupted.
+        """
+        event = self._cancel_event = threading.Event()
+        future = Future()
+
+        def run():
+            # A cancelled generation can keep running after the next prompt
+            # replaced the event, so the worker keeps its own
+            if self._cancel_local is not None:
+                self._cancel_local.event = event
+            try:
+                future.set_result(self.generate(prompt, args, context=context))
+            except BaseException as e:
+                future.set_exception(e)
+
+        # A daemon thread, so that a generation that cannot be aborted does
+        # not keep the kernel alive after it is cancelled
+        worker = threading.Thread(target=run, name="icortex-generate", daemon=True)
+        start = time.monotonic()
+        worker.start()
+
+        progress = ""
+        try:
+            while True:
+                try:
+                    return future.result(timeout=PROGRESS_INTERVAL)
+                except TimeoutError:
+                    progress = f"\rGenerating... {time.monotonic() - start:.0f}s"
+                    sys.stdout.write(progress)
+                    sys.stdout.flush()
+        except KeyboardInterrupt:
+            self.cancel()
+            raise GenerationCancelled("Generation was cancelled")
+        finally:
+            if progress:
+                # Clear the progress line
+                sys.stdout.write("\r" + " " * len(progress) + "\r")
+                sys.stdout.flush()
+
+    def get_status(self) -> t.Dict[str, t.Any]:
+        """Get runtime information about the service, such as its memory
+        usage. Services can extend the returned dict with their own fields.
+
+        Returns:
+            Dict[str, Any]: Status fields, shown by ``%icortex service show``.
+        """
+        status = {"rss_mb": round(get_rss() / 2**20, 1)}
+        pss = get_pss()
+        if pss is not None:
+            status["pss_mb"] = round(pss / 2**20, 1)
+        return status
+
     def get_variable(self, var_name: str) -> ServiceVariable:
         """Get a variable by its name
 
@@ -307,7 +479,7 @@ class ServiceBase(ABC):
         args.prompt = " ".join(args.prompt)
 
         # Otherwise, generate with the prompt
-        generation_result = self.generate(
+        generation_result = self._generate_in_background(
             args.prompt,
             args,
             context=context,
@@ -323,6 +495,26 @@ class ServiceBase(ABC):
         # Search for any missing modules
         missing_modules = get_missing_modules(code_)
 
+        # Start downloading the missing packages while the user decides
+        # whether to install them. There is nothing to download offline
+        prefetch = None
+        install_options = {}
+        if len(missing_modules) > 0:
+            from icortex.config import ICortexConfig
+
+            conf = ICortexConfig(DEFAULT_ICORTEX_CONFIG_PATH)
+            wheelhouse = os.path.expanduser(
+                conf.get_packages_option("wheelhouse", DEFAULT_WHEELHOUSE_PATH)
+            )
+            offline = conf.get_packages_option("offline", False)
+            install_options = {
+                "installer": conf.get_packages_option("installer", "auto"),
+                "wheelhouse": wheelhouse,
+                "offline": offline,
+            }
+            if conf.get_packages_option("prefetch", False) and not offline:
+                prefetch = prefetch_missing_packages(code_, wheelhouse)
+
         install_packages_yesno = False
         if len(missing_modules) > 0 and not args.auto_install_packages:
             install_packages_yesno = yes_no_input(
@@ -334,7 +526,9 @@ class ServiceBase(ABC):
         if install_packages:
             # Unresolved modules are modules that cannot be mapped
             # to any PyPI packages according to the local data in this library
-            unresolved_modules = install_missing_packages(code_)
+            unresolved_modules = install_missing_packages(
+                code_, prefetch=prefetch, **install_options
+            )
             if len(unresolved_modules) > 0:
                 print(
                     f"""The following imported modules could not be resolved to PyPI packages: {', '.join(unresolved_modules)}
@@ -93,7 +93,7 @@ class TextCortexService(ServiceBase):
             "template_name": "icortex",
             "prompt": {
                 "instruction": prompt,
-                "context": context.to_dict() if context else {},
+                "context": context.to_dict(recent_only=True) if context else {},
             },
             "temperature": args.temperature,
             "token_count": args.token_count,
@@ -0,0 +1,79 @@
+import threading
+
+import pytest
+
+from icortex.services.batching import MicroBatcher
+
+
+def test_concurrent_requests_are_batched():
+    batches = []
+
+    def process_batch(requests):
+        batches.append(list(requests))
+        return [r * 2 for r in requests]
+
+    # The window is long enough for all requests to be queued
+    batcher = MicroBatcher(process_batch, window=0.5, max_batch_size=4)
+    futures = [batcher.submit(i) for i in range(4)]
+
+    assert [f.result(timeout=5) for f in futures] == [0, 2, 4, 6]
+    assert batches == [[0, 1, 2, 3]]
+
+
+def test_max_batch_size():
+    batches = []
+    lock = threading.Lock()
+
+    def process_batch(requests):
+        with lock:
+            batches.append(list(requests))
+        return requests
+
+    batcher = MicroBatcher(process_batch, window=0.5, max_batch_size=2)
+    futures = [batcher.submit(i) for i in range(5)]
+
+    assert [f.result(timeout=5) for f in futures] == [0, 1, 2, 3, 4]
+    assert all(len(batch) <= 2 for batch in batches)
+
+
+def test_requests_are_grouped_by_key():
+    batches = []
+
+    def process_batch(requests):
+        batches.append([r["value"] for r in requests])
+        return [r["value"] for r in requests]
+
+    batcher = MicroBatcher(
+        process_batch, window=0.5, max_batch_size=8, key=lambda r: r["key"]
+    )
+    futures = [
+        batcher.submit({"key": "a", "value": 1}),
+        batcher.submit({"key": "b", "value": 2}),
+        batcher.submit({"key": "a", "value": 3}),
+    ]
+
+    assert [f.result(timeout=5) for f in futures] == [1, 2, 3]
+    assert sorted(batches) == [[1, 3], [2]]
+
+
+def test_errors_are_routed_to_callers():
+    def process_batch(requests):
+        raise ValueError("model failed")
+
+    batcher = MicroBatcher(process_batch, window=0.01, max_batch_size=8)
+    future = batcher.submit(1)
+
+    with pytest.raises(ValueError):
+        future.result(timeout=5)
+
+
+def test_close():
+    batcher = MicroBatcher(lambda requests: requests, window=0.01, max_batch_size=8)
+    future = batcher.submit(1)
+    batcher.close()
+
+    # Requests that were submitted before closing are still processed
+    assert future.result(timeout=5) == 1
+    assert not batcher._thread.is_alive()
+    with pytest.raises(RuntimeError):
+        batcher.submit(2)
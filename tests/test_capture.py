@@ -0,0 +1,37 @@
+import sys
+
+from icortex.capture import StreamRecorder, capture_streams
+
+
+def test_capture_streams_forwards_and_records(capsys):
+    with capture_streams() as captured:
+        print("out 1")
+        print("out 2")
+        print("err", file=sys.stderr)
+
+    # Output is still shown while it is captured
+    assert capsys.readouterr() == ("out 1\nout 2\n", "err\n")
+    assert captured.outputs == [
+        {"output_type": "stream", "name": "stdout", "text": ["out 1\n", "out 2\n"]},
+        {"output_type": "stream", "name": "stderr", "text": ["err\n"]},
+    ]
+
+
+def test_stream_recorder_keeps_head_and_tail():
+    recorder = StreamRecorder(limit=10)
+    for i in range(1000):
+        recorder.write(f"{i % 10}")
+
+    assert recorder.size == 1000
+    assert recorder.truncated == 990
+    value = recorder.getvalue()
+    assert value.startswith("01234\n")
+    assert value.endswith("\n56789")
+    assert "990 bytes truncated" in value
+
+
+def test_stream_recorder_without_limit():
+    recorder = StreamRecorder(limit=0)
+    recorder.write("a" * 100)
+    assert recorder.getvalue() == "a" * 100
+    assert recorder.truncated == 0
@@ -0,0 +1,122 @@
+from icortex.cell_cache import CellCache
+from icortex.context import ICortexContext
+from icortex.var import Var
+
+
+def test_cached_run(tmp_path, capsys):
+    context = ICortexContext()
+    success = {"success": True}
+    var = Var("n", "_n", 1, "int")
+    context.define_var(var)
+    context.add_var_cell("%var n 1", var, var.get_code(), [], execution_result=success)
+    for code in [
+        "print('a')\na = [1, 2]",
+        "print('b')\nb = sum(a) * _n",
+        "print('result', b)",
+    ]:
+        context.add_code_cell(code, [], execution_result=success)
+
+    cache_path = str(tmp_path / "cache")
+    context.run(["1"], cache_path=cache_path)
+    assert capsys.readouterr().out == "a\nb\nresult 3\n"
+
+    # Nothing changed, so every cell is loaded from the cache
+    context.run(["1"], cache_path=cache_path)
+    assert capsys.readouterr().out == ""
+
+    # Only the cells that depend on the variable are executed again
+    context.run(["2"], cache_path=cache_path, jobs=2)
+    assert capsys.readouterr().out == "b\nresult 6\n"
+
+
+def run_cached(codes, cache_path):
+    scope = {}
+    run_cell, _ = CellCache(cache_path).prepare(codes, scope)
+    loaded = [run_cell(idx) for idx in range(len(codes))]
+    return scope, loaded
+
+
+def test_cells_that_mutate_earlier_objects(tmp_path):
+    cache_path = str(tmp_path / "cache")
+
+    def get_codes(n):
+        return [
+            f"_n = {n}",
+            "import random\nitems = list(range(10))",
+            "random.seed(_n)\nrandom.shuffle(items)",
+            "first = items[0]",
+        ]
+
+    scope, loaded = run_cached(get_codes(1), cache_path)
+    first = scope["first"]
+    scope, loaded = run_cached(get_codes(1), cache_path)
+    assert scope["first"] == first
+    # The shuffle mutates items from an earlier cell, so it is executed
+    assert loaded == [True, True, False, True]
+
+    scope, loaded = run_cached(get_codes(2), cache_path)
+    assert scope["first"] == scope["items"][0]
+    assert loaded == [False, True, False, False]
+
+    # The state of the module is not stored, and the next cell uses it
+    codes = ["import random\nrandom.seed(1)", "import random\nx = random.random()"]
+    run_cached(codes, cache_path)
+    scope, loaded = run_cached(codes, cache_path)
+    assert loaded == [False, True]
+
+    # Aliases of earlier objects are not stored
+    codes = ["a = [1]", "b = a", "b.append(2)"]
+    scope, loaded = run_cached(codes, cache_path)
+    scope, loaded = run_cached(codes, cache_path)
+    assert loaded == [True, False, False]
+    assert scope["a"] == [1, 2]
+
+
+def test_cells_that_mutate_through_aliases(tmp_path):
+    cache_path = str(tmp_path / "cache")
+
+    def get_codes(n):
+        return [
+            "lists = [[], []]",
+            "for lst in lists:\n    lst.append(1)",
+            f"total = sum(len(l) for l in lists) * {n}",
+        ]
+
+    run_cached(get_codes(10), cache_path)
+    # Only the last cell changed, but the loop mutates lists from an earlier
+    # cell, so it is executed again
+    scope, loaded = run_cached(get_codes(20), cache_path)
+    assert loaded == [True, False, False]
+    assert scope["total"] == 40
+    assert scope["lists"] == [[1], [1]]
+
+    # Items of earlier objects are not stored, since they would be loaded
+    # as copies
+    codes = ["lists = [[], []]", "first = lists[0]", "first.append(2)"]
+    run_cached(codes, cache_path)
+    scope, loaded = run_cached(codes, cache_path)
+    assert loaded == [True, False, False]
+    assert scope["lists"] == [[2], []]
+
+    # Files that cells write are not stored
+    path = tmp_path / "data.txt"
+    codes = [
+        f"with open({str(path)!r}, 'w') as f:\n    f.write('1')",
+        f"x = open({str(path)!r}).read()",
+    ]
+    run_cached(codes, cache_path)
+    path.unlink()
+    scope, loaded = run_cached(codes, cache_path)
+    assert loaded == [False, True]
+    assert path.read_text() == "1"
+
+
+def test_cache_eviction(tmp_path):
+    cache = CellCache(str(tmp_path), max_size=600)
+    scope = {"x": "x" * 200}
+    for key in ["a", "b", "c"]:
+        cache.store(key, scope, ["x"])
+        assert cache.load(key, {})
+
+    # The least recently used entry is deleted
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["b.pkl", "c.pkl"]
@@ -0,0 +1,96 @@
+import gc
+import json
+import os
+import tempfile
+import weakref
+
+from IPython.core.interactiveshell import ExecutionInfo, ExecutionResult
+
+from icortex.context import ICortexContext
+
+
+class Large:
+    def __repr__(self):
+        return "Large()" + "x" * 10000
+
+
+def test_history_does_not_keep_results_alive():
+    value = Large()
+    ref = weakref.ref(value)
+
+    result = ExecutionResult(ExecutionInfo("value", False, None, None, None))
+    result.result = value
+    context = ICortexContext()
+    cell = context.add_code_cell("value", [], execution_result=result)
+
+    del value, result
+    gc.collect()
+    assert ref() is None
+
+    assert cell.success
+    assert cell.execution_result["result"].startswith("Large()xxx")
+    assert len(cell.execution_result["result"]) <= 1000
+
+
+def test_history_does_not_keep_exception_frames_alive():
+    def fail():
+        local = Large()
+        raise ValueError(weakref.ref(local))
+
+    result = ExecutionResult(ExecutionInfo("fail()", False, None, None, None))
+    try:
+        fail()
+    except ValueError as e:
+        result.error_in_exec = e
+        ref = e.args[0]
+    context = ICortexContext()
+    cell = context.add_code_cell("fail()", [], execution_result=result)
+
+    del result
+    gc.collect()
+    assert ref() is None
+
+    assert not cell.success
+    assert cell.execution_result["error_in_exec"]["name"] == "ValueError"
+    assert "fail" in cell.execution_result["error_in_exec"]["traceback"]
+
+
+def test_history_spills_old_cells_to_journal(tmp_path):
+    journal_path = str(tmp_path / "journal.jsonl")
+    context = ICortexContext(window=2, journal_path=journal_path)
+    for i in range(5):
+        context.add_code_cell(f"x = {i}", [])
+
+    assert len(context._cells) == 2
+    assert len(context) == 5
+    assert [cell.get_code() for cell in context.iter_cells()] == [
+        f"x = {i}" for i in range(5)
+    ]
+    assert len(context.to_dict()["cells"]) == 5
+    assert len(context.to_dict(recent_only=True)["cells"]) == 2
+
+    path = str(tmp_path / "notebook.icx")
+    context.save_to_file(path)
+    with open(path) as f:
+        assert json.load(f) == context.to_dict()
+    loaded = ICortexContext.from_file(path)
+    assert [cell.get_code() for cell in loaded.iter_cells()] == [
+        f"x = {i}" for i in range(5)
+    ]
+
+    context.close()
+    assert not (tmp_path / "journal.jsonl").exists()
+
+
+def test_history_journal_defaults_to_temp_file(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    context = ICortexContext(window=1)
+    context.add_code_cell("x = 0", [])
+    context.add_code_cell("x = 1", [])
+
+    journal_path = context.journal_path
+    assert os.path.dirname(journal_path) == tempfile.gettempdir()
+    assert list(tmp_path.iterdir()) == []
+
+    context.close()
+    assert not os.path.exists(journal_path)
@@ -0,0 +1,173 @@
+import threading
+
+import pytest
+
+from icortex.dependency import (
+    build_dependency_graph,
+    get_cell_dependencies,
+    run_in_parallel,
+)
+
+
+def test_cell_dependencies():
+    deps = get_cell_dependencies(
+        "import numpy as np\n"
+        "x = np.zeros(n)\n"
+        "data.append(x)\n"
+        "y = [i * k for i in range(3)]\n"
+        "def f(a):\n"
+        "    b = a + offset\n"
+        "    return b\n"
+    )
+    # np.zeros and data.append may mutate their arguments
+    assert deps.writes == {"np", "x", "y", "f", "n"}
+    assert "data" in deps.method_targets
+    assert deps.called_methods == {"zeros", "append"}
+    assert {"np", "n", "data", "x", "k"} <= deps.reads
+    assert "b" not in deps.writes and "i" not in deps.writes
+    assert deps.imports == {"np": "numpy"}
+    # The body of f only reads offset when f is called
+    assert "offset" not in deps.reads
+    assert "offset" in deps.function_effects["f"].reads
+
+    assert get_cell_dependencies("from os import *") is None
+    assert get_cell_dependencies("exec('x = 1')") is None
+    assert get_cell_dependencies("%pip install numpy") is None
+
+
+def test_dependency_graph():
+    codes = [
+        "a = 1",
+        "b = 2",
+        "c = a + b",
+        "a = 3",  # Has to wait for c to read the old a
+        "def f():\n    return b\n",  # Only reads b when called
+        "d = f()",
+        "%magic",
+        "e = 1",
+    ]
+    graph = build_dependency_graph([get_cell_dependencies(code) for code in codes])
+    assert graph == [set(), set(), {0, 1}, {0, 2}, set(), {1, 4}, set(range(6)), {6}]
+
+    # Loading data with the same module in two cells
+    codes = [
+        "import pandas as pd\nx = pd.read_csv('x.csv')",
+        "import pandas as pd\ny = pd.read_csv('y.csv')",
+        "x.fit(y)",
+    ]
+    graph = build_dependency_graph([get_cell_dependencies(code) for code in codes])
+    # Functions of a module may change the state of the module
+    assert graph == [set(), {0}, {0, 1}]
+
+
+def get_graph(codes):
+    return build_dependency_graph([get_cell_dependencies(code) for code in codes])
+
+
+def test_dependency_graph_indirect_effects():
+    # Lambdas read when they are called
+    assert get_graph(
+        ["counter = 0", "g = lambda: counter", "counter = 5", "print(g())"]
+    ) == [set(), set(), {0}, {1, 2}]
+
+    # Methods of classes. Creating an instance may call any of them
+    assert get_graph(
+        [
+            "items = []",
+            "class C:\n    def add(self):\n        items.append(1)\n",
+            "c = C()",
+            "print(items)",
+            "c.add()",
+        ]
+    ) == [set(), set(), {0, 1}, {2}, {2, 3}]
+
+    # Arguments that are mutated by functions
+    assert get_graph(
+        [
+            "import random\nitems = list(range(10))",
+            "random.shuffle(items)",
+            "first = items[0]",
+        ]
+    ) == [set(), {0}, {1}]
+    assert get_graph(
+        ["data = [2, 1]", "def f(l):\n    l.sort()\n", "f(data)", "print(data)"]
+    ) == [set(), set(), {0, 1}, {2}]
+
+    # Functions of modules
+    assert get_graph(
+        [
+            "import matplotlib.pyplot as plt",
+            "plt.plot([1, 2])",
+            "plt.savefig('plot.png')",
+        ]
+    ) == [set(), {0}, {1}]
+
+
+def test_dependency_graph_aliases():
+    # Mutating objects through names bound to them or to their items
+    assert get_graph(
+        ["items = []", "alias = items\nalias.append(1)", "print(len(items))"]
+    ) == [set(), {0}, {1}]
+    assert get_graph(
+        ["items = []", "alias = items", "alias.append(1)", "print(len(items))"]
+    ) == [set(), {0}, {0, 1}, {2}]
+    deps = get_cell_dependencies(
+        "for key, values in d.items():\n    values.append(key)"
+    )
+    assert "d" in deps.method_targets
+    assert deps.aliases == {"key": {"d"}, "values": {"d"}}
+
+    # The mutated objects are read through the alias as well
+    assert get_graph(
+        ["items = []", "alias = items", "items.append(1)", "print(alias)"]
+    )[3] == {1, 2}
+
+
+def test_dependency_graph_files():
+    codes = [
+        "with open('data.txt', 'w') as f:\n    f.write('1')",
+        "print(open('data.txt').read())",
+        "import json\nconfig = json.load(open('config.json'))",
+        "df.to_csv('data.csv')",
+    ]
+    # Reading files does not order cells among each other
+    assert get_graph(codes) == [set(), {0}, {0}, {0, 1, 2}]
+
+
+def test_run_in_parallel():
+    # Both cells wait for each other, so they can only finish if they run
+    # at the same time
+    barrier = threading.Barrier(2, timeout=5)
+    codes = [
+        "wait()\na = 1",
+        "wait()\nb = 2",
+        "c = a + b",
+    ]
+    scope = {"wait": barrier.wait}
+    run_in_parallel(codes, scope, jobs=2)
+    assert scope["c"] == 3
+
+
+def test_run_in_parallel_error():
+    scope = {}
+    codes = ["a = 1", "b = 1 / 0", "c = b + 1"]
+    with pytest.raises(ZeroDivisionError):
+        run_in_parallel(codes, scope, jobs=2)
+    assert "c" not in scope
+
+
+def test_run_in_parallel_loop_mutation():
+    class Model:
+        def fit(self):
+            # Give the next cell a chance to run too early
+            threading.Event().wait(0.05)
+            self.coef_ = 1
+
+    codes = [
+        "models = [Model(), Model()]",
+        "for model in models:\n    model.fit()",
+        "coefs = [getattr(x, 'coef_', None) for x in models]",
+    ]
+    scope = {"Model": Model}
+    run_in_parallel(codes, scope, jobs=2)
+    assert scope["coefs"] == [1, 1]
@@ -0,0 +1,433 @@
+import os
+import sys
+import threading
+import types
+from contextlib import nullcontext
+
+import pytest
+
+from icortex.services import huggingface
+from icortex.services.huggingface import (
+    DecodingStats,
+    HuggingFaceAutoService,
+    PrefixCache,
+    StopSequenceCriteria,
+    get_model_initializer,
+    has_onnx_weights,
+    parse_cpu_list,
+    parse_version,
+    set_process_affinity,
+    truncate_at_stop,
+)
+
+
+def test_truncate_at_stop():
+    assert truncate_at_stop("print(1)\n```\nmore", "```") == "print(1)\n"
+    assert truncate_at_stop("print(1)", "```") == "print(1)"
+    assert truncate_at_stop("print(1)", "") == "print(1)"
+
+
+def test_prefix_cache_longest_match():
+    cache = PrefixCache(4)
+    cache.put([1, 2], "short")
+    cache.put([1, 2, 3], "long")
+
+    assert cache.get([1, 2, 3, 4]) == ("long", 3)
+    assert cache.get([1, 2, 5]) == ("short", 2)
+    # The whole input is never a match, something has to be left to prefill
+    assert cache.get([1, 2, 3]) == ("short", 2)
+    assert cache.get([7, 8, 9]) == (None, 0)
+
+
+def test_prefix_cache_partial_match():
+    # Earlier prompts are reused for the part they share with a new prompt
+    cache = PrefixCache(4)
+    cache.put([1, 2, 3, 4], "prompt")
+    assert cache.get([1, 2, 9, 9]) == ("prompt", 2)
+
+
+def test_prefix_cache_eviction():
+    cache = PrefixCache(2)
+    cache.put([1], "a")
+    cache.put([2], "b")
+    # Touch [1] so that [2] becomes the least recently used entry
+    assert cache.get([1, 0]) == ("a", 1)
+    cache.put([3], "c")
+
+    assert cache.get([2, 0]) == (None, 0)
+    assert cache.get([1, 0]) == ("a", 1)
+    assert cache.get([3, 0]) == ("c", 1)
+
+
+def test_prefix_cache_disabled():
+    cache = PrefixCache(0)
+    cache.put([1], "a")
+    assert cache.get([1, 0]) == (None, 0)
+
+
+def test_parse_cpu_list():
+    assert parse_cpu_list("0-3,8,10-11") == {0, 1, 2, 3, 8, 10, 11}
+    assert parse_cpu_list(" 4 , 5 ") == {4, 5}
+    assert parse_cpu_list("") == set()
+
+
+def test_parse_version():
+    assert parse_version("4.24.0") == (4, 24, 0)
+    assert parse_version("4.29.0.dev0") == (4, 29, 0)
+    assert parse_version("4.31.0rc1") == (4, 31, 0)
+    assert parse_version("unknown") == ()
+    assert parse_version("4.24.0") < parse_version("4.29.0")
+
+
+@pytest.mark.skipif(
+    not hasattr(os, "sched_setaffinity"), reason="CPU affinity is Linux only"
+)
+def test_set_process_affinity():
+    orig = os.sched_getaffinity(0)
+    target = {min(orig)}
+    started, pinned = threading.Event(), threading.Event()
+    affinity = {}
+
+    def run():
+        started.set()
+        pinned.wait(5)
+        affinity["thread"] = os.sched_getaffinity(0)
+
+    # A thread that is already running is pinned as well
+    thread = threading.Thread(target=run)
+    thread.start()
+    started.wait(5)
+    try:
+        set_process_affinity(target)
+        pinned.set()
+        thread.join(5)
+        assert affinity["thread"] == target
+        assert os.sched_getaffinity(0) == target
+    finally:
+        pinned.set()
+        set_process_affinity(orig)
+
+
+def test_decoding_stats_acceptance_rate():
+    stats = DecodingStats()
+    assert stats.acceptance_rate is None
+    assert stats.tokens_per_second is None
+
+    # 4 verification steps produced 10 tokens from 8 draft proposals, so 6
+    # of the proposals were accepted
+    stats.update(10, 2.0, target_calls=4, draft_calls=8)
+    assert stats.acceptance_rate == 0.75
+    assert stats.tokens_per_second == 5.0
+
+
+def test_model_revision_from_local_cache(tmp_path, monkeypatch):
+    # A model in the local cache is resolved without going online
+    from icortex.services import huggingface
+
+    repo_dir = tmp_path / "models--org--model"
+    monkeypatch.setattr(
+        huggingface, "_get_repo_cache_dir", lambda model_id: str(repo_dir)
+    )
+    (repo_dir / "refs").mkdir(parents=True)
+    (repo_dir / "refs" / "main").write_text("abc123")
+    (repo_dir / "snapshots" / "abc123").mkdir(parents=True)
+    (repo_dir / "snapshots" / "abc123" / "pytorch_model.bin").write_text("")
+
+    revision, files = huggingface.get_model_revision("org/model")
+    assert revision == "abc123"
+    assert files == ["pytorch_model.bin"]
+
+    assert huggingface.get_artifact_tag("pytest").startswith("pytest-")
+
+
+def test_shipped_onnx_weights():
+    files = ["config.json", "pytorch_model.bin", "model.onnx"]
+    # PyTorch weights take precedence, but shipped ONNX weights are found
+    assert get_model_initializer("org/model", files=files) == "AutoModelForCausalLM"
+    assert has_onnx_weights(files)
+    assert not has_onnx_weights(["config.json", "pytorch_model.bin"])
+
+
+class StubORTModel:
+    calls = []
+
+    @classmethod
+    def from_pretrained(cls, model_id, **kwargs):
+        # Mirrors the signature of optimum 1.5, which has no revision
+        # parameter, so that passing it twice fails like it does there
+        cls.calls.append((model_id, kwargs))
+        return cls()
+
+    def save_pretrained(self, save_dir):
+        with open(os.path.join(save_dir, "model.onnx"), "w") as f:
+            f.write("")
+
+
+@pytest.fixture
+def stub_optimum(monkeypatch):
+    module = types.ModuleType("optimum.onnxruntime")
+    module.ORTModelForCausalLM = StubORTModel
+    monkeypatch.setitem(sys.modules, "optimum", types.ModuleType("optimum"))
+    monkeypatch.setitem(sys.modules, "optimum.onnxruntime", module)
+    StubORTModel.calls = []
+    return StubORTModel
+
+
+def test_load_ort_model_revision(stub_optimum):
+    huggingface.load_ort_model("org/model", revision="abc", session_options=None)
+    huggingface.load_ort_model("/path/to/onnx", file_name="model_quantized.onnx")
+    assert stub_optimum.calls == [
+        ("org/model@abc", {"session_options": None}),
+        ("/path/to/onnx", {"file_name": "model_quantized.onnx"}),
+    ]
+
+
+def test_export_onnx_model(stub_optimum, tmp_path, monkeypatch):
+    monkeypatch.setattr(huggingface, "get_package_version", lambda name: "1.5.0")
+    onnx_dir = huggingface.export_onnx_model("org/model", "abc", str(tmp_path))
+    assert os.path.exists(os.path.join(onnx_dir, "model.onnx"))
+    # The export is cached
+    huggingface.export_onnx_model("org/model", "abc", str(tmp_path))
+    assert stub_optimum.calls == [("org/model@abc", {"from_transformers": True})]
+
+    monkeypatch.setattr(huggingface, "get_package_version", lambda name: "1.7.3")
+    huggingface.load_ort_model("org/model", revision="abc", export=True)
+    assert stub_optimum.calls[-1] == ("org/model@abc", {"export": True})
+
+
+@pytest.fixture
+def stub_transformers(monkeypatch):
+    class AutoModelForCausalLM:
+        loaded = []
+
+        @classmethod
+        def from_config(cls, config):
+            return "model without weights"
+
+        @classmethod
+        def from_pretrained(cls, model_id, revision=None):
+            cls.loaded.append((model_id, revision))
+            return "model"
+
+    module = types.ModuleType("transformers")
+    module.AutoModelForCausalLM = AutoModelForCausalLM
+    module.AutoConfig = types.SimpleNamespace(from_pretrained=lambda *a, **k: None)
+    modeling_utils = types.ModuleType("transformers.modeling_utils")
+    modeling_utils.no_init_weights = nullcontext
+    monkeypatch.setitem(sys.modules, "transformers", module)
+    monkeypatch.setitem(sys.modules, "transformers.modeling_utils", modeling_utils)
+    monkeypatch.setattr(huggingface, "_skip_torch_init", nullcontext)
+    return AutoModelForCausalLM
+
+
+def test_mmap_model_falls_back(stub_transformers, monkeypatch):
+    def missing_safetensors(*args):
+        raise ImportError("cannot import name 'save_model'")
+
+    monkeypatch.setattr(huggingface, "get_safetensors_files", missing_safetensors)
+    assert huggingface.load_mmap_model("org/model", "abc", "") == "model"
+
+    def shape_mismatch(model, tensors):
+        raise ValueError("Shape mismatch for lm_head.weight")
+
+    monkeypatch.setattr(huggingface, "get_safetensors_files", lambda *a: ["x"])
+    monkeypatch.setattr(huggingface, "mmap_safetensors", lambda path: {})
+    monkeypatch.setattr(huggingface, "_assign_tensors", shape_mismatch)
+    assert huggingface.load_mmap_model("org/model", "abc", "") == "model"
+    assert stub_transformers.loaded == [("org/model", "abc")] * 2
+
+
+class FakeTensor:
+    """2D tensor of token ids, with the indexing that the criteria and
+    _generate_batch use."""
+
+    def __init__(self, rows):
+        self.rows = [list(row) for row in rows]
+
+    @property
+    def shape(self):
+        return (len(self.rows), len(self.rows[0]) if self.rows else 0)
+
+    def __getitem__(self, index):
+        if isinstance(index, tuple):
+            rows, cols = index
+            return FakeTensor([row[cols] for row in self.rows[rows]])
+        return FakeTensor([self.rows[index]])
+
+    def tolist(self):
+        return self.rows[0] if len(self.rows) == 1 else self.rows
+
+    def to(self, device):
+        return self
+
+
+class CharTokenizer:
+    """Tokenizer with one token per character, and some tokens that stand
+    for several characters."""
+
+    pad_token_id = 0
+    vocab = {1000: "``", 1001: "`\n"}
+
+    def encode(self, text):
+        return [ord(c) for c in text]
+
+    def decode(self, ids, skip_special_tokens=False):
+        if isinstance(ids, FakeTensor):
+            ids = ids.tolist()
+        return "".join(
+            self.vocab.get(i, chr(i))
+            for i in ids
+            if not (skip_special_tokens and i == self.pad_token_id)
+        )
+
+    def batch_decode(self, ids, skip_special_tokens=False):
+        return [self.decode(row, skip_special_tokens) for row in ids.rows]
+
+    def __call__(self, texts, return_tensors=None, padding=False):
+        rows = [self.encode(text) for text in texts]
+        length = max(len(row) for row in rows)
+        # Left padding
+        rows = [[self.pad_token_id] * (length - len(row)) + row for row in rows]
+        mask = [[int(i != self.pad_token_id) for i in row] for row in rows]
+        return types.SimpleNamespace(
+            input_ids=FakeTensor(rows),
+            attention_mask=FakeTensor(mask),
+            to=lambda device: types.SimpleNamespace(
+                input_ids=FakeTensor(rows), attention_mask=FakeTensor(mask)
+            ),
+        )
+
+
+def test_stop_sequence_spanning_tokens():
+    tokenizer = CharTokenizer()
+    prompt = tokenizer.encode("x=")
+    criteria = StopSequenceCriteria(tokenizer, "```", len(prompt))
+
+    # The stop string is split into the tokens "`" and "``"
+    steps = [ord("1"), ord("`"), 1000]
+    for i in range(1, len(steps)):
+        assert not criteria(FakeTensor([prompt + steps[:i]]), None)
+    assert criteria(FakeTensor([prompt + steps]), None)
+
+    # The prompt is never matched against
+    prompt = tokenizer.encode("```")
+    criteria = StopSequenceCriteria(tokenizer, "```", len(prompt))
+    assert not criteria(FakeTensor([prompt + [ord("a")]]), None)
+
+
+def test_stop_sequence_per_row():
+    tokenizer = CharTokenizer()
+    stop = [ord(c) for c in "```"]
+    criteria = StopSequenceCriteria(tokenizer, "```", 0)
+    rows = [[ord("a")] + stop, [ord("b"), ord("c")]]
+    assert not criteria(FakeTensor(rows), None)
+
+    # The first row keeps generating past the stop string, which is now out
+    # of the window, while the second row reaches it
+    rows = [rows[0] + [ord("d")] * 4, rows[1] + [ord("e")] * 3 + stop]
+    assert criteria(FakeTensor(rows), None)
+
+    # Beam search swapped the rows, and replaced the beam that contained the
+    # stop string with one that does not
+    criteria = StopSequenceCriteria(tokenizer, "```", 0)
+    assert not criteria(FakeTensor([[ord("a")] + stop, [ord("b")] * 4]), None)
+    rows = [[ord("b")] * 5, [ord("a")] + stop + [ord("d")]]
+    assert not criteria(FakeTensor(rows), None)
+
+
+class StubGenerationModel:
+    """Returns the candidates of each prompt adjacent to each other, each
+    followed by a stop string and more text. Decoding ends early when the
+    stopping criteria are met."""
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.calls = []
+
+    def generate(
+        self, input_ids, num_return_sequences=1, stopping_criteria=(), **kwargs
+    ):
+        self.calls.append(dict(kwargs, num_return_sequences=num_return_sequences))
+        rows = []
+        for i, prompt in enumerate(input_ids.rows):
+            for j in range(num_return_sequences):
+                text = f"c{i}{j}\n```\nmore"
+                rows.append(prompt + self.tokenizer.encode(text))
+        ids = FakeTensor(rows)
+        for length in range(input_ids.shape[1] + 1, ids.shape[1]):
+            if any(criteria(ids[:, :length], None) for criteria in stopping_criteria):
+                self.calls[-1]["stopped"] = True
+                return ids[:, :length]
+        return ids
+
+
+@pytest.fixture
+def stub_service(monkeypatch):
+    transformers = types.ModuleType("transformers")
+    transformers.StoppingCriteriaList = list
+    monkeypatch.setitem(sys.modules, "transformers", transformers)
+
+    service = HuggingFaceAutoService.__new__(HuggingFaceAutoService)
+    service.tokenizer = CharTokenizer()
+    service.model = StubGenerationModel(service.tokenizer)
+    service.device = "cpu"
+    service.initializer = "ORTModelForCausalLM"
+    service.draft_enabled = False
+    service._draft_turns = 0
+    service.plain_stats = DecodingStats()
+    service.assisted_stats = DecodingStats()
+    service._forward_calls = {"target": 0, "draft": 0}
+    service.prefix_cache = PrefixCache(0)
+    return service
+
+
+def test_generate_batch_candidates(stub_service):
+    outputs = stub_service._generate_batch(
+        ["a", "longer"], stop="```", temperature=0.5, num_return_sequences=3
+    )
+    assert outputs == [["c00", "c01", "c02"], ["c10", "c11", "c12"]]
+    assert stub_service.model.calls[-1]["do_sample"]
+    assert stub_service.model.calls[-1]["max_new_tokens"] == 64
+    assert stub_service.model.calls[-1]["stopped"]
+
+    # Greedy decoding falls back to beam search for several candidates
+    outputs = stub_service._generate_batch(
+        ["a"], stop="```", temperature=0, num_return_sequences=2
+    )
+    assert outputs == [["c00", "c01"]]
+    assert stub_service.model.calls[-1]["num_beams"] == 2
+
+    outputs = stub_service._generate_batch(["a"], stop="", temperature=0)
+    assert outputs == [["c00\n```\nmore"]]
+    assert "stopped" not in stub_service.model.calls[-1]
+
+
+def test_draft_model_slower_than_plain(stub_service, monkeypatch):
+    clock = [0.0]
+    monkeypatch.setattr(
+        huggingface, "time", types.SimpleNamespace(perf_counter=lambda: clock[0])
+    )
+
+    # Assisted generation takes twice as long as plain decoding
+    generate = stub_service.model.generate
+
+    def slow_generate(input_ids, **kwargs):
+        clock[0] += 2.0 if "assistant_model" in kwargs else 1.0
+        return generate(input_ids, **kwargs)
+
+    stub_service.model.generate = slow_generate
+    stub_service.draft_model = object()
+    stub_service.draft_model_id = "draft"
+    stub_service.draft_enabled = True
+    stub_service.draft_sampling = False
+    stub_service.draft_min_acceptance = 0.0
+
+    for _ in range(20):
+        if not stub_service.draft_enabled:
+            break
+        assert stub_service._generate_batch(["a"], temperature=0) == [["c00"]]
+
+    assert not stub_service.draft_enabled
+    assert stub_service.plain_stats.generations >= huggingface.DRAFT_MIN_GENERATIONS
+    assisted = ["assistant_model" in call for call in stub_service.model.calls]
+    assert any(assisted) and not all(assisted)
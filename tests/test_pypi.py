@@ -0,0 +1,151 @@
+import sys
+
+from icortex import pypi
+from icortex.pypi import get_imported_modules, get_missing_modules
+
+
+def test_get_imported_modules():
+    code = """
+import os.path as osp, json
+from numpy.linalg import norm
+from . import local
+from __future__ import annotations
+try:
+    import optional_module
+except ImportError:
+    optional_module = None
+if True:
+    import pandas
+"""
+    assert get_imported_modules(code) == ["os", "json", "numpy", "pandas"]
+
+
+def test_get_imported_modules_invalid_code():
+    code = "import os.path as osp, json\nfrom numpy import (\n"
+    assert get_imported_modules(code) == ["os", "json", "numpy"]
+
+
+def test_module_exists_is_memoized(monkeypatch):
+    pypi.clear_module_cache()
+    calls = []
+    find_spec = pypi.importlib.util.find_spec
+
+    def counting_find_spec(name, *args, **kwargs):
+        calls.append(name)
+        return find_spec(name, *args, **kwargs)
+
+    monkeypatch.setattr(pypi.importlib.util, "find_spec", counting_find_spec)
+    code = "import json, nonexistent_module_for_icortex_tests"
+    assert get_missing_modules(code) == ["nonexistent_module_for_icortex_tests"]
+    assert get_missing_modules(code) == ["nonexistent_module_for_icortex_tests"]
+    assert calls == ["nonexistent_module_for_icortex_tests"]
+
+
+def test_install_packages_streams_output(monkeypatch, capsys):
+    def get_install_command(packages, **kwargs):
+        return [sys.executable, "-c", f"print('installing', {packages!r})"]
+
+    monkeypatch.setattr(pypi, "get_install_command", get_install_command)
+    assert pypi.install_packages(["a", "b"])
+    assert capsys.readouterr().out == "installing ['a', 'b']\n"
+
+
+def test_get_install_command_with_pip():
+    assert pypi.get_install_command(["numpy"], installer="pip") == [
+        sys.executable,
+        "-m",
+        "pip",
+        "install",
+        "numpy",
+    ]
+
+
+def test_module_index(tmp_path, monkeypatch):
+    monkeypatch.setattr(pypi, "_module_index", None)
+    index_path = str(tmp_path / "module_index.json")
+    index = pypi.get_module_index(index_path)
+
+    # Shipped mapping
+    assert index["cv2"] == "opencv-python"
+    # Overrides
+    assert index["sklearn"] == "scikit-learn"
+    # Installed distributions
+    assert index["IPython"].lower() == "ipython"
+    assert (tmp_path / "module_index.json").exists()
+
+
+def test_install_from_prefetched_wheels(tmp_path, monkeypatch):
+    commands = []
+
+    def get_download_command(packages, dest):
+        return [sys.executable, "-c", "print('downloading')"]
+
+    def install_packages(packages, **kwargs):
+        commands.append((packages, kwargs))
+        return True
+
+    monkeypatch.setattr(pypi, "get_download_command", get_download_command)
+    monkeypatch.setattr(pypi, "install_packages", install_packages)
+    monkeypatch.setattr(pypi, "module_to_pypi_package", lambda module: "package")
+
+    code = "import nonexistent_module_for_icortex_tests"
+    prefetch = pypi.prefetch_missing_packages(code, str(tmp_path))
+    assert prefetch.wait()
+    assert pypi.install_missing_packages(code, prefetch=prefetch) == []
+    assert commands == [
+        (
+            ["package"],
+            {"installer": "auto", "find_links": str(tmp_path), "no_index": True},
+        )
+    ]
+
+
+def test_offline_install_uses_wheelhouse_only(tmp_path, monkeypatch):
+    commands = []
+
+    def install_packages(packages, **kwargs):
+        commands.append((packages, kwargs))
+        return False
+
+    monkeypatch.setattr(pypi, "install_packages", install_packages)
+    monkeypatch.setattr(pypi, "module_to_pypi_package", lambda module: "package")
+
+    code = "import nonexistent_module_for_icortex_tests"
+    unresolved = pypi.install_missing_packages(
+        code, wheelhouse=str(tmp_path), offline=True
+    )
+    assert unresolved == ["nonexistent_module_for_icortex_tests"]
+    # No fallback to the package index
+    assert commands == [
+        (
+            ["package"],
+            {"installer": "auto", "find_links": str(tmp_path), "no_index": True},
+        )
+    ]
+
+
+def test_sync_wheelhouse(tmp_path, monkeypatch):
+    commands = []
+
+    def run_streamed(command):
+        commands.append(command)
+        return True
+
+    monkeypatch.setattr(pypi, "_run_streamed", run_streamed)
+    # Build the index under tmp_path instead of the user cache
+    monkeypatch.setattr(pypi, "_module_index", None)
+    pypi.get_module_index(str(tmp_path / "module_index.json"))
+
+    codes = [
+        "import os\nimport sklearn",
+        "from sklearn import svm\nimport nonexistent_module_for_icortex_tests",
+    ]
+    packages, unresolved, success = pypi.sync_wheelhouse(
+        codes, str(tmp_path / "wheels")
+    )
+    assert packages == ["scikit-learn"]
+    assert unresolved == ["nonexistent_module_for_icortex_tests"]
+    assert success
+    assert commands == [
+        pypi.get_download_command(["scikit-learn"], str(tmp_path / "wheels"))
+    ]
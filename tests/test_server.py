@@ -0,0 +1,79 @@
+import threading
+import typing as t
+
+import pytest
+
+from icortex import server
+from icortex.config import ICortexConfig
+from icortex.services.generation_result import GenerationResult
+from icortex.services.remote import RemoteService
+from icortex.services.service_base import ServiceBase, ServiceVariable
+
+
+class StubService(ServiceBase):
+    name = "stub"
+    description = "Service used for testing the generation server"
+    variables = {
+        "prefix": ServiceVariable(
+            str,
+            default="# ",
+            help="Prefix of the generated code",
+            argparse_args=["--prefix"],
+        ),
+    }
+
+    def generate(self, prompt: str, args, context=None) -> GenerationResult:
+        if prompt == "fail":
+            # A bug in a service must not be reported as an unknown service
+            raise KeyError("missing")
+        return GenerationResult(
+            {"service": self.name, "data": {"prompt": prompt}},
+            {"generated_text": [{"text": args.prefix + prompt}]},
+        )
+
+    def get_outputs_from_result(self, generation_result) -> t.List[str]:
+        return [i["text"] for i in generation_result.response_dict["generated_text"]]
+
+
+@pytest.fixture
+def server_url(tmp_path, monkeypatch):
+    def get_service(name):
+        return {"stub": StubService}[name]
+
+    monkeypatch.setattr(server, "get_service", get_service)
+    config_path = tmp_path / "icortex.toml"
+    config_path.write_text('service = "stub"\n\n[stub]\nprefix = "## "\n')
+
+    httpd = server.make_server(str(config_path), port=0)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_remote_round_trip(server_url):
+    service = RemoteService(url=server_url)
+    assert service.backend == "stub"
+    # Variables of the hosted service are exposed by the client
+    assert service.get_variable("prefix") is not None
+
+    args = service.prompt_parser.parse_args(["hello", "--prefix", ">> "])
+    result = service.generate("hello", args)
+    assert service.get_outputs_from_result(result) == [">> hello"]
+
+    with pytest.raises(Exception, match="KeyError"):
+        service.generate("fail", args)
+
+    with pytest.raises(Exception, match="Unknown service"):
+        RemoteService(url=server_url, backend="nonexistent")
+
+
+def test_set_hosted_variable(server_url, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    config_path = tmp_path / "client.toml"
+    config_path.write_text(f'service = "remote"\n\n[remote]\nurl = "{server_url}"\n')
+
+    config = ICortexConfig(str(config_path))
+    assert config.set_service_var("prefix", ">>> ")
+    assert ICortexConfig(str(config_path)).dict["remote"]["prefix"] == ">>> "
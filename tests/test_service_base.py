@@ -0,0 +1,83 @@
+import _thread
+import threading
+
+import pytest
+
+from icortex.services.service_base import (
+    GenerationCancelled,
+    ServiceBase,
+    ServiceVariable,
+)
+
+
+class BlockingService(ServiceBase):
+    name = "blocking"
+
+    def __init__(self, **kwargs):
+        self.stopped = threading.Event()
+        super().__init__(**kwargs)
+
+    def generate(self, prompt, args, context=None):
+        # Decode until cancelled, like a stopping criterion would
+        while not self.is_cancelled():
+            self.stopped.wait(0.01)
+        self.stopped.set()
+        return None
+
+    def get_outputs_from_result(self, generation_result):
+        return []
+
+
+def test_interrupt_cancels_generation():
+    service = BlockingService()
+    timer = threading.Timer(0.2, _thread.interrupt_main)
+    timer.start()
+    with pytest.raises(GenerationCancelled):
+        service._generate_in_background("prompt", None)
+
+    assert service.is_cancelled()
+    assert service.stopped.wait(1)
+
+
+def test_cancelled_generation_stays_cancelled():
+    service = BlockingService()
+    checks = []
+    generate = service.generate
+
+    def record_check(prompt, args, context=None):
+        checks.append(service.get_cancel_check())
+        if prompt == "block":
+            return generate(prompt, args, context=context)
+
+    service.generate = record_check
+    timer = threading.Timer(0.2, _thread.interrupt_main)
+    timer.start()
+    with pytest.raises(GenerationCancelled):
+        service._generate_in_background("block", None)
+
+    # The next prompt does not resume the cancelled generation
+    service._generate_in_background("next", None)
+    assert checks[0]()
+    assert not checks[1]()
+    assert service.stopped.wait(1)
+
+
+class VariableService(BlockingService):
+    name = "variables"
+    variables = {
+        "temperature": ServiceVariable(
+            float, default=0.5, argparse_args=["-t", "--temperature"]
+        ),
+        "model": ServiceVariable(str, default="small"),
+    }
+
+
+def test_set_variable_updates_parser_in_place():
+    service = VariableService()
+    parser = service.prompt_parser
+
+    assert service.set_variable("temperature", 0.9)
+    assert service.prompt_parser is parser
+    assert parser.parse_args(["prompt"]).temperature == 0.9
+    # Variables outside the parser need a new service instance
+    assert not service.set_variable("model", "large")
@@ -0,0 +1,58 @@
+import subprocess
+import sys
+
+# Cumulative import time budget for the CLI in microseconds. Importing the
+# kernel used to take it over 500 ms, so this leaves ample headroom for
+# slow machines while still catching heavy imports that sneak back in.
+CLI_IMPORT_BUDGET_US = 150_000
+
+# Modules that the CLI must not import until a command needs them
+HEAVY_MODULES = [
+    "IPython",
+    "ipykernel",
+    "jupyter_client",
+    "pkg_resources",
+    "pygments",
+    "black",
+    "toml",
+    "requests",
+    "torch",
+    "transformers",
+]
+
+
+def get_import_times(statement: str):
+    """Import times in microseconds, measured with ``-X importtime`` in a
+    fresh interpreter.
+
+    Returns:
+        Dict[str, int]: Map from module names to cumulative import times.
+    """
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    ret = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        ret[name.strip()] = int(cumulative)
+    return ret
+
+
+def test_cli_startup():
+    times = get_import_times("import icortex.cli")
+
+    imported = [name for name in HEAVY_MODULES if name in times]
+    assert imported == []
+    assert times["icortex.cli"] < CLI_IMPORT_BUDGET_US
+
+
+def test_package_import_is_lazy():
+    times = get_import_times("import icortex")
+
+    assert "icortex.kernel" not in times
+    assert "icortex.services" not in times